@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Benchmark of writing deeply nested indented output: the previous writer (one print() per line, and an indenting
+lambda wrapped around write_line at every depth) against OutputEmitter.
+
+    python benchmarks/bench_writer.py [--rules 20000] [--depth 16] [--repeat 5]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import css2stylus
+
+def build_tree(num_rules, max_depth, seed=0):
+    rnd = random.Random(seed)
+    converter = css2stylus.Css2Stylus()
+    converter._reset()
+    converter._use_indented_style = True
+
+    extraction_rules = css2stylus.ExtractionRules({})
+
+    for unused_i in range(num_rules):
+        # Few distinct parts per level, so that rules share their parents and the tree gets deep
+        selector = ' '.join('.level%d-%d' % (depth, rnd.randint(0, 3)) for depth in range(rnd.randint(1, max_depth)))
+        converter._addStyleRule({'type' : 'style',
+                                 'selector_list' : (selector,),
+                                 'properties' : [('color', 'red', ''), ('margin', '0 1px', '')]},
+                                {},
+                                extraction_rules)
+
+    return converter
+
+def write_tree_print(node, write_line):
+    """
+    Previous writer: print() per line, and one more lambda call per depth level for every line.
+    """
+    for child in node.iter_children():
+        write_line()
+
+        for selector in child.selector_list:
+            write_line(selector)
+
+        for property_line in child.properties:
+            write_line('  ' + property_line)
+
+        write_tree_print(child, lambda s='': write_line('  ' + s))
+
+def write_print(converter, filename):
+    with open(filename, 'wb') as f:
+        write_tree_print(converter._tree, lambda line='': print(line, file=f))
+
+def write_emitter(converter, filename, atomic=False):
+    with css2stylus.OutputEmitter(filename, atomic=atomic) as emitter:
+        converter._write_tree(emitter)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the output writer')
+    parser.add_argument('--rules', type=int, default=20000)
+    parser.add_argument('--depth', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    converter = build_tree(args.rules, args.depth)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filenames = {}
+        for name, write in (('print per line', write_print),
+                            ('OutputEmitter', write_emitter),
+                            ('OutputEmitter atomic', lambda converter, filename: write_emitter(converter, filename,
+                                                                                              atomic=True))):
+            filenames[name] = os.path.join(temp_dir, name.replace(' ', '_'))
+
+            times = []
+            for unused_i in range(args.repeat):
+                start_time = time.time()
+                write(converter, filenames[name])
+                times.append(time.time() - start_time)
+
+            print('%-22s best %.3fs  (%d bytes)' % (name, min(times), os.path.getsize(filenames[name])))
+
+        with open(filenames['print per line'], 'rb') as f:
+            expected = f.read()
+        for filename in filenames.values():
+            with open(filename, 'rb') as f:
+                assert f.read() == expected, 'Output differs'
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
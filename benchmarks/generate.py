@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Seeded generator of synthetic stylesheets and matching vars modules for benchmarking.
+
+Rules of "themed" selectors (starting with '.theme-N') use the same colors for every rule of a theme, so that the
+generated vars module extracts them without ambiguous values. Everything else is random, but the same seed always gives
+the same output.
+
+    python benchmarks/generate.py --rules 5000 --output big.css --vars-module-output bench_vars.py
+"""
+
+from __future__ import print_function
+import argparse
+import random
+
+TAGS = ('body', 'div', 'p', 'a', 'ul', 'li', 'span', 'input', 'h1', 'form')
+CLASSES = ('.ui-btn', '.ui-bar', '.ui-body', '.ui-icon', '.ui-link', '.ui-corner-all', '.ui-shadow', '.content',
+           '.header', '.footer')
+PSEUDOS = (':hover', ':focus', ':first-child', ':active')
+COMBINATORS = (' ', ' ', ' ', ' > ', ' + ')
+
+VALUES = {
+    'color' : ('red', '#fff', '#3c3c3c', 'rgba(0, 0, 0, 0.3)'),
+    'background' : ('#111', 'url(images/icons-18-white.png) no-repeat', 'transparent'),
+    'margin' : ('0', '0 auto', '1px 2px 3px 4px', '0.5em'),
+    'padding' : ('0', '.4em 15px', '10px'),
+    'font' : ('bold 16px/1.5 Helvetica, Arial, sans-serif', '12px Arial'),
+    'width' : ('100%', 'auto', '200px'),
+    'text-shadow' : ('0 1px 1px #000', 'none'),
+    'display' : ('block', 'inline-block', 'none'),
+}
+
+# Properties converted to Stylus functions (see NIB_SHORTHANDS)
+PREFIXED_PROPERTIES = (
+    ('border-radius', ('-webkit-', '-moz-', ''), ('.6em', '1em', '0')),
+    ('box-shadow', ('-webkit-', '-moz-', ''), ('0 1px 4px rgba(0, 0, 0, .3)', '0 0 12px #387bbe')),
+    ('background-clip', ('-webkit-', '-moz-', ''), ('padding-box', 'border-box')),
+)
+
+def _theme_colors(theme):
+    rnd = random.Random(theme)
+    return ['#%06x' % rnd.randrange(0x1000000) for unused_i in range(3)]
+
+def generate_stylesheet(num_rules, max_depth=4, comment_density=0.1, prefix_density=0.2, num_themes=10,
+                        theme_density=0.2, seed=0):
+    """
+    Returns CSS with num_rules style rules.
+
+    @param max_depth:
+        Maximum number of compound selectors in a selector (e.g. 'body .ui-btn > a:hover' has depth 3).
+    @param comment_density:
+        Probability of a comment before each rule.
+    @param prefix_density:
+        Probability of each property being one of the vendor-prefixed properties that are written as Stylus functions.
+    @param num_themes:
+        Number of different '.theme-N' classes, should equal the number of patterns of the vars module.
+    @param theme_density:
+        Probability of a rule having themed selectors.
+    """
+    rnd = random.Random(seed)
+    lines = []
+
+    def compound_selector():
+        part = rnd.choice(TAGS + CLASSES)
+        if rnd.random() < 0.3:
+            part += rnd.choice(CLASSES)
+        if rnd.random() < 0.1:
+            part += rnd.choice(PSEUDOS)
+        return part
+
+    for i in range(num_rules):
+        if rnd.random() < comment_density:
+            lines.append('/* Comment %d */' % i)
+
+        theme = rnd.randrange(num_themes) if num_themes and rnd.random() < theme_density else None
+
+        selectors = []
+        for unused_j in range(1 if rnd.random() < 0.7 else rnd.randint(2, 3)):
+            parts = [compound_selector() for unused_k in range(rnd.randint(1, max_depth))]
+            if theme is not None:
+                parts[0] = '.theme-%d' % theme
+
+            selector = parts[0]
+            for part in parts[1:]:
+                selector += rnd.choice(COMBINATORS) + part
+            selectors.append(selector)
+
+        declarations = []
+        for unused_j in range(rnd.randint(1, 6)):
+            if rnd.random() < prefix_density:
+                name, prefixes, values = rnd.choice(PREFIXED_PROPERTIES)
+                value = rnd.choice(values)
+                declarations.extend('%s%s: %s' % (prefix, name, value) for prefix in prefixes)
+            else:
+                name = rnd.choice(sorted(VALUES))
+                declarations.append('%s: %s' % (name, rnd.choice(VALUES[name])))
+
+        if theme is not None:
+            color, gradient_start, gradient_end = _theme_colors(theme)
+            declarations.append('color: %s' % color)
+            declarations.append('background-image: linear-gradient(%s, %s)' % (gradient_start, gradient_end))
+
+        lines.append('%s {\n    %s;\n}' % (',\n'.join(selectors), ';\n    '.join(declarations)))
+
+    return '\n'.join(lines) + '\n'
+
+def generate_vars_module(num_patterns):
+    """
+    Returns the source of a vars module with num_patterns selector patterns, extracting three variables each from
+    the themed rules of generate_stylesheet (with num_themes=num_patterns).
+    """
+    lines = ['"""',
+             'Generated by benchmarks/generate.py',
+             '"""',
+             '',
+             'EXTRACT_VARIABLES = {}']
+
+    for theme in range(num_patterns):
+        lines.append("EXTRACT_VARIABLES[r'\\.theme-%d( .*)?'] = {" % theme)
+        lines.append("    r'color' : [(r'<COLOR>', 'theme-%d-color')]," % theme)
+        lines.append("    r'background-image' : [(r'linear-gradient\\(\\s*<COLOR>', 'theme-%d-gradient-start'),"
+                     % theme)
+        lines.append("                           (r',\\s*<COLOR>', 'theme-%d-gradient-end')]," % theme)
+        lines.append('}')
+
+    return '\n'.join(lines) + '\n'
+
+def add_generator_arguments(parser):
+    parser.add_argument('--rules', type=int, default=5000, help='Number of style rules (default 5000)')
+    parser.add_argument('--depth', type=int, default=4, help='Maximum selector depth (default 4)')
+    parser.add_argument('--comment-density', type=float, default=0.1,
+                        help='Probability of a comment before each rule (default 0.1)')
+    parser.add_argument('--prefix-density', type=float, default=0.2,
+                        help='Probability of vendor-prefixed properties (default 0.2)')
+    parser.add_argument('--patterns', type=int, default=50,
+                        help='Number of patterns in the vars module (default 50)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+
+def generate_from_args(args):
+    """
+    Returns (CSS, vars module source) for the arguments of add_generator_arguments.
+    """
+    css = generate_stylesheet(num_rules=args.rules,
+                              max_depth=args.depth,
+                              comment_density=args.comment_density,
+                              prefix_density=args.prefix_density,
+                              num_themes=args.patterns,
+                              seed=args.seed)
+
+    return css, generate_vars_module(args.patterns)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic stylesheet and vars module')
+    add_generator_arguments(parser)
+    parser.add_argument('--output', required=True, help='CSS output file', metavar='FILENAME')
+    parser.add_argument('--vars-module-output', help='Vars module output file', metavar='FILENAME')
+    args = parser.parse_args()
+
+    css, vars_module = generate_from_args(args)
+
+    with open(args.output, 'wb') as f:
+        f.write(css)
+
+    if args.vars_module_output:
+        with open(args.vars_module_output, 'wb') as f:
+            f.write(vars_module)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Output profile benchmark: converts a generated stylesheet (see generate.py) with each output profile (see
+OUTPUT_PROFILES), merges the rules with the variables and compiles the merged Stylus file with the Stylus command line
+tool, which must be installed with nib (npm install -g stylus nib).
+
+    python benchmarks/output_profile.py --rules 20000 --patterns 200
+    python benchmarks/output_profile.py --stylus node_modules/.bin/stylus
+
+For each profile, prints the size of the merged Stylus file and the best time of --repeat Stylus compiles, and both
+relative to the first profile. The compiled CSS of all profiles is checked to be the same. Stylus compiles with
+--compress, so that the comments of the verbose output don't make a difference. Without Stylus, only the sizes are
+printed.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import css2stylus
+import generate
+
+def find_executable(name):
+    if os.path.dirname(name):
+        return name if os.path.isfile(name) else None
+
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        filename = os.path.join(directory, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+
+    return None
+
+def compile_stylus(stylus, filename, repeat):
+    """
+    Returns (best seconds of `repeat` compiles, compiled CSS).
+    """
+    best_seconds = None
+
+    for unused_i in range(repeat):
+        start_time = time.time()
+        process = subprocess.Popen([stylus, '--use', 'nib', '--compress', '--print', filename],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        css, stderr = process.communicate()
+        seconds = time.time() - start_time
+
+        if process.returncode:
+            raise Exception('Compiling %s failed:\n%s' % (filename, stderr))
+
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+
+    return best_seconds, css
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the output size and Stylus compile time of the output '
+                                                 'profiles')
+    generate.add_generator_arguments(parser)
+    parser.add_argument('--profiles', nargs='+', choices=css2stylus.OUTPUT_PROFILES,
+                        default=list(css2stylus.OUTPUT_PROFILES),
+                        help='Output profiles to compare (default %s)' % ' '.join(css2stylus.OUTPUT_PROFILES))
+    parser.add_argument('--parser', choices=sorted(css2stylus.PARSERS), default='builtin',
+                        help='CSS parser backend (default builtin)')
+    parser.add_argument('--no-indented-style', action='store_true', help='Benchmark linear instead of indented style')
+    parser.add_argument('--stylus', default='stylus', help='Stylus command line tool (default stylus)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of compiles per profile (default 3)')
+    args = parser.parse_args()
+
+    css, vars_module = generate.generate_from_args(args)
+    stylus = find_executable(args.stylus)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        vars_module_name = 'bench_vars_%d' % os.getpid()
+        with open(os.path.join(temp_dir, vars_module_name + '.py'), 'wb') as f:
+            f.write(vars_module)
+
+        sys.path.insert(0, temp_dir)
+        extraction_rules = css2stylus.ExtractionRules.from_modules([vars_module_name])
+
+        print('%d rules, %d bytes of CSS' % (args.rules, len(css)))
+        if stylus is None:
+            print('WARNING: %s not found, only comparing sizes' % args.stylus, file=sys.stderr)
+
+        print('%-10s %10s %8s %10s %12s %8s' % ('profile', 'bytes', 'size', 'lines', 'compile sec', 'speedup'))
+
+        baseline = None
+        for profile in args.profiles:
+            result = css2stylus.Css2Stylus().convert_css(css,
+                                                         extraction_rules,
+                                                         use_indented_style=not args.no_indented_style,
+                                                         parser=args.parser,
+                                                         output_profile=profile)
+            merged, warnings = css2stylus.Css2Stylus.merge_text(result.rules_text, result.vars_text)
+            for warning in warnings:
+                print(warning, file=sys.stderr)
+
+            merged_filename = os.path.join(temp_dir, profile + '.styl')
+            with open(merged_filename, 'wb') as f:
+                f.write(merged)
+
+            seconds, compiled = compile_stylus(stylus, merged_filename, args.repeat) if stylus else (None, None)
+
+            if baseline is None:
+                baseline = (len(merged), seconds, compiled)
+            elif compiled != baseline[2]:
+                print('ERROR: Compiled CSS of the %s profile differs from the %s profile' % (profile, args.profiles[0]),
+                      file=sys.stderr)
+                sys.exit(1)
+
+            print('%-10s %10d %7.1f%% %10d %12s %8s' % (profile,
+                                                        len(merged),
+                                                        100.0 * len(merged) / baseline[0],
+                                                        merged.count('\n'),
+                                                        '%.4f' % seconds if seconds is not None else '-',
+                                                        '%.2fx' % (baseline[1] / seconds) if seconds else '-'))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
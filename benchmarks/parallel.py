@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Parallel rule conversion benchmark: converts a generated stylesheet (see generate.py) with different numbers of worker
+processes (see ParallelRuleConverter) and prints the speedup against converting in a single process.
+
+    python benchmarks/parallel.py --rules 20000 --patterns 200
+    python benchmarks/parallel.py --workers 1 2 4 8 --parser cssutils
+
+For each number of workers, prints the best time of --repeat runs of the whole conversion and of its 'rules' stage
+(which includes starting the worker processes), and the speedup of both. The output of every run is checked against
+the output of the first number of workers, which should be 1.
+"""
+
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import css2stylus
+import generate
+
+def time_conversion(css, extraction_rules, num_workers, args):
+    """
+    Returns (seconds, seconds of the 'rules' stage, ConversionResult) of the fastest of args.repeat conversions.
+    """
+    best = None
+
+    for unused_i in range(args.repeat):
+        stats = css2stylus.ConversionStats()
+        start_time = time.time()
+        result = css2stylus.Css2Stylus().convert_css(css,
+                                                     extraction_rules,
+                                                     use_indented_style=not args.no_indented_style,
+                                                     parser=args.parser,
+                                                     stats=stats,
+                                                     num_workers=num_workers)
+        seconds = time.time() - start_time
+        rules_seconds = sum(stage_seconds for name, stage_seconds, unused_objects, unused_rss in stats.stages
+                            if name == 'rules')
+
+        if best is None or seconds < best[0]:
+            best = (seconds, rules_seconds, result)
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the conversion of a generated stylesheet with worker processes')
+    generate.add_generator_arguments(parser)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of worker processes to compare (default 1 2 4 8)')
+    parser.add_argument('--parser', choices=sorted(css2stylus.PARSERS), default='builtin',
+                        help='CSS parser backend (default builtin)')
+    parser.add_argument('--no-indented-style', action='store_true', help='Benchmark linear instead of indented style')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per number of workers (default 3)')
+    args = parser.parse_args()
+
+    css, vars_module = generate.generate_from_args(args)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        vars_module_name = 'bench_vars_%d' % os.getpid()
+        with open(os.path.join(temp_dir, vars_module_name + '.py'), 'wb') as f:
+            f.write(vars_module)
+
+        sys.path.insert(0, temp_dir)
+        extraction_rules = css2stylus.ExtractionRules.from_modules([vars_module_name])
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print('%d rules, %d bytes, %d CPUs' % (args.rules, len(css), multiprocessing.cpu_count()))
+    print('%-8s %10s %10s %12s %10s' % ('workers', 'seconds', 'speedup', 'rules stage', 'speedup'))
+
+    baseline = None
+    for num_workers in args.workers:
+        seconds, rules_seconds, result = time_conversion(css, extraction_rules, num_workers, args)
+
+        output = (result.rules_text, result.vars_text, result.messages)
+        if baseline is None:
+            baseline = (seconds, rules_seconds, output)
+        elif output != baseline[2]:
+            print('ERROR: Output with %d workers differs from the output with %d' % (num_workers, args.workers[0]),
+                  file=sys.stderr)
+            sys.exit(1)
+
+        print('%-8d %10.4f %9.2fx %12.4f %9.2fx' % (num_workers,
+                                                     seconds,
+                                                     baseline[0] / seconds,
+                                                     rules_seconds,
+                                                     baseline[1] / rules_seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Benchmark suite: converts a generated stylesheet (see generate.py) and times each stage of the conversion separately.
+
+    python benchmarks/run.py --rules 5000 --patterns 50 --output results.json
+    python benchmarks/run.py --rules 5000 --patterns 50 --compare results.json
+
+Stages:
+    load_rules        Import the vars module and compile the extraction rules
+    load_compiled     Load the same rules from a compiled rules file (see compile-vars mode)
+    parse             Split the CSS into statements (builtin parser) or build the CSSOM (cssutils)
+    collect_rules     Turn the parsed statements or CSSOM into rule records
+    add_style_rule    Css2Stylus._addStyleRule for all style rules (conversion, variable extraction and tree)
+    convert_rules     Only the property conversion and variable extraction part of it
+    build_tree        Only the tree part of it (finding or creating the node of each rule)
+    write_tree        Css2Stylus._write_tree into an output file
+    merge             Css2Stylus.merge of the rules and vars output
+    convert           The whole convert call, for comparison with the sum of the stages
+
+Each stage reports the best time of --repeat runs, throughput in rules per second and the peak RSS of the process
+after the stage. Results are saved as JSON with --output, and --compare prints the change against a saved run.
+"""
+
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import css2stylus
+import generate
+
+def parse_stages(parser_name, css):
+    """
+    Returns (parse function, collect function) of a parser backend. The parse function returns the parsed stylesheet,
+    and the collect function the records from that.
+    """
+    css_parser = css2stylus.PARSERS[parser_name]()
+
+    if parser_name == 'cssutils':
+        parse = lambda: css2stylus._import_cssutils().parseString(css, validate=False)
+        collect = lambda sheet: list(css_parser._iter_records(sheet))
+    else:
+        parse = lambda: list(css2stylus.iter_css_statements(css2stylus.StringIO(css)))
+        collect = lambda statements: [record
+                                      for statement in statements
+                                      for record in css_parser.parse_statement(statement)]
+
+    return parse, collect
+
+class Benchmark(object):
+    def __init__(self, temp_dir, css, vars_module_name, num_rules, parser, use_indented_style, repeat):
+        self.temp_dir = temp_dir
+        self.css = css
+        self.vars_module_name = vars_module_name
+        self.num_rules = num_rules
+        self.parser = parser
+        self.use_indented_style = use_indented_style
+        self.repeat = repeat
+
+        # Stage name => result dictionary
+        self.results = {}
+
+        self.css_filename = os.path.join(temp_dir, 'bench.css')
+        self.out_filename = os.path.join(temp_dir, 'bench.rules.styl')
+        self.vars_out_filename = os.path.join(temp_dir, 'bench.vars.styl')
+        self.merged_filename = os.path.join(temp_dir, 'bench.merged.styl')
+
+        with open(self.css_filename, 'wb') as f:
+            f.write(css)
+
+    def time_stage(self, name, function, setup=lambda: None):
+        """
+        Runs function(setup()) `repeat` times and records the best time. Returns the result of the last run.
+        """
+        times = []
+
+        for unused_i in range(self.repeat):
+            argument = setup()
+
+            # Garbage of previous stages shouldn't be collected while timing
+            gc.collect()
+
+            start_time = time.time()
+            result = function(argument)
+            times.append(time.time() - start_time)
+
+        seconds = min(times)
+        self.results[name] = {'seconds' : seconds,
+                              'rules_per_second' : self.num_rules / seconds if seconds else None,
+                              'peak_rss_mb' : css2stylus._get_peak_rss_mb()}
+
+        return result
+
+    def new_converter(self):
+        converter = css2stylus.Css2Stylus()
+        converter._reset()
+        converter._use_indented_style = self.use_indented_style
+        return converter
+
+    def run(self):
+        def load_rules(unused_argument):
+            # Import again every time
+            sys.modules.pop(self.vars_module_name, None)
+            return css2stylus.ExtractionRules.from_modules([self.vars_module_name])
+
+        extraction_rules = self.time_stage('load_rules', load_rules)
+
+        compiled_filename = os.path.join(self.temp_dir, 'bench.compiled.json')
+        css2stylus.ExtractionRules.compile([self.vars_module_name], compiled_filename)
+        self.time_stage('load_compiled',
+                        lambda unused_argument: css2stylus.ExtractionRules.from_modules([compiled_filename]))
+
+        parse, collect = parse_stages(self.parser, self.css)
+        parsed = self.time_stage('parse', lambda unused_argument: parse())
+        records = self.time_stage('collect_rules', lambda unused_argument: collect(parsed))
+        style_rules = [record for record in records if record['type'] == 'style']
+
+        def add_style_rules(converter):
+            extracted_variables = {}
+            for rule in style_rules:
+                converter._addStyleRule(rule, extracted_variables, extraction_rules)
+            return converter
+
+        converter = self.time_stage('add_style_rule', add_style_rules, setup=self.new_converter)
+
+        self.time_stage('convert_rules',
+                        lambda converter: [converter._convertStyleRule(rule, extraction_rules) for rule in style_rules],
+                        setup=self.new_converter)
+
+        self.time_stage('build_tree',
+                        lambda converter: [converter._get_rule_node(rule['selector_list']) for rule in style_rules],
+                        setup=self.new_converter)
+
+        def write_tree(unused_argument):
+            with css2stylus.OutputEmitter(self.out_filename) as emitter:
+                converter._write_tree(emitter)
+
+        self.time_stage('write_tree', write_tree)
+
+        def convert(unused_argument):
+            with css2stylus.captured_output():
+                css2stylus.Css2Stylus().convert(filename=self.css_filename,
+                                                out_filename=self.out_filename,
+                                                vars_out_filename=self.vars_out_filename,
+                                                vars_modules=None,
+                                                use_indented_style=self.use_indented_style,
+                                                parser=self.parser,
+                                                extraction_rules=extraction_rules)
+
+        self.time_stage('convert', convert)
+
+        def merge(unused_argument):
+            # Remove the previous output, merge doesn't write an unchanged file
+            if os.path.exists(self.merged_filename):
+                os.remove(self.merged_filename)
+
+            css2stylus.Css2Stylus.merge(stylus_filename=self.out_filename,
+                                        vars_filename=self.vars_out_filename,
+                                        out_merged_filename=self.merged_filename)
+
+        self.time_stage('merge', merge)
+
+STAGE_NAMES = ('load_rules', 'load_compiled', 'parse', 'collect_rules', 'add_style_rule', 'convert_rules', 'build_tree',
+               'write_tree', 'merge', 'convert')
+
+def print_results(results, compare_results=None):
+    header = '%-16s %10s %14s %10s' % ('stage', 'seconds', 'rules/sec', 'peak RSS')
+    if compare_results:
+        header += ' %10s' % 'change'
+    print(header)
+
+    for name in STAGE_NAMES:
+        result = results['stages'][name]
+        line = '%-16s %10.4f %14s %10s' % (name,
+                                          result['seconds'],
+                                          '%.0f' % result['rules_per_second'] if result['rules_per_second'] else '-',
+                                          '%.1f MB' % result['peak_rss_mb'] if result['peak_rss_mb'] else '-')
+
+        if compare_results:
+            old_result = compare_results['stages'].get(name)
+            if old_result and old_result['seconds']:
+                line += ' %+9.1f%%' % ((result['seconds'] / old_result['seconds'] - 1) * 100)
+
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the stages of a conversion of a generated stylesheet')
+    generate.add_generator_arguments(parser)
+    parser.add_argument('--parser', choices=sorted(css2stylus.PARSERS), default='builtin',
+                        help='CSS parser backend (default builtin)')
+    parser.add_argument('--no-indented-style', action='store_true', help='Benchmark linear instead of indented style')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each stage (default 3)')
+    parser.add_argument('--output', help='Save the results to this JSON file', metavar='FILENAME')
+    parser.add_argument('--compare', help='Compare with results saved with --output', metavar='FILENAME')
+    args = parser.parse_args()
+
+    css, vars_module = generate.generate_from_args(args)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        vars_module_name = 'bench_vars_%d' % os.getpid()
+        with open(os.path.join(temp_dir, vars_module_name + '.py'), 'wb') as f:
+            f.write(vars_module)
+
+        # ExtractionRules.from_modules imports from the current directory
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        try:
+            benchmark = Benchmark(temp_dir=temp_dir,
+                                  css=css,
+                                  vars_module_name=vars_module_name,
+                                  num_rules=args.rules,
+                                  parser=args.parser,
+                                  use_indented_style=not args.no_indented_style,
+                                  repeat=args.repeat)
+            benchmark.run()
+        finally:
+            os.chdir(cwd)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    results = {'parameters' : {'rules' : args.rules,
+                               'depth' : args.depth,
+                               'comment_density' : args.comment_density,
+                               'prefix_density' : args.prefix_density,
+                               'patterns' : args.patterns,
+                               'seed' : args.seed,
+                               'parser' : args.parser,
+                               'indented_style' : not args.no_indented_style,
+                               'repeat' : args.repeat,
+                               'css_bytes' : len(css)},
+               'python' : platform.python_version(),
+               'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'stages' : benchmark.results}
+
+    compare_results = None
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            compare_results = json.load(f)
+
+        if compare_results['parameters'] != results['parameters']:
+            print('WARNING: Parameters differ from the compared run', file=sys.stderr)
+
+    print_results(results, compare_results)
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Startup benchmark: measures how long the command line tool takes for small inputs, where starting the interpreter and
+importing modules is most of the work.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --imports merge
+
+For each mode, prints the end-to-end latency (best of --repeat runs) and the number of imported modules, and the
+overhead compared with starting the interpreter only. Python doesn't cache the bytecode of the script it runs, so
+compiling css2stylus.py is part of every run and printed separately.
+
+--imports prints the slowest imports of a mode like `python -X importtime` (which Python 2 doesn't have), measured by
+timing every import statement.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate
+
+SCRIPT_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'css2stylus.py')
+
+MODES = (
+    ('merge', ['merge', '--input', 'rules.styl', '--vars-input', 'vars.styl', '--output', 'merged.styl']),
+    ('convert builtin', ['convert', '--input', 'small.css', '--output', 'rules.styl', '--vars-output', 'vars.styl',
+                         '--parser', 'builtin']),
+    ('convert cssutils', ['convert', '--input', 'small.css', '--output', 'rules.styl', '--vars-output', 'vars.styl',
+                          '--parser', 'cssutils']),
+)
+
+# Runs css2stylus.main() with every import timed, and prints {module: [self seconds, cumulative seconds]} and the
+# imported modules as JSON to stderr
+IMPORT_TIMING_CODE = r'''
+import __builtin__, json, sys, time
+
+original_import = __builtin__.__import__
+import_times = {}
+nested_seconds = []
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return original_import(name, *args, **kwargs)
+
+    nested_seconds.append(0.0)
+    start_time = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        seconds = time.time() - start_time
+        self_seconds = seconds - nested_seconds.pop()
+        if nested_seconds:
+            nested_seconds[-1] += seconds
+        import_times.setdefault(name, [self_seconds, seconds])
+
+__builtin__.__import__ = timed_import
+
+sys.path.insert(0, %(script_dir)r)
+sys.argv = %(argv)r
+import css2stylus
+css2stylus.main()
+
+__builtin__.__import__ = original_import
+sys.stderr.write('\n' + json.dumps({'imports' : import_times, 'modules' : sorted(sys.modules)}) + '\n')
+'''
+
+def best_seconds(args, repeat):
+    seconds = []
+    with open(os.devnull, 'wb') as devnull:
+        for unused_i in range(repeat):
+            start_time = time.time()
+            subprocess.check_call([sys.executable] + args, stdout=devnull, stderr=devnull)
+            seconds.append(time.time() - start_time)
+    return min(seconds)
+
+def get_import_report(argv):
+    code = IMPORT_TIMING_CODE % {'script_dir' : os.path.dirname(os.path.abspath(SCRIPT_FILENAME)),
+                                 'argv' : [SCRIPT_FILENAME] + argv}
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    unused_stdout, stderr = process.communicate()
+    if process.returncode:
+        raise Exception('Running %s failed:\n%s' % (' '.join(argv), stderr))
+    return json.loads(stderr.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the startup time of the command line tool')
+    parser.add_argument('--rules', type=int, default=20, help='Number of style rules of the input (default 20)')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs of each mode (default 10)')
+    parser.add_argument('--imports', choices=[name for name, unused_argv in MODES],
+                        help='Print the slowest imports of this mode')
+    parser.add_argument('--top', type=int, default=15, help='Number of imports printed with --imports (default 15)')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(temp_dir)
+    try:
+        with open('small.css', 'wb') as f:
+            f.write(generate.generate_stylesheet(args.rules))
+
+        # Input files of merge mode
+        best_seconds([SCRIPT_FILENAME] + MODES[1][1], 1)
+
+        baseline_seconds = best_seconds(['-c', 'pass'], args.repeat)
+        with open(SCRIPT_FILENAME, 'rb') as f:
+            source = f.read()
+        start_time = time.time()
+        compile(source, SCRIPT_FILENAME, 'exec')
+        compile_seconds = time.time() - start_time
+
+        print('%-18s %10s %10s %8s' % ('mode', 'seconds', 'overhead', 'modules'))
+        print('%-18s %10.4f %10s %8s' % ('(interpreter)', baseline_seconds, '-', '-'))
+        print('%-18s %10s %10.4f %8s' % ('(compile script)', '-', compile_seconds, '-'))
+
+        for name, argv in MODES:
+            seconds = best_seconds([SCRIPT_FILENAME] + argv, args.repeat)
+            report = get_import_report(argv)
+            print('%-18s %10.4f %10.4f %8d' % (name, seconds, seconds - baseline_seconds, len(report['modules'])))
+
+            if name == args.imports:
+                import_report = report
+
+        if args.imports:
+            print()
+            print('%-30s %10s %12s' % ('import', 'self', 'cumulative'))
+            for module_name, (self_seconds, seconds) in sorted(import_report['imports'].items(),
+                                                               key=lambda item: -item[1][1])[:args.top]:
+                print('%-30s %10.4f %12.4f' % (module_name, self_seconds, seconds))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,19 @@ Dependencies:
 """
 
 from __future__ import print_function
-import cssutils
+import bisect
+import contextlib
+import hashlib
 import os
 import re
 from StringIO import StringIO
 import sys
-import unittest
+import traceback
+
+# Slow imports (cssutils, multiprocessing, unittest, ...) are done where they're needed, so that e.g. merge mode starts
+# quickly. test_startup checks that they stay out of the modes that don't need them.
+
+__version__ = '0.2'
 
 # Browser specific name => Stylus function name
 # If a -moz- or -webkit- key is mapped, the official name must be mapped also (even if the official name differs)
@@ -25,131 +32,2810 @@ NIB_SHORTHANDS = {
     '-moz-border-radius-topleft' : 'border-top-left-radius',
 }
 
-OPERATORS = ('>', '*', '+')
+# Vendor prefixes of the NIB_SHORTHANDS properties that are written as the same function call (nib adds the prefixed
+# versions itself). Vars modules can add more, e.g. VENDOR_PREFIXES = ['-khtml-'].
+VENDOR_PREFIXES = ('-moz-', '-webkit-', '-ms-', '-o-')
+
+def build_shorthand_index(shorthands=NIB_SHORTHANDS, vendor_prefixes=VENDOR_PREFIXES):
+    """
+    Returns a dictionary property name => Stylus function for all properties that are written as function call: the
+    shorthands and their vendor-prefixed versions.
+    """
+    index = dict(shorthands)
+
+    # The function of the unprefixed name wins if a prefixed name is a shorthand itself
+    for prefix in vendor_prefixes:
+        for name, stylus_function in shorthands.items():
+            index[prefix + name] = stylus_function
+
+    return index
+
+# Stylus functions that are not in the nib library, but are called for NIB_SHORTHANDS: (name, lines of the definition)
+HELPER_FUNCTIONS = (
+    ('border-top-left-radius', ('border-top-left-radius()',
+                                '  border-top-left-radius: arguments',
+                                '  -webkit-border-top-left-radius: arguments',
+                                '  -moz-border-radius-topleft: arguments')),
+)
+
+# Formats of the rules output (see Css2Stylus.convert)
+OUTPUT_PROFILES = ('verbose', 'compact')
+
+# Combinators between compound selectors, besides whitespace
+SELECTOR_COMBINATORS = ('>', '+', '~')
+
+# Replacements for the templates in the search regexes of EXTRACT_VARIABLES
+SEARCH_REGEX_TEMPLATES = (
+    # Match colors #fff, #123456, red, white, etc.
+    ('<COLOR>', r'(?P<color>#[a-fA-F0-9]{3,6}|[a-z]{3,20})'),
+    ('<VALUE>', r'\s*(?P<value>.*)\s*'),
+)
+
+# Regex groups that contain the variable value
+VARIABLE_VALUE_GROUP_NAMES = ('color', 'value')
+
+# Number of bytes read at once in streaming mode
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+def iter_css_statements(f, chunk_size=STREAMING_CHUNK_SIZE):
+    """
+    Reads a CSS file object in chunks and yields its top-level statements (comments, rules and at-rules) one at a
+    time, so that only the current statement has to be held in memory. Comments and strings are skipped when looking
+    for the braces and semicolons that end a statement.
+    """
+    # Regexes finding the next interesting character, depending on whether we're inside a comment or string
+    special_regexes = {None : re.compile(r'[{};"\']|/\*'),
+                       '*/' : re.compile(r'\*/'),
+                       '"' : re.compile(r'[\\"\n]'),
+                       "'" : re.compile(r"[\\'\n]")}
+
+    pending = ''
+    eof = False
+
+    # Start of the current statement, position up to which `pending` was scanned and start of the last comment
+    start = pos = comment_start = 0
+
+    depth = 0
+    inside = None
+
+    while True:
+        match = special_regexes[inside].search(pending, pos)
+
+        if match is None or (match.group() == '\\' and match.end() == len(pending)):
+            if eof:
+                statement = pending[start:].strip()
+                if statement:
+                    yield statement
+                return
+
+            # Tokens like '/*' may continue in the next chunk, so the last character is scanned again
+            pos = max(pos, len(pending) - 1) - start
+            comment_start -= start
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            pending = pending[start:] + chunk
+            start = 0
+            continue
+
+        token = match.group()
+        pos = match.end()
+        end = None
+
+        if inside is None:
+            if token == '/*':
+                inside = '*/'
+                comment_start = match.start()
+            elif token in ('"', "'"):
+                inside = token
+            elif token == '{':
+                depth += 1
+            elif token == '}':
+                depth = max(0, depth - 1)
+                if depth == 0:
+                    end = pos
+            elif depth == 0:
+                # Semicolon ending an at-rule like @import
+                end = pos
+        elif inside == '*/':
+            inside = None
+
+            if depth == 0 and not pending[start:comment_start].strip():
+                # Comment between rules
+                end = pos
+        elif token == '\\':
+            # Skip escaped character
+            pos += 1
+        else:
+            # End of string (or invalid newline in string)
+            inside = None
+
+        if end is not None:
+            statement = pending[start:end].strip()
+            if statement:
+                yield statement
+
+            start = end
+
+# cssutils rule type numbers, used for the "Unsupported rule type" message of the builtin parser
+AT_RULE_TYPES = {
+    'charset' : 2,
+    'import' : 3,
+    'media' : 4,
+    'font-face' : 5,
+    'page' : 6,
+    'namespace' : 10,
+}
+
+# Length units that cssutils drops from zero values ('0px' => '0')
+ZERO_DROPPED_UNITS = ('cm', 'mm', 'in', 'px', 'pc', 'pt', 'em', 'ex')
+
+def _print_warning(message):
+    print(message, file=sys.stderr)
+
+# Imported by _import_cssutils when parsing the first stylesheet with it
+cssutils = None
+
+# Stream given to redirected_cssutils_log, cssutils log messages are written to sys.stderr if None
+_cssutils_log_stream = None
+
+class _CssutilsLogStream(object):
+    """
+    Stream of the cssutils log handler. cssutils may be imported while sys.stderr is redirected (e.g. by
+    captured_output), so the handler must not keep the sys.stderr of that time.
+    """
+
+    def write(self, text):
+        (_cssutils_log_stream or sys.stderr).write(text)
+
+    def flush(self):
+        (_cssutils_log_stream or sys.stderr).flush()
+
+def _import_cssutils():
+    """
+    Imports cssutils on first use. It takes longer to import than everything else that merge mode does.
+    """
+    global cssutils
+
+    if cssutils is None:
+        import cssutils
+        import logging
+
+        for handler in logging.getLogger('CSSUTILS').handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stderr:
+                handler.stream = _CssutilsLogStream()
+
+    return cssutils
+
+class CssutilsParser(object):
+    """
+    Reference parser backend using cssutils. Yields records of the following types:
+
+        {'type' : 'comment', 'text' : '/* ... */'}
+        {'type' : 'style', 'selector_list' : (selector, ...), 'properties' : [(name, value, priority), ...]}
+        {'type' : 'media', 'media_text' : 'screen and (...)', 'rules' : [record, ...]}
+
+    @param warn:
+        Function called with the text of each warning (e.g. unsupported rule types), default is printing to stderr.
+    """
+
+    def __init__(self, warn=None):
+        self._warn = warn or _print_warning
+
+        # @charset and @namespace statements passed to parse_statement so far, and the number of rules they give
+        self._prelude = ''
+        self._num_prelude_rules = 0
+
+    def parse(self, css):
+        return self._iter_records(_import_cssutils().parseString(css, validate=False))
+
+    def parse_statement(self, statement):
+        """
+        Parses one statement of a stylesheet (see iter_css_statements) like parse does as part of the whole stylesheet.
+        The @charset and @namespace statements are parsed again in front of every later statement, since the encoding
+        and the namespace prefixes of the selectors depend on them.
+        """
+        rules = list(_import_cssutils().parseString(self._prelude + statement, validate=False))
+        rules = rules[self._num_prelude_rules:]
+
+        if rules and all(rule.type in (rule.CHARSET_RULE, rule.NAMESPACE_RULE) for rule in rules):
+            self._prelude += statement + '\n'
+            self._num_prelude_rules += len(rules)
+
+        return self._iter_records(rules)
+
+    def _iter_records(self, rules):
+        for rule in rules:
+            if rule.type == rule.COMMENT:
+                yield {'type' : 'comment',
+                       'text' : rule.cssText}
+            elif rule.type == rule.STYLE_RULE:
+                selector_list = tuple(selector.selectorText for selector in rule.selectorList)
+
+                properties = []
+                for property in rule.style:
+                    properties.append((property.name, property.value, property.priority))
+
+                yield {'type' : 'style',
+                       'selector_list' : selector_list,
+                       'properties' : properties}
+            elif rule.type == rule.MEDIA_RULE:
+                yield {'type' : 'media',
+                       'media_text' : rule.media.mediaText,
+                       'rules' : list(self._iter_records(rule.cssRules))}
+            else:
+                self._warn('Unsupported rule type: %d' % rule.type)
+
+class BuiltinParser(object):
+    """
+    Lightweight parser backend that only extracts what the converter needs and yields the same records as
+    CssutilsParser. Selectors and property values are normalized like cssutils serializes them (whitespace, numbers,
+    colors, strings, URLs, comments, escapes, !important). Declarations and selectors that cssutils would reject
+    because of syntax errors are dropped (rules with the same message as cssutils), but browser hacks and other exotic
+    syntax may give different results than cssutils.
+    """
+
+    _value_token_regex = re.compile(r'''
+        (?P<comment>/\*.*?\*/) |
+        (?P<space>\s+) |
+        (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*') |
+        (?P<urange>[uU]\+[0-9a-fA-F?]{1,6}(?:-[0-9a-fA-F]{1,6})?) |
+        (?P<url>[uU][rR][lL]\(\s*(?:"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|[^'"()\s]*)\s*\)) |
+        (?P<dimension>(?P<number>[+-]?(?:\d*\.\d+|\d+))(?P<unit>%|-?[a-zA-Z_][\w-]*)?) |
+        (?P<hash>\#[\w-]+) |
+        (?P<function>-?[a-zA-Z_][\w-]*\() |
+        (?P<ident>-?[a-zA-Z_][\w-]*) |
+        (?P<char>.)
+    ''', re.X | re.S)
+
+    _selector_token_regex = re.compile(r'''
+        (?P<comment>/\*.*?\*/) |
+        (?P<space>\s+) |
+        (?P<combinator>[>+~]) |
+        (?P<attribute>\[(?:[^\]"']|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')*\]) |
+        (?P<pseudo>::?-?[a-zA-Z_][\w-]*(?:\((?:[^()"']|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')*\))?) |
+        (?P<simple>(?:[\w#.*-]|\\[0-9a-fA-F]{1,6}\s?|\\[^\n0-9a-fA-F])+) |
+        (?P<char>.)
+    ''', re.X | re.S)
+
+    # Hexadecimal escape in a selector, which cssutils replaces by the character
+    _hex_escape_regex = re.compile(r'\\([0-9a-fA-F]{1,6})\s?')
+
+    _property_name_regex = re.compile(r'-?[a-zA-Z_][\w-]*$')
+
+    _media_feature_regex = re.compile(r'\(\s*([^:()]+?)\s*(?::\s*([^()]*?)\s*)?\)')
+
+    _charset_regex = re.compile(r'(?:\xef\xbb\xbf)?@charset\s+"([^"]*)"\s*;')
+
+    def __init__(self, warn=None):
+        self._warn = warn or _print_warning
+
+        # Encoding of the statements, set by the @charset statement
+        self._encoding = 'utf-8'
+
+    def parse(self, css):
+        for statement in iter_css_statements(StringIO(css)):
+            for record in self.parse_statement(statement):
+                yield record
+
+    def parse_statement(self, statement):
+        if not isinstance(statement, unicode):
+            charset_match = self._charset_regex.match(statement)
+            if charset_match:
+                import codecs
+
+                try:
+                    self._encoding = codecs.lookup(charset_match.group(1)).name
+                except LookupError:
+                    self._warn('Unknown @charset encoding: %s, decoding as UTF-8' % charset_match.group(1))
+
+            statement = statement.decode(self._encoding)
+            if statement.startswith(u'\ufeff'):
+                statement = statement[1:]
+
+        statement = statement.strip()
+
+        if statement.startswith('/*'):
+            yield {'type' : 'comment',
+                   'text' : statement}
+        elif statement.startswith('@'):
+            keyword = re.match(r'@([\w-]*)', statement).group(1).lower()
+
+            if keyword == 'media' and statement.endswith('}') and '{' in statement:
+                block_start = statement.index('{')
+
+                rules = []
+                for inner_statement in iter_css_statements(StringIO(statement[block_start + 1:-1])):
+                    rules.extend(self.parse_statement(inner_statement))
+
+                yield {'type' : 'media',
+                       'media_text' : self._normalize_media_text(statement[len('@media'):block_start]),
+                       'rules' : rules}
+            else:
+                self._warn('Unsupported rule type: %d' % AT_RULE_TYPES.get(keyword, 0))
+        elif statement.endswith('}') and '{' in statement:
+            block_start = self._find_top_level(statement, '{')
+            selector_list = self._parse_selector_list(statement[:block_start])
+
+            if selector_list is not None:
+                yield {'type' : 'style',
+                       'selector_list' : selector_list,
+                       'properties' : self._parse_declarations(statement[block_start + 1:-1])}
+
+    @classmethod
+    def _split_top_level(cls, text, separator):
+        """
+        Splits at the separator character, ignoring separators in strings, comments, parentheses and brackets.
+        """
+        parts = []
+        depth = 0
+        start = 0
+
+        for match in re.finditer(r'''/\*.*?\*/|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[()\[\]]|%s''' % re.escape(separator),
+                                 text,
+                                 re.S):
+            token = match.group()
+            if token in '([':
+                depth += 1
+            elif token in ')]':
+                depth -= 1
+            elif token == separator and depth == 0:
+                parts.append(text[start:match.start()])
+                start = match.end()
+
+        parts.append(text[start:])
+        return parts
+
+    @classmethod
+    def _find_top_level(cls, text, separator):
+        return len(cls._split_top_level(text, separator)[0])
+
+    def _parse_selector_list(self, text):
+        selector_list = []
+
+        for selector in self._split_top_level(text, ','):
+            normalized_selector = self._normalize_selector(selector)
+
+            if normalized_selector is None:
+                # Like cssutils, drop the whole rule with the same message
+                if selector:
+                    self._warn('ERROR\tSelectorList: Invalid Selector: %s' % selector)
+                else:
+                    self._warn('ERROR\tSelectorList: Unknown Syntax: %r' % text)
+                return None
+
+            selector_list.append(normalized_selector)
+
+        return tuple(selector_list)
+
+    def _normalize_selector(self, selector):
+        """
+        Returns the selector serialized like cssutils does, or None if it's invalid. Comments are kept where they are,
+        with whitespace before them, but cssutils drops the whitespace after a comment that follows a combinator:
+
+            'a /**/b' => 'a /**/b', 'a>/**/ b' => 'a > /**/b'
+        """
+        out = []
+        # Whether whitespace came right before the current token, and since the last compound selector. Whitespace on
+        # either side of a comment between compound selectors is a descendant combinator.
+        pending_space = False
+        seen_space = False
+        after_comment = False
+        expect_compound = True
+
+        for match in self._selector_token_regex.finditer(selector.strip()):
+            kind = match.lastgroup
+            token = match.group()
+
+            if kind == 'space':
+                pending_space = True
+                seen_space = True
+            elif kind == 'comment':
+                out.append(' ' + token if pending_space and not expect_compound else token)
+                pending_space = False
+                after_comment = True
+            elif kind == 'combinator':
+                if expect_compound:
+                    return None
+                out.append(' %s ' % token)
+                pending_space = False
+                seen_space = False
+                after_comment = False
+                expect_compound = True
+            elif kind == 'char':
+                return None
+            else:
+                if not expect_compound:
+                    if pending_space:
+                        out.append(' ')
+                    elif after_comment and not seen_space:
+                        # 'a/**/b' has no combinator
+                        return None
+
+                pending_space = False
+                seen_space = False
+                after_comment = False
+                expect_compound = False
+
+                if kind == 'attribute':
+                    token = self._normalize_attribute_selector(token)
+                elif kind == 'pseudo':
+                    token = self._normalize_pseudo_selector(token)
+                    if token is None:
+                        return None
+                elif '\\' in token:
+                    token = self._hex_escape_regex.sub(self._unescape_hex, token)
+
+                out.append(token)
+
+        if expect_compound:
+            # Empty selector or ends with a combinator
+            return None
+
+        return ''.join(out)
+
+    def _normalize_attribute_selector(self, token):
+        out = []
+        for match in self._value_token_regex.finditer(token[1:-1]):
+            kind = match.lastgroup
+            if kind == 'string':
+                out.append(self._serialize_string(match.group()))
+            elif kind not in ('space', 'comment'):
+                out.append(match.group())
+
+        return '[%s]' % ''.join(out)
+
+    @staticmethod
+    def _unescape_hex(match):
+        try:
+            return unichr(int(match.group(1), 16))
+        except ValueError:
+            # Beyond the characters of a narrow Python build
+            return match.group()
+
+    def _normalize_pseudo_selector(self, token):
+        """
+        Returns the pseudo-class or pseudo-element serialized like cssutils does, or None if it's invalid.
+        """
+        if '(' not in token:
+            return token.lower()
+
+        name, argument = token[:-1].split('(', 1)
+        name = name.lower()
+
+        if name == ':not':
+            # cssutils only accepts a single compound selector
+            if (len(self._split_top_level(argument, ',')) > 1 or
+                    any(match.lastgroup == 'combinator' for match in self._selector_token_regex.finditer(argument))):
+                return None
+
+            argument = argument.strip()
+        else:
+            argument = re.sub(r'\s+', ' ', argument).rstrip()
+
+        return '%s(%s)' % (name, argument)
+
+    def _normalize_media_text(self, text):
+        media_text = ', '.join(re.sub(r'\s+', ' ', query.strip()) for query in self._split_top_level(text, ','))
+
+        return self._media_feature_regex.sub(lambda match: ('(%s: %s)' % (match.group(1),
+                                                                          self._serialize_value(match.group(2))[0])
+                                                            if match.group(2) is not None
+                                                            else '(%s)' % match.group(1)),
+                                             media_text)
+
+    def _parse_declarations(self, text):
+        # Normalized name => (position of last occurrence, effective (name, value, priority))
+        effective = {}
+
+        for position, declaration in enumerate(self._split_top_level(text, ';')):
+            name, colon, value = declaration.partition(':')
+
+            # Comments before the name are allowed
+            name = re.sub(r'/\*.*?\*/', '', name, flags=re.S).strip()
+            name = re.sub(r'\\([^0-9a-fA-F\n])', r'\1', name).lower()
+
+            if not colon or not self._property_name_regex.match(name):
+                continue
+
+            value, priority = self._serialize_value(value)
+
+            if not value:
+                continue
+
+            previous = effective.get(name)
+            if previous is not None and previous[1][2] and not priority:
+                # An !important declaration wins over later ones without priority
+                effective[name] = (position, previous[1])
+            else:
+                effective[name] = (position, (name, value, priority))
+
+        return [property for unused_position, property in sorted(effective.values())]
+
+    def _serialize_value(self, text):
+        """
+        Returns (value, priority) serialized like cssutils does, or (None, None) for invalid values.
+        """
+        out = []
+        # Names of the functions we're currently in
+        functions = []
+        priority = ''
+        in_priority = False
+
+        def remove_last_space():
+            if out and out[-1] == ' ':
+                del out[-1]
+
+        for match in self._value_token_regex.finditer(text):
+            kind = match.lastgroup
+            token = match.group()
+
+            if kind == 'space' or (kind == 'comment' and not functions):
+                continue
+
+            if in_priority:
+                if kind != 'ident' or priority:
+                    return None, None
+                priority = token.lower()
+                continue
+
+            if kind == 'char':
+                if token == '!' and not functions:
+                    in_priority = True
+                    continue
+                elif token == ')' and functions:
+                    functions.pop()
+                    remove_last_space()
+                    out.append(')')
+                    out.append(' ')
+                elif token in '+-*/' and functions and functions[-1] == 'calc(':
+                    # Operators in calc() are always surrounded by spaces
+                    remove_last_space()
+                    out.append(' %s ' % token)
+                elif token == '=' and functions:
+                    # IE filter like Alpha(Opacity=30)
+                    remove_last_space()
+                    out.append(token)
+                elif token in ',/':
+                    remove_last_space()
+                    out.append(token)
+                    if token == ',':
+                        out.append(' ')
+                else:
+                    return None, None
+                continue
+
+            if kind == 'function':
+                functions.append(token.lower())
+                out.append(token)
+                continue
+
+            if kind == 'dimension':
+                token = self._serialize_number(match.group('number'), match.group('unit') or '')
+            elif kind == 'hash':
+                if len(token) == 7 and token[1] == token[2] and token[3] == token[4] and token[5] == token[6]:
+                    token = '#%s%s%s' % (token[1], token[3], token[5])
+            elif kind == 'string':
+                token = self._serialize_string(token)
+            elif kind == 'url':
+                token = self._serialize_url(token)
+            elif kind == 'urange':
+                # Unicode range of @font-face, which isn't a number
+                token = token.lower()
+
+            out.append(token)
+            out.append(' ')
+
+        if functions or (in_priority and not priority):
+            return None, None
+
+        return ''.join(out).strip(), priority
+
+    @staticmethod
+    def _serialize_number(number, unit):
+        unit = unit.lower()
+        value = float(number)
+
+        if value == 0:
+            return '0' + ('' if unit in ZERO_DROPPED_UNITS else unit)
+
+        if value == int(value):
+            serialized = str(int(value))
+        else:
+            serialized = '%f' % value
+            i = serialized.index('.') + 2
+            serialized = serialized[:i] + serialized[i:].rstrip('0')
+
+        # cssutils keeps an explicit plus sign
+        if number.startswith('+'):
+            serialized = '+' + serialized
+
+        return serialized + unit
+
+    @staticmethod
+    def _unquote(string):
+        quote = string[0]
+        return string[1:-1].replace('\\' + quote, quote)
+
+    @classmethod
+    def _serialize_string(cls, string):
+        value = cls._unquote(string)
+        value = value.replace('\n', '\\a ').replace('\r', '\\d ').replace('\f', '\\c ').replace('"', '\\"')
+        if value.endswith('\\'):
+            value = value[:-1] + '\\\\'
+
+        return '"%s"' % value
+
+    @classmethod
+    def _serialize_url(cls, token):
+        url = token[token.index('(') + 1:-1].strip()
+        if url and url[0] in '"\'' and url[0] == url[-1]:
+            url = cls._unquote(url)
+
+        if re.search(r'''[()\s;,'"]''', url):
+            url = cls._serialize_string('"%s"' % url.replace('"', '\\"'))
+
+        return 'url(%s)' % url
+
+PARSERS = {
+    'cssutils' : CssutilsParser,
+    'builtin' : BuiltinParser,
+}
+
+class ExtractionRule(object):
+    """
+    Search regex of EXTRACT_VARIABLES, with templates expanded and compiled, and the variable name to extract.
+    """
+
+    def __init__(self, search_regex, variable_name, regex):
+        self.search_regex = search_regex
+        self.variable_name = variable_name
+        self.regex = regex
+
+        # Only these groups need to be checked for the variable value
+        self.group_names = tuple(group_name
+                                 for group_name in VARIABLE_VALUE_GROUP_NAMES
+                                 if group_name in regex.groupindex)
+
+class ValueSubstitution(object):
+    """
+    Substitutes variable names for parts of a property value. Every search runs against the original value, with
+    the parts that were already substituted masked by underscores so that they can't be matched again. The
+    substituted spans are kept sorted, so each new span only needs to be checked for overlaps against its two
+    neighbors, and the rewritten value is built with a single join at the end.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self._masked_value = value
+
+        # Sorted, non-overlapping (start, end, replacement) tuples of positions in the original value
+        self._spans = []
+
+    def search(self, regex):
+        return regex.search(self._masked_value)
+
+    def substitute(self, start, end, replacement):
+        i = bisect.bisect(self._spans, (start,))
+
+        for span_start, span_end, unused_replacement in self._spans[max(0, i - 1):i + 1]:
+            if Css2Stylus.overlaps((start, end), (span_start, span_end)):
+                raise AssertionError('Regex search overlaps with inserted variable')
+
+        self._spans.insert(i, (start, end, replacement))
+        self._masked_value = self._masked_value[:start] + (end - start) * '_' + self._masked_value[end:]
+
+    def get_value(self):
+        if not self._spans:
+            return self.value
+
+        parts = []
+        position = 0
+        for start, end, replacement in self._spans:
+            parts.append(self.value[position:start])
+            parts.append(replacement)
+            position = end
+        parts.append(self.value[position:])
+
+        return ''.join(parts)
+
+class ExtractionRuleCompiler(object):
+    """
+    Creates ExtractionRule objects, compiling each distinct search regex only once.
+    """
+
+    def __init__(self, expanded_regexes=None):
+        # Search regex (with templates) => compiled regex
+        self._compiled_regexes = {}
+
+        # Search regex (with templates) => search regex with expanded templates, given for compiled rules files
+        self._expanded_regexes = expanded_regexes or {}
+
+    @property
+    def num_compilations(self):
+        return len(self._compiled_regexes)
+
+    def compile_mapping(self, mapping):
+        """
+        Compiles a property mapping of EXTRACT_VARIABLES ({property name: [(search regex, variable name), ...]}).
+        """
+        return dict((property_name, [self.compile_rule(search_regex, variable_name)
+                                     for search_regex, variable_name in extraction_infos])
+                    for property_name, extraction_infos in mapping.items())
+
+    def compile_rule(self, search_regex, variable_name):
+        regex = self._compiled_regexes.get(search_regex)
+
+        if regex is None:
+            expanded_search_regex = self._expanded_regexes.get(search_regex)
+            if expanded_search_regex is None:
+                expanded_search_regex = search_regex
+                for template, replacement in SEARCH_REGEX_TEMPLATES:
+                    expanded_search_regex = expanded_search_regex.replace(template, replacement)
+
+            regex = re.compile(expanded_search_regex)
+            self._compiled_regexes[search_regex] = regex
+
+        return ExtractionRule(search_regex, variable_name, regex)
+
+    def get_expanded_regexes(self):
+        """
+        Returns a dictionary search regex (with templates) => search regex with expanded templates of all compiled
+        rules.
+        """
+        return dict((search_regex, regex.pattern) for search_regex, regex in self._compiled_regexes.items())
+
+class SelectorIndex(object):
+    """
+    Finds the EXTRACT_VARIABLES entry for a selector. The selector regexes are sorted once into exact keys, buckets
+    keyed by a literal part that any matching selector must contain at a fixed position, and the remaining "real"
+    regexes. A lookup then only tries the few regexes that can possibly match. The result is the same as trying every
+    regex in iteration order of the EXTRACT_VARIABLES dictionary (first match wins).
+    """
+
+    def __init__(self, variables_to_extract, anchors=None):
+        """
+        @param anchors:
+            Results of _literal_anchor for the selector regexes in iteration order, as returned by get_anchors. Only
+            given for compiled rules files.
+        """
+        self._selector_match_regexes = set(variables_to_extract)
+
+        # Result of _literal_anchor for each selector regex
+        self._anchors = []
+
+        # (offset, length) => {literal => [(position, full match regex, selector_match_regex), ...]}
+        self._buckets = {}
+
+        # [(position, full match regex, selector_match_regex), ...] for regexes without a usable literal part
+        self._regexes = []
+
+        # Full match regex => compiled regex. Compiled on first use, most regexes of big vars modules are never tried.
+        self._compiled_regexes = {}
+
+        for position, selector_match_regex in enumerate(variables_to_extract):
+            # Force full matching
+            full_match_regex = selector_match_regex
+            if not full_match_regex.endswith('$'):
+                full_match_regex += '$'
+
+            entry = (position, full_match_regex, selector_match_regex)
+
+            anchor = self._literal_anchor(selector_match_regex) if anchors is None else anchors[position]
+            self._anchors.append(anchor)
+
+            if anchor is None:
+                self._regexes.append(entry)
+            else:
+                offset, literal = anchor
+                self._buckets.setdefault((offset, len(literal)), {}).setdefault(literal, []).append(entry)
+
+    def find(self, selector, pattern_stats=None):
+        """
+        Returns the first selector regex (key of EXTRACT_VARIABLES) that matches, or None if there is no match.
+
+        @param pattern_stats:
+            Dictionary selector regex => [match attempts, hits] to count in (see ConversionStats).
+        """
+        if selector in self._selector_match_regexes:
+            if pattern_stats is not None:
+                counts = pattern_stats.setdefault(selector, [0, 0])
+                counts[0] += 1
+                counts[1] += 1
+
+            return selector
+
+        candidates = list(self._regexes)
+        for (offset, length), bucket in self._buckets.items():
+            candidates.extend(bucket.get(selector[offset:offset + length], ()))
+
+        candidates.sort(key=lambda entry: entry[0])
+
+        for unused_position, full_match_regex, selector_match_regex in candidates:
+            regex = self._compiled_regexes.get(full_match_regex)
+            if regex is None:
+                regex = self._compiled_regexes[full_match_regex] = re.compile(full_match_regex)
+
+            match = regex.match(selector)
+
+            if pattern_stats is not None:
+                counts = pattern_stats.setdefault(selector_match_regex, [0, 0])
+                counts[0] += 1
+                counts[1] += bool(match)
+
+            if match:
+                return selector_match_regex
+
+        return None
+
+    def get_anchors(self):
+        return list(self._anchors)
+
+    @staticmethod
+    def _literal_anchor(regex):
+        """
+        Returns (offset, literal) so that every string matched by the regex has that literal at that offset, or None if
+        the regex doesn't start with such a fixed-width part.
+
+        For example '.ui-bar-a .ui-link(:.*)?' gives (1, 'ui-bar-a ') because the first '.' matches any character.
+        """
+        # Top-level alternatives and inline flags (e.g. case-insensitive matching) make any prefix meaningless
+        depth = 0
+        in_class = False
+        i = 0
+        while i < len(regex):
+            c = regex[i]
+            if c == '\\':
+                i += 1
+            elif in_class:
+                if c == ']':
+                    in_class = False
+            elif c == '[':
+                in_class = True
+            elif c == '(':
+                if regex[i + 1:i + 2] == '?' and regex[i + 2:i + 3] in tuple('iLmsux'):
+                    return None
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == '|' and depth == 0:
+                return None
+            i += 1
+
+        # List of single characters (None for a '.' wildcard) at the start of the regex
+        atoms = []
+        i = 1 if regex.startswith('^') else 0
+        while i < len(regex):
+            c = regex[i]
+            if c in '*+?{':
+                # The previous atom is optional or repeated
+                if atoms:
+                    atoms.pop()
+                break
+            elif c == '.':
+                atoms.append(None)
+            elif c == '\\':
+                escaped = regex[i + 1:i + 2]
+                if not escaped or escaped.isalnum():
+                    # Character classes like \d, anchors like \b or back references
+                    break
+                atoms.append(escaped)
+                i += 1
+            elif c in '^$[]()|':
+                break
+            else:
+                atoms.append(c)
+            i += 1
+
+        # Use the first run of literal characters
+        offset = 0
+        while offset < len(atoms) and atoms[offset] is None:
+            offset += 1
+
+        literal = []
+        for atom in atoms[offset:]:
+            if atom is None:
+                break
+            literal.append(atom)
+
+        if not literal:
+            return None
+
+        return offset, ''.join(literal)
+
+class ExtractionRules(object):
+    """
+    Merged EXTRACT_VARIABLES of the vars modules, together with the selector index and the compiled extraction rules.
+    Loading and compiling only needs to be done once for any number of conversions.
+    """
+
+    def __init__(self, variables_to_extract, shorthands=NIB_SHORTHANDS, vendor_prefixes=VENDOR_PREFIXES,
+                 selector_anchors=None, expanded_regexes=None):
+        """
+        @param selector_anchors:
+        @param expanded_regexes:
+            Precomputed by a compiled rules file, see SelectorIndex.get_anchors and
+            ExtractionRuleCompiler.get_expanded_regexes.
+        """
+        self.variables_to_extract = variables_to_extract
+        self.selector_index = SelectorIndex(variables_to_extract, selector_anchors)
+
+        self.shorthands = shorthands
+        self.vendor_prefixes = vendor_prefixes
+
+        # (name, filename, definitions) tuples of the vars modules and rule files, see _load_rule_sources, and the
+        # compiled rules file they were loaded from (if any)
+        self.sources = []
+        self.compiled_filename = None
+
+        # Property name => Stylus function, and the set of those functions
+        self.shorthand_index = build_shorthand_index(shorthands, vendor_prefixes)
+        self.stylus_functions = frozenset(self.shorthand_index.values())
+
+        # Same as variables_to_extract, but with compiled ExtractionRule objects instead of (search regex, variable
+        # name) tuples
+        self.compiler = ExtractionRuleCompiler(expanded_regexes)
+        self.compiled_variables_to_extract = dict((selector_match_regex, self.compiler.compile_mapping(mapping))
+                                                  for selector_match_regex, mapping in variables_to_extract.items())
+
+        # ExtractionRule => (selector regex, property name, index), which unlike the ExtractionRule objects is the same
+        # in other processes (see ConversionStats.get_pattern_counts)
+        self.extraction_rule_keys = {}
+        for selector_match_regex, mapping in self.compiled_variables_to_extract.items():
+            for property_name, compiled_rules in mapping.items():
+                for i, extraction_rule in enumerate(compiled_rules):
+                    self.extraction_rule_keys[extraction_rule] = (selector_match_regex, property_name, i)
+
+    def get_fingerprint(self):
+        """
+        Returns a hash of the rules. The order of the selector regexes matters because the first matching one wins.
+        """
+        return hashlib.sha1(repr(([(selector_match_regex,
+                                    sorted((property_name, tuple(map(tuple, extraction_infos)))
+                                           for property_name, extraction_infos in mapping.items()))
+                                   for selector_match_regex, mapping in self.variables_to_extract.items()],
+                                  sorted(self.shorthand_index.items())))).hexdigest()
+
+    def get_source_filenames(self):
+        """
+        Returns the files the rules were loaded from, to load them again when one of them changes.
+        """
+        filenames = [filename for unused_name, filename, unused_definitions in self.sources]
+        if self.compiled_filename is not None:
+            filenames.append(self.compiled_filename)
+        return filenames
+
+    @classmethod
+    def from_modules(cls, vars_modules):
+        """
+        Loads and merges EXTRACT_VARIABLES of the vars modules, and the optional NIB_SHORTHANDS (property name =>
+        Stylus function) and VENDOR_PREFIXES that extend the module-level defaults. Instead of module names, JSON rule
+        files with the same keys can be given (see load_rule_file). A single compiled rules file (see compile) is
+        loaded without importing anything, unless one of its sources changed.
+        """
+        if vars_modules and len(vars_modules) == 1 and vars_modules[0].endswith(RULE_FILE_EXTENSION):
+            definitions = load_rule_file(vars_modules[0])
+
+            if 'compiled' in definitions:
+                return cls.from_compiled(vars_modules[0], definitions)
+
+        return cls._from_sources(_load_rule_sources(vars_modules))
+
+    @classmethod
+    def _from_sources(cls, sources, validate=False):
+        """
+        @param sources:
+            List of (name, filename, definitions dictionary) tuples, see _load_rule_sources
+        @param validate:
+            Raise ValueError for invalid regexes and variable names (see validate_variables_to_extract)
+        """
+        variables_to_extract = {}
+        shorthands = dict(NIB_SHORTHANDS)
+        vendor_prefixes = list(VENDOR_PREFIXES)
+
+        if not sources:
+            print('WARNING: Not extracting variables, use the --vars-module parameter to do so', file=sys.stderr)
+
+        for unused_name, unused_filename, definitions in sources:
+            # Merge dictionary (cannot use dict.update because that does a simple key replacement, we have a
+            # nested dictionary)
+            for selector_match_regex, mapping in definitions['EXTRACT_VARIABLES'].items():
+                if selector_match_regex in variables_to_extract:
+                    merged_mapping = variables_to_extract[selector_match_regex]
+                    for property_name, extraction_infos in mapping.items():
+                        if property_name in merged_mapping:
+                            merged_mapping[property_name] = (tuple(merged_mapping[property_name]) +
+                                                             tuple(extraction_infos))
+                        else:
+                            merged_mapping[property_name] = extraction_infos
+                else:
+                    # Copy, merging must not change the dictionary of the module
+                    variables_to_extract[selector_match_regex] = dict(mapping)
+
+            shorthands.update(definitions.get('NIB_SHORTHANDS', {}))
+            vendor_prefixes.extend(prefix
+                                   for prefix in definitions.get('VENDOR_PREFIXES', ())
+                                   if prefix not in vendor_prefixes)
+
+        if validate:
+            validate_variables_to_extract(variables_to_extract)
+
+        extraction_rules = cls(variables_to_extract, shorthands, vendor_prefixes)
+        extraction_rules.sources = sources
+        return extraction_rules
+
+    @classmethod
+    def compile(cls, vars_modules, out_filename):
+        """
+        Merges the vars modules and rule files into a single JSON file that also contains everything the conversion
+        would otherwise compute when loading them: the expanded search regexes and the literal parts of the selector
+        regexes (see SelectorIndex). All regexes are validated. The file records the state of its sources, and is
+        compiled again automatically when loaded after a source changed. Returns the ExtractionRules.
+        """
+        extraction_rules = cls._from_sources(_load_rule_sources(vars_modules), validate=True)
+        extraction_rules.save_compiled(out_filename)
+
+        return extraction_rules
+
+    def save_compiled(self, out_filename):
+        import collections
+        import json
+
+        sources = [{'name' : name, 'filename' : os.path.abspath(filename), 'state' : _get_file_state(filename)}
+                   for name, filename, unused_definitions in self.sources]
+
+        # Ordered like the dictionaries, the first matching selector regex wins
+        compiled = collections.OrderedDict([
+            ('EXTRACT_VARIABLES', collections.OrderedDict(
+                (selector_match_regex, collections.OrderedDict(
+                    (property_name, [list(extraction_info) for extraction_info in extraction_infos])
+                    for property_name, extraction_infos in mapping.items()))
+                for selector_match_regex, mapping in self.variables_to_extract.items())),
+            ('NIB_SHORTHANDS', self.shorthands),
+            ('VENDOR_PREFIXES', list(self.vendor_prefixes)),
+            ('compiled', {'format' : COMPILED_RULES_FORMAT,
+                          'sources' : sources,
+                          'selector_anchors' : self.selector_index.get_anchors(),
+                          'expanded_regexes' : self.compiler.get_expanded_regexes()})])
+
+        with open(out_filename + '.tmp', 'wb') as f:
+            f.write(json.dumps(compiled, indent=1))
+            f.write('\n')
+
+        _replace_file(out_filename + '.tmp', out_filename)
+
+    @classmethod
+    def from_compiled(cls, filename, definitions):
+        """
+        Returns the rules of a compiled rules file (see compile). If it's outdated, it's compiled again from its
+        sources and saved.
+        """
+        compiled = definitions['compiled']
+
+        def is_changed(source):
+            # Sources that don't exist anymore (e.g. the compiled file was copied to another machine) are ignored
+            state = _get_file_state(source['filename'])
+            return state is not None and state != tuple(source['state'] or ())
+
+        if compiled.get('format') != COMPILED_RULES_FORMAT or any(is_changed(source) for source in compiled['sources']):
+            print('Compiled rules file %s is outdated, compiling it again' % filename, file=sys.stderr)
+
+            sources = _load_rule_sources([source['name'] for source in compiled['sources']],
+                                         [source['filename'] for source in compiled['sources']])
+            extraction_rules = cls._from_sources(sources, validate=True)
+            extraction_rules.save_compiled(filename)
+        else:
+            extraction_rules = cls(definitions['EXTRACT_VARIABLES'],
+                                   definitions['NIB_SHORTHANDS'],
+                                   definitions['VENDOR_PREFIXES'],
+                                   selector_anchors=compiled['selector_anchors'],
+                                   expanded_regexes=compiled['expanded_regexes'])
+            extraction_rules.sources = [(source['name'], source['filename'], None) for source in compiled['sources']]
+
+        extraction_rules.compiled_filename = filename
+        return extraction_rules
+
+def validate_variables_to_extract(variables_to_extract):
+    """
+    Compiles all regexes of EXTRACT_VARIABLES and raises ValueError for invalid ones, instead of failing in the middle
+    of a conversion.
+    """
+    compiler = ExtractionRuleCompiler()
+
+    for selector_match_regex, mapping in variables_to_extract.items():
+        try:
+            re.compile(selector_match_regex)
+        except re.error as e:
+            raise ValueError('Invalid selector regex %r: %s' % (selector_match_regex, e))
+
+        for property_name, extraction_infos in mapping.items():
+            for extraction_info in extraction_infos:
+                if len(extraction_info) != 2:
+                    raise ValueError('Expected (search regex, variable name) for property %s of %r, got %r'
+                                     % (property_name, selector_match_regex, extraction_info))
+
+                search_regex, variable_name = extraction_info
+
+                if not isinstance(variable_name, basestring) or not variable_name:
+                    raise ValueError('Invalid variable name %r for property %s of %r'
+                                     % (variable_name, property_name, selector_match_regex))
+
+                try:
+                    extraction_rule = compiler.compile_rule(search_regex, variable_name)
+                except re.error as e:
+                    raise ValueError('Invalid search regex %r of variable %s: %s' % (search_regex, variable_name, e))
+
+                if not extraction_rule.group_names:
+                    raise ValueError('Search regex %r of variable %s has no %s group'
+                                     % (search_regex, variable_name, ' or '.join(VARIABLE_VALUE_GROUP_NAMES)))
+
+# Vars modules with this extension are JSON rule files, see load_rule_file
+RULE_FILE_EXTENSION = '.json'
+
+# Version of the compiled rules file format, files of other versions are compiled again
+COMPILED_RULES_FORMAT = 1
+
+def _to_str(value):
+    """
+    Converts the unicode strings of loaded JSON to str, like the strings of vars modules. Objects are already converted
+    by _json_object_pairs.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_to_str(item) for item in value]
+
+    return value
+
+def _json_object_pairs(pairs):
+    import collections
+
+    return collections.OrderedDict((key.encode('utf-8'), _to_str(value)) for key, value in pairs)
+
+def load_rule_file(filename):
+    """
+    Loads a JSON rule file, the declarative form of a vars module:
+
+        {"EXTRACT_VARIABLES": {"selector regex": {"property": [["search regex", "variable name"], ...]}, ...},
+         "NIB_SHORTHANDS": {"property": "Stylus function", ...},
+         "VENDOR_PREFIXES": ["-khtml-", ...]}
+
+    Only EXTRACT_VARIABLES is required. Objects are loaded as OrderedDicts, because the selector regexes of compiled
+    rules files are in the order in which they are tried.
+    """
+    import json
+
+    with open(filename, 'rb') as f:
+        try:
+            definitions = json.loads(f.read(), object_pairs_hook=_json_object_pairs)
+        except ValueError as e:
+            raise ValueError('Invalid rule file %s: %s' % (filename, e))
+
+    if not isinstance(definitions, dict) or not isinstance(definitions.get('EXTRACT_VARIABLES'), dict):
+        raise ValueError('Rule file %s has no EXTRACT_VARIABLES object' % filename)
+
+    return definitions
+
+def _load_rule_sources(vars_modules, filenames=None):
+    """
+    Imports the vars modules and loads the JSON rule files. Returns a list of (name, filename, definitions) tuples,
+    where definitions is a dictionary with EXTRACT_VARIABLES and the optional NIB_SHORTHANDS and VENDOR_PREFIXES.
+
+    @param filenames:
+        Filenames of the modules, to load them again from the same files instead of importing them by name.
+    """
+    import imp
+
+    sources = []
+
+    if not vars_modules:
+        return sources
+
+    if len(set(vars_modules)) != len(vars_modules):
+        raise AssertionError('Duplicate variables module')
+
+    script_dir = os.path.abspath(os.path.dirname(__file__))
+    cwd = os.getcwd()
+    sys.path.insert(0, cwd)
+    sys.path.insert(1, script_dir)
+    try:
+        for i, vars_module in enumerate(vars_modules):
+            if vars_module.endswith(RULE_FILE_EXTENSION):
+                filename = filenames[i] if filenames else vars_module
+                sources.append((vars_module, filename, load_rule_file(filename)))
+                continue
+
+            if filenames:
+                module = imp.load_source(vars_module, filenames[i])
+            else:
+                module = __import__(vars_module)
+
+            definitions = {'EXTRACT_VARIABLES' : module.EXTRACT_VARIABLES}
+            for name in ('NIB_SHORTHANDS', 'VENDOR_PREFIXES'):
+                if hasattr(module, name):
+                    definitions[name] = getattr(module, name)
+
+            sources.append((vars_module, os.path.splitext(module.__file__)[0] + '.py', definitions))
+    finally:
+        sys.path = sys.path[2:]
+
+    return sources
+
+@contextlib.contextmanager
+def captured_output():
+    """
+    Captures everything printed to stdout and stderr (including cssutils log messages) into two StringIO objects.
+    """
+    stdout = StringIO()
+    stderr = StringIO()
+
+    with redirected_cssutils_log(stderr):
+        original_streams = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+
+        try:
+            yield stdout, stderr
+        finally:
+            sys.stdout, sys.stderr = original_streams
+
+@contextlib.contextmanager
+def redirected_cssutils_log(stream):
+    """
+    Writes the cssutils log messages (normally printed to stderr) to the given file-like object.
+    """
+    global _cssutils_log_stream
+
+    original_stream = _cssutils_log_stream
+    _cssutils_log_stream = stream
+
+    try:
+        yield
+    finally:
+        _cssutils_log_stream = original_stream
+
+class _LineCollector(object):
+    """
+    File-like object that appends every written line (without line break) to a list.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self._partial_line = ''
+
+    def write(self, text):
+        lines = (self._partial_line + text).split('\n')
+        self._partial_line = lines.pop()
+        self.lines.extend(lines)
+
+    def flush(self):
+        pass
+
+class ConversionCache(object):
+    """
+    On-disk cache of convert results, keyed by a hash of everything the output depends on: the input CSS, the
+    EXTRACT_VARIABLES rules, the conversion options and the version of this tool. Each entry is a directory with the
+    rules and vars output files and the printed report. Least recently used entries are evicted when the cache grows
+    beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def get_key(self, filename, extraction_rules, options):
+        digest = hashlib.sha1()
+        digest.update(_get_tool_version_hash())
+        digest.update(repr(sorted(options.items())))
+        digest.update(extraction_rules.get_fingerprint())
+
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(STREAMING_CHUNK_SIZE), ''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def restore(self, key, out_filename, vars_out_filename):
+        """
+        Copies the cached output files and returns the report (dictionary with 'stdout' and 'stderr'), or returns
+        None if there is no such cache entry.
+        """
+        import json
+        import shutil
+
+        entry_dir = os.path.join(self.cache_dir, key)
+
+        try:
+            with open(os.path.join(entry_dir, 'report.json'), 'rb') as f:
+                report = json.load(f)
+
+            shutil.copyfile(os.path.join(entry_dir, 'rules.styl'), out_filename)
+            shutil.copyfile(os.path.join(entry_dir, 'vars.styl'), vars_out_filename)
+        except (IOError, OSError, ValueError):
+            # Missing entry, or evicted by another process meanwhile
+            return None
+
+        # Mark as recently used
+        os.utime(entry_dir, None)
+
+        return report
+
+    def store(self, key, out_filename, vars_out_filename, report):
+        import json
+        import shutil
+        import tempfile
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Write to a temporary directory first, so that other processes never see incomplete entries
+        temp_dir = tempfile.mkdtemp(prefix='.tmp', dir=self.cache_dir)
+        try:
+            shutil.copyfile(out_filename, os.path.join(temp_dir, 'rules.styl'))
+            shutil.copyfile(vars_out_filename, os.path.join(temp_dir, 'vars.styl'))
+            with open(os.path.join(temp_dir, 'report.json'), 'wb') as f:
+                json.dump(report, f)
+
+            os.rename(temp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # Already stored by another process
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self._evict()
+
+    def _evict(self):
+        import shutil
+
+        entries = []
+        total_size = 0
+
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('.tmp') or not os.path.isdir(entry_dir):
+                continue
+
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, filename)) for filename in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except OSError:
+                continue
+
+            total_size += size
+
+        # Oldest first
+        entries.sort()
+
+        for unused_mtime, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+# Cached result of _get_tool_version_hash
+_tool_version_hash = None
+
+def _get_tool_version_hash():
+    """
+    Returns a hash of the version and source code of this tool, so that cached results are invalidated by changes.
+    """
+    global _tool_version_hash
+
+    if _tool_version_hash is None:
+        with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'rb') as f:
+            _tool_version_hash = hashlib.sha1(__version__ + f.read()).hexdigest()
+
+    return _tool_version_hash
+
+class RuleIndex(object):
+    """
+    Fingerprint index of converted style rules, stored next to the output files for incremental reconversion. Maps
+    a hash of each rule's selector list and properties to its conversion result (Stylus property lines, extracted
+    variables, number of regex searches and pattern counts for --stats), which only depends on the rule and the
+    extraction rules. On the next conversion, unchanged rules are taken from the index instead of running the
+    extraction regexes again. The stylesheet is still parsed and the whole tree is built and written as usual. Removed
+    rules are dropped from the index when it is saved.
+    """
+
+    def __init__(self, filename, extraction_rules, with_pattern_counts=False):
+        """
+        @param with_pattern_counts:
+            Statistics are collected, entries of conversions without them can't be reused
+        """
+        import json
+
+        self.filename = filename
+        self.num_reused = 0
+        self.num_converted = 0
+
+        # Results of a previous conversion are only valid for the same extraction rules and tool version
+        self._header = hashlib.sha1(_get_tool_version_hash() + extraction_rules.get_fingerprint()).hexdigest()
+
+        # Rule fingerprint => [property lines, [(variable name, variable value), ...], number of searches, pattern
+        # counts (see ConversionStats.get_pattern_counts) or None]
+        self._old_entries = {}
+        self._entries = {}
+
+        try:
+            with open(filename, 'rb') as f:
+                index = json.load(f)
+
+            if index['header'] == self._header:
+                self._old_entries = index['rules']
+
+                if with_pattern_counts:
+                    self._old_entries = dict((fingerprint, entry) for fingerprint, entry in self._old_entries.items()
+                                             if entry[3] is not None)
+        except (IOError, ValueError, KeyError, TypeError):
+            # No previous index or unreadable, convert everything
+            pass
+
+    @staticmethod
+    def get_rule_fingerprint(rule):
+        import json
+
+        return hashlib.sha1(json.dumps([rule['selector_list'], rule['properties']])).hexdigest()
+
+    def get(self, fingerprint):
+        """
+        Returns the conversion result of an unchanged rule, or None.
+        """
+        entry = self._entries.get(fingerprint)
+
+        if entry is None:
+            entry = self._old_entries.get(fingerprint)
+            if entry is None:
+                return None
+
+            self._entries[fingerprint] = entry
+
+        self.num_reused += 1
+        return entry
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._entries or fingerprint in self._old_entries
+
+    def add(self, fingerprint, entry):
+        self.num_converted += 1
+        self._entries[fingerprint] = entry
+
+    def save(self):
+        import json
+
+        if not self.num_converted and len(self._entries) == len(self._old_entries):
+            # Same rules as before
+            return
+
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            # json.dumps is much faster than json.dump, which doesn't use the C encoder
+            f.write(json.dumps({'header' : self._header, 'rules' : self._entries}))
+
+        # Atomic replacement, an interrupted conversion leaves the previous index intact
+        _replace_file(temp_filename, self.filename)
+
+def _replace_file(src_filename, dst_filename):
+    """
+    Renames a file, replacing an existing destination file (atomic except on Windows, where rename can't replace).
+    """
+    if os.name == 'nt' and os.path.exists(dst_filename):
+        os.remove(dst_filename)
+
+    os.rename(src_filename, dst_filename)
+
+class OutputEmitter(object):
+    """
+    Collects the lines of an output file in memory and writes them with a single write when closed. Lines are
+    indented by `indent` levels of two spaces. Use as context manager:
+
+        with OutputEmitter(filename) as emitter:
+            emitter.write_line('body')
+            emitter.indent += 1
+            emitter.write_line('color: red')
+
+    With filename None, nothing is written and getvalue returns the text instead.
+
+    @param atomic:
+        Write to a temporary file that is renamed to the output filename when closed, so that other programs (e.g. a
+        Stylus watcher) never see partial output, and the previous output stays intact if the conversion fails.
+    @param max_buffered_lines:
+        Write the collected lines whenever there are that many, instead of only once when closed. Keeps memory usage
+        constant for big outputs.
+    """
+
+    def __init__(self, filename, atomic=False, max_buffered_lines=None):
+        self.filename = filename
+        self.atomic = atomic
+        self.max_buffered_lines = max_buffered_lines
+        self.indent = 0
+
+        self._lines = []
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None and self.atomic:
+            self.discard()
+        else:
+            # Without atomic writing, a failed conversion leaves the output written so far (like writing line by line)
+            self.close()
+
+    def write_line(self, line=''):
+        if self.indent:
+            line = '  ' * self.indent + line
+
+        self._lines.append(line)
+
+        if self.max_buffered_lines is not None and len(self._lines) >= self.max_buffered_lines:
+            self.flush()
+
+    def write_lines(self, lines):
+        if self.indent:
+            indent = '  ' * self.indent
+            self._lines.extend([indent + line for line in lines])
+        else:
+            self._lines.extend(lines)
+
+        if self.max_buffered_lines is not None and len(self._lines) >= self.max_buffered_lines:
+            self.flush()
+
+    def getvalue(self):
+        """
+        Returns the text of an in-memory emitter.
+        """
+        assert self.filename is None
+        return '\n'.join(self._lines + ['']) if self._lines else ''
+
+    def flush(self):
+        if self.filename is None:
+            return
+
+        if self._file is None:
+            self._file = open(self.filename + '.tmp' if self.atomic else self.filename, 'wb')
+
+        if self._lines:
+            self._lines.append('')
+            self._file.write('\n'.join(self._lines))
+            self._lines = []
+
+    def close(self):
+        if self.filename is None:
+            return
+
+        self.flush()
+        self._file.close()
+
+        if self.atomic:
+            _replace_file(self.filename + '.tmp', self.filename)
+
+    def discard(self):
+        self._lines = []
+
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._file.name)
+
+def _get_peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in megabytes, or None if unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Bytes on Mac OS X, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak_rss / 1024.0 / 1024
+    return peak_rss / 1024.0
+
+@contextlib.contextmanager
+def _no_stats_stage(unused_name):
+    yield
+
+class ConversionStats(object):
+    """
+    Profiling report of a conversion (see the --stats option). Collects per stage the wall time, the net change in
+    the number of objects tracked by the garbage collector (Python 2 has no allocation tracing) and the peak RSS
+    afterwards. Also counts match attempts and hits of every EXTRACT_VARIABLES selector regex and property search
+    regex, and the number of tree nodes and maximum depth.
+    """
+
+    def __init__(self):
+        # [(stage name, seconds, new objects, peak RSS in MB), ...]
+        self.stages = []
+
+        # Selector regex => [match attempts, hits]
+        self.selector_patterns = {}
+
+        # ExtractionRule => [searches, matches]
+        self.property_patterns = {}
+
+        self.num_tree_nodes = 0
+        self.max_tree_depth = 0
+
+        # None if no cache was used
+        self.cache_hit = None
+
+        # Set by the conversion, needed to report all patterns (also those that were never tried)
+        self.extraction_rules = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        import gc
+        import time
+
+        num_objects = len(gc.get_objects())
+        start_time = time.time()
+
+        yield
+
+        seconds = time.time() - start_time
+        self.stages.append((name, seconds, len(gc.get_objects()) - num_objects, _get_peak_rss_mb()))
+
+    def add_tree(self, tree):
+        for depth, unused_node in tree.walk():
+            self.num_tree_nodes += 1
+            self.max_tree_depth = max(self.max_tree_depth, depth + 1)
+
+    def count_search(self, extraction_rule, matched):
+        counts = self.property_patterns.setdefault(extraction_rule, [0, 0])
+        counts[0] += 1
+        counts[1] += bool(matched)
+
+    def get_pattern_counts(self):
+        """
+        Returns the pattern statistics in a form that can be sent to another process or stored as JSON, and added to
+        other statistics with add_pattern_counts (see ParallelRuleConverter and RuleIndex).
+        """
+        extraction_rule_keys = self.extraction_rules.extraction_rule_keys
+
+        return (self.selector_patterns,
+                [extraction_rule_keys[extraction_rule] + tuple(counts)
+                 for extraction_rule, counts in self.property_patterns.items()])
+
+    def add_pattern_counts(self, pattern_counts):
+        selector_patterns, property_patterns = pattern_counts
+
+        for selector_match_regex, (attempts, hits) in selector_patterns.items():
+            counts = self.selector_patterns.setdefault(selector_match_regex, [0, 0])
+            counts[0] += attempts
+            counts[1] += hits
+
+        compiled_variables_to_extract = self.extraction_rules.compiled_variables_to_extract
+
+        for selector_match_regex, property_name, i, searches, matches in property_patterns:
+            extraction_rule = compiled_variables_to_extract[selector_match_regex][property_name][i]
+            counts = self.property_patterns.setdefault(extraction_rule, [0, 0])
+            counts[0] += searches
+            counts[1] += matches
+
+    def to_dict(self):
+        """
+        Returns the report as JSON-serializable dictionary.
+        """
+        report = {'stages' : [{'name' : name, 'seconds' : seconds, 'new_objects' : new_objects, 'peak_rss_mb' : peak_rss}
+                              for name, seconds, new_objects, peak_rss in self.stages],
+                  'cache_hit' : self.cache_hit}
+
+        if self.extraction_rules is None:
+            # No conversion (merge mode)
+            return report
+
+        extraction_rules = self.extraction_rules
+        property_patterns = []
+
+        for selector_match_regex, mapping in sorted(extraction_rules.compiled_variables_to_extract.items()):
+            for property_name, compiled_rules in sorted(mapping.items()):
+                for extraction_rule in compiled_rules:
+                    searches, matches = self.property_patterns.get(extraction_rule, (0, 0))
+                    property_patterns.append({'selector_regex' : selector_match_regex,
+                                              'property' : property_name,
+                                              'search_regex' : extraction_rule.search_regex,
+                                              'variable' : extraction_rule.variable_name,
+                                              'searches' : searches,
+                                              'matches' : matches})
+
+        report['selector_patterns'] = [{'selector_regex' : selector_match_regex,
+                                        'attempts' : self.selector_patterns.get(selector_match_regex, (0, 0))[0],
+                                        'hits' : self.selector_patterns.get(selector_match_regex, (0, 0))[1]}
+                                       for selector_match_regex in sorted(extraction_rules.variables_to_extract)]
+        report['property_patterns'] = property_patterns
+        report['tree'] = {'nodes' : self.num_tree_nodes, 'max_depth' : self.max_tree_depth}
+
+        return report
+
+    @staticmethod
+    def format_report(report, max_never_matched=10):
+        """
+        Returns the text of a report from to_dict. Only the first max_never_matched patterns that never matched are
+        listed (the JSON report has all of them).
+        """
+        lines = ['Stats:',
+                 '  %-14s %10s %12s %10s' % ('stage', 'seconds', 'new objects', 'peak RSS')]
+
+        for stage in report['stages']:
+            lines.append('  %-14s %10.4f %+12d %10s' % (stage['name'],
+                                                         stage['seconds'],
+                                                         stage['new_objects'],
+                                                         '%.1f MB' % stage['peak_rss_mb']
+                                                         if stage['peak_rss_mb'] is not None else '-'))
+
+        if report['cache_hit'] is not None:
+            lines.append('  Cache %s' % ('hit' if report['cache_hit'] else 'miss'))
+
+        if 'tree' not in report or report['cache_hit']:
+            return '\n'.join(lines)
+
+        lines.append('  Tree: %d nodes, maximum depth %d' % (report['tree']['nodes'], report['tree']['max_depth']))
+
+        for kind, patterns, attempts_key, hits_key in (
+                ('Selector patterns', report['selector_patterns'], 'attempts', 'hits'),
+                ('Property patterns', report['property_patterns'], 'searches', 'matches')):
+            lines.append('  %s: %d, %d attempts, %d hits' % (kind,
+                                                             len(patterns),
+                                                             sum(pattern[attempts_key] for pattern in patterns),
+                                                             sum(pattern[hits_key] for pattern in patterns)))
+
+            # Patterns that cost a lot but never match are candidates for removal or fixing
+            never_matched = sorted((pattern for pattern in patterns if not pattern[hits_key]),
+                                   key=lambda pattern: -pattern[attempts_key])
+            for pattern in never_matched[:max_never_matched]:
+                if 'property' in pattern:
+                    description = '%s { %s: %s } => $%s' % (pattern['selector_regex'],
+                                                             pattern['property'],
+                                                             pattern['search_regex'],
+                                                             pattern['variable'])
+                else:
+                    description = pattern['selector_regex']
+
+                lines.append('    never matched (%d attempts): %s' % (pattern[attempts_key], description))
+
+            if len(never_matched) > max_never_matched:
+                lines.append('    ... and %d more patterns that never matched' % (len(never_matched) - max_never_matched))
+
+        return '\n'.join(lines)
+
+class ConversionResult(object):
+    """
+    Result of Css2Stylus.convert_css.
+    """
+
+    def __init__(self):
+        # Stylus code of the rules and of the extracted variables
+        self.rules_text = None
+        self.vars_text = None
+
+        # Variable name => (value, number of occurrences of that value)
+        self.variables = {}
+
+        # Report lines and warnings, printed to stdout and stderr by Css2Stylus.convert
+        self.messages = []
+        self.warnings = []
+
+class MergeTemplate(object):
+    """
+    Stylus rules file of merge mode, split once at the magic line into the text before and after it. Any number of
+    vars files can then be inserted without scanning or copying the rules again (see Css2Stylus.merge_many).
+
+    @param text:
+        Stylus code, or a memory-mapped file (see from_file). Memory-mapped files without carriage returns are not
+        copied at all, the text before and after the magic line are buffers of the mapping.
+    """
+
+    _magic_line_regex = re.compile(r'^/\* Extracted variables should be inserted here \*/[ \t\v\f]*(?:\n|\Z)', re.M)
+
+    def __init__(self, text):
+        self.warnings = []
+        self._mmap = None
+
+        if text.find('\r') != -1:
+            text = self.normalize_newlines(text[:])
+
+        match = self._magic_line_regex.search(text)
+
+        if match is None:
+            self.warnings.append('Warning: Magic line for variables not found, inserting at top')
+            self._head = ''
+            self._tail = '\n' + text[:]
+        elif isinstance(text, basestring):
+            self._head = text[:match.start()]
+            self._tail = text[match.end():]
+        else:
+            self._head = buffer(text, 0, match.start())
+            self._tail = buffer(text, match.end())
+
+    @classmethod
+    def from_file(cls, filename, use_mmap=False):
+        """
+        Returns the template of a Stylus file. Call close when done.
+        """
+        data, mapping = cls.read_file(filename, use_mmap)
+
+        template = cls(data)
+        template._mmap = mapping
+        return template
+
+    @staticmethod
+    def read_file(filename, use_mmap=False):
+        """
+        Returns (content, mmap object or None). With use_mmap, the content is the memory-mapped file itself, which
+        must be closed when not needed anymore.
+        """
+        import mmap
+
+        with open(filename, 'rb') as f:
+            if use_mmap and os.fstat(f.fileno()).st_size:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                return mapping, mapping
+
+            return f.read(), None
+
+    @staticmethod
+    def normalize_newlines(text):
+        """
+        Universal newlines, like reading a file in 'rU' mode.
+        """
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+
+    def _get_parts(self, vars_text):
+        if vars_text.find('\r') != -1:
+            vars_text = self.normalize_newlines(vars_text[:])
+
+        return self._head, vars_text, self._tail
+
+    def render(self, vars_text):
+        """
+        Returns the merged text with the given variables.
+        """
+        return ''.join(part[:] for part in self._get_parts(vars_text))
+
+    def render_to_file(self, vars_filename, out_merged_filename, use_mmap=False):
+        """
+        Merges a vars file into a file. The output file isn't touched if it's unchanged, so that tools watching its
+        modification time don't rebuild. Returns whether the file was written.
+        """
+        vars_text, vars_mapping = self.read_file(vars_filename, use_mmap)
+        try:
+            parts = self._get_parts(vars_text)
+
+            if self._file_equals(out_merged_filename, parts):
+                return False
+
+            with open(out_merged_filename, 'wb') as merged_file:
+                for part in parts:
+                    merged_file.write(part)
+
+            return True
+        finally:
+            if vars_mapping is not None:
+                vars_mapping.close()
+
+    @staticmethod
+    def _file_equals(filename, parts, chunk_size=1024 * 1024):
+        try:
+            if os.path.getsize(filename) != sum(len(part) for part in parts):
+                return False
+
+            with open(filename, 'rb') as f:
+                for part in parts:
+                    for start in range(0, len(part), chunk_size):
+                        if f.read(min(chunk_size, len(part) - start)) != part[start:start + chunk_size]:
+                            return False
+        except EnvironmentError:
+            return False
+
+        return True
+
+    def close(self):
+        if self._mmap is not None:
+            self._head = self._tail = None
+            self._mmap.close()
+            self._mmap = None
+
+# Extraction rules of the current batch worker process, see Css2Stylus.convert_batch
+_batch_extraction_rules = None
+
+def _init_batch_worker(extraction_rules):
+    global _batch_extraction_rules
+    _batch_extraction_rules = extraction_rules
+
+def _run_batch_job(job):
+    """
+    Runs a single conversion of a batch. Output is captured and returned, so that the results of all conversions can
+    be reported in input order, and errors don't abort the other conversions.
+    """
+    error = None
+
+    with captured_output() as (stdout, stderr):
+        try:
+            Css2Stylus().convert(vars_modules=None, extraction_rules=_batch_extraction_rules, **job)
+        except Exception:
+            error = traceback.format_exc()
+
+    return {'filename' : job['filename'],
+            'stdout' : stdout.getvalue(),
+            'stderr' : stderr.getvalue(),
+            'error' : error}
+
+# (Extraction rules, whether to collect pattern statistics) of the current rule worker process, see
+# ParallelRuleConverter
+_rule_worker_state = None
+
+def _init_rule_worker(extraction_rules, collect_stats):
+    global _rule_worker_state
+    _rule_worker_state = (extraction_rules, collect_stats)
+
+def _convert_rule_chunk(rules):
+    """
+    Converts a chunk of style rules in a rule worker process. Returns the list of Css2Stylus._convertAndCountStyleRule
+    results. If a rule fails, its exception takes the place of its result and the rest of the chunk is skipped, so that
+    the conversion fails at the same rule as without workers.
+    """
+    extraction_rules, collect_stats = _rule_worker_state
+
+    converter = Css2Stylus()
+    if collect_stats:
+        converter._stats = ConversionStats()
+        converter._stats.extraction_rules = extraction_rules
+
+    results = []
+    for rule in rules:
+        try:
+            results.append(converter._convertAndCountStyleRule(rule, extraction_rules))
+        except Exception as e:
+            results.append(e)
+            break
+
+    return results
+
+class ParallelRuleConverter(object):
+    """
+    Runs the property conversion and variable extraction of style rules (Css2Stylus._convertStyleRule) on a pool of
+    worker processes, which is most of the work for big stylesheets. The results come back in rule order, and the tree,
+    variables and ambiguity errors are built from them in the calling process like without workers, so the output is
+    the same.
+    """
+
+    # Maximum number of style rules sent to a worker at once. Smaller chunks let the calling process start building the
+    # tree earlier, bigger ones have less overhead.
+    max_chunk_size = 256
+
+    def __init__(self, extraction_rules, num_workers, stats=None):
+        import multiprocessing
+
+        self.num_workers = num_workers
+        self._pool = multiprocessing.Pool(num_workers,
+                                          initializer=_init_rule_worker,
+                                          initargs=(extraction_rules, stats is not None))
+
+    def imap(self, style_rules, rule_index=None):
+        """
+        Returns an iterator of the _convertAndCountStyleRule results of the style rules, in the same order. Rules that
+        Css2Stylus._addStyleRule will take from the rule index aren't converted, their result is None.
+        """
+        if rule_index is None:
+            needs_conversion = [True] * len(style_rules)
+        else:
+            # Only the first of identical rules is converted, _addStyleRule finds the others in the index
+            needs_conversion = []
+            fingerprints = set()
+            for rule in style_rules:
+                fingerprint = rule_index.get_rule_fingerprint(rule)
+                needs_conversion.append(fingerprint not in rule_index and fingerprint not in fingerprints)
+                fingerprints.add(fingerprint)
+
+        results = self._iter_results([rule for rule, convert in zip(style_rules, needs_conversion) if convert])
+
+        for convert in needs_conversion:
+            yield next(results) if convert else None
+
+    def _iter_results(self, rules):
+        chunk_size = max(1, min(self.max_chunk_size, len(rules) // (4 * self.num_workers)))
+        chunks = [rules[start:start + chunk_size] for start in range(0, len(rules), chunk_size)]
+
+        for results in self._pool.imap(_convert_rule_chunk, chunks):
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+# State of the current server worker process, see ConversionServer. (Working directory, vars modules) => (extraction
+# rules, {module filename : (modification time, size)}), and (input filename, parser) => ((modification time, size),
+# parsed records) of the most recently converted stylesheets.
+_server_extraction_rules = {}
+_server_records = None
+SERVER_RECORDS_CACHE_SIZE = 8
+
+# Options that server requests may give for each command, requests with other options are rejected (see
+# ConversionServer)
+SERVER_JOB_OPTIONS = {
+    'convert' : frozenset(('filename', 'out_filename', 'vars_out_filename', 'vars_modules', 'use_indented_style',
+                           'streaming', 'parser', 'cache_dir', 'cache_size', 'incremental', 'atomic', 'dedupe_blocks',
+                           'discover_vars', 'output_profile')),
+    'merge' : frozenset(('stylus_filename', 'vars_filename', 'out_merged_filename', 'jobs', 'num_workers', 'use_mmap')),
+}
+
+def get_server_token_filename(port):
+    """
+    Returns the file in the home directory where the server listening on a TCP port keeps its token, which only the
+    user can read.
+    """
+    return os.path.join(os.path.expanduser('~'), '.css2stylus-server-%d.token' % port)
+
+def _get_file_state(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return stat.st_mtime, stat.st_size
+
+def _init_server_worker(vars_modules):
+    global _server_records
+    import collections
+    import signal
+
+    # Ctrl+C is handled by the server process, which terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _server_records = collections.OrderedDict()
+
+    if vars_modules:
+        _get_server_extraction_rules(vars_modules)
+
+def _get_server_extraction_rules(vars_modules, stats=None):
+    """
+    Returns the extraction rules of the vars modules, loaded relative to the current directory. They are only loaded
+    again if a module file changed.
+    """
+    if not vars_modules:
+        # Nothing to keep, and convert prints the warning about not extracting variables every time
+        return ExtractionRules.from_modules(vars_modules)
+
+    key = (os.getcwd(), tuple(vars_modules))
+    cached = _server_extraction_rules.get(key)
+
+    if cached is not None and all(_get_file_state(filename) == state for filename, state in cached[1].items()):
+        return cached[0]
+
+    with (stats.stage('load_rules') if stats is not None else _no_stats_stage('load_rules')):
+        # Modules of the same name may have been imported from another directory, or changed
+        for vars_module in vars_modules:
+            sys.modules.pop(vars_module, None)
+
+        extraction_rules = ExtractionRules.from_modules(vars_modules)
+
+    file_states = dict((filename, _get_file_state(filename)) for filename in extraction_rules.get_source_filenames())
+
+    _server_extraction_rules[key] = (extraction_rules, file_states)
+    return extraction_rules
+
+def _get_server_records(filename, parser, stats=None):
+    """
+    Returns the parsed records of a stylesheet, from the cache of the worker process if the file is unchanged.
+    """
+    key = (os.path.abspath(filename), parser)
+    state = _get_file_state(filename)
+
+    cached = _server_records.pop(key, None)
+    if cached is None or cached[0] != state:
+        with (stats.stage('parse') if stats is not None else _no_stats_stage('parse')):
+            with open(filename, 'rb') as f:
+                cached = (state, list(PARSERS[parser]().parse(f.read())))
+
+    # Most recently used last
+    _server_records[key] = cached
+    while len(_server_records) > SERVER_RECORDS_CACHE_SIZE:
+        _server_records.popitem(last=False)
+
+    return cached[1]
+
+def _run_server_job(job):
+    """
+    Runs a convert or merge request of the server in a worker process. Like batch jobs, output is captured and
+    returned. The job runs in the working directory of the client, so that relative filenames and vars modules work
+    like on the command line.
+    """
+    import time
+
+    start_time = time.time()
+    error = None
+    report = None
+    cwd = os.getcwd()
+
+    with captured_output() as (stdout, stderr):
+        try:
+            os.chdir(job['cwd'])
+            stats = ConversionStats() if job['stats'] else None
+            options = dict(job['options'])
+
+            if job['command'] == 'convert':
+                cache_dir = options.pop('cache_dir', None)
+                cache_size = options.pop('cache_size', 100)
+                cache = ConversionCache(cache_dir, cache_size * 1024 * 1024) if cache_dir else None
+                extraction_rules = _get_server_extraction_rules(options.pop('vars_modules', None), stats)
+
+                # Cached conversions and streaming don't need the parsed stylesheet
+                records = None
+                if cache is None and not options.get('streaming'):
+                    records = _get_server_records(options['filename'], options.get('parser', 'cssutils'), stats)
+
+                Css2Stylus().convert(vars_modules=None,
+                                     extraction_rules=extraction_rules,
+                                     cache=cache,
+                                     records=records,
+                                     stats=stats,
+                                     **options)
+            elif 'jobs' in options:
+                Css2Stylus.merge_many(stats=stats, **options)
+            else:
+                Css2Stylus.merge(stats=stats, **options)
+
+            if stats is not None:
+                report = stats.to_dict()
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            os.chdir(cwd)
+
+    return {'ok' : error is None,
+            'stdout' : stdout.getvalue(),
+            'stderr' : stderr.getvalue(),
+            'error' : error,
+            'stats' : report,
+            'seconds' : time.time() - start_time}
+
+class SelectorTreeNode(object):
+    """
+    Node of the selector tree built by Css2Stylus. Each node has a tuple of selectors (None for the root node), a list
+    of property strings (full lines) and an order index, which is the global creation order used to sort the output.
+    Children are kept in insertion order, which is also the order of their order indexes, so writing the tree needs no
+    sorting.
+    """
+
+    __slots__ = ('selector_list', 'properties', 'order_index', '_children', '_child_order', '_function_calls')
+
+    def __init__(self, selector_list=None, order_index=-1):
+        self.selector_list = selector_list
+        self.properties = []
+        self.order_index = order_index
+
+        # Selector list => child node, and the child nodes in insertion order. Both are None while the node has no
+        # children, which is the case for most nodes.
+        self._children = None
+        self._child_order = None
+
+        # Stylus function call lines in the properties, only collected once properties of a second rule are added
+        self._function_calls = None
+
+    def add_properties(self, property_lines, stylus_functions):
+        """
+        Appends property lines. A call of one of the given Stylus functions that is already in the properties (e.g.
+        'border-radius(5px)' of another rule merged into this node) is moved to the end instead of being written
+        twice. That doesn't change the result, since the later call sets the same properties to the same values.
+        """
+        if not self.properties:
+            # Most nodes only get the properties of one rule, which has no duplicate calls
+            self.properties.extend(property_lines)
+            return
+
+        if self._function_calls is None:
+            self._function_calls = set(line for line in self.properties if self._is_call(line, stylus_functions))
+
+        for line in property_lines:
+            if self._is_call(line, stylus_functions):
+                if line in self._function_calls:
+                    self.properties.remove(line)
+                else:
+                    self._function_calls.add(line)
+
+            self.properties.append(line)
+
+    @staticmethod
+    def _is_call(line, stylus_functions):
+        parenthesis_index = line.find('(')
+        return parenthesis_index != -1 and line[:parenthesis_index] in stylus_functions
+
+    def get_child(self, selector_list):
+        """
+        Returns the child node with the given selector list, or None.
+        """
+        if self._children is None:
+            return None
+
+        return self._children.get(selector_list)
+
+    def set_child(self, node):
+        """
+        Adds a child node. An existing child with the same selector list is replaced, and the new node comes last.
+        Adding a child again moves it to the end.
+        """
+        if self._children is None:
+            self._children = {}
+            self._child_order = []
+        elif node.selector_list in self._children:
+            self._child_order.remove(self._children[node.selector_list])
+
+        self._children[node.selector_list] = node
+        self._child_order.append(node)
+
+    def add_child(self, node):
+        """
+        Appends a child node. Existing children with the same selector list are kept before it, get_child returns the
+        new node.
+        """
+        if self._children is None:
+            self._children = {}
+            self._child_order = []
+
+        self._children[node.selector_list] = node
+        self._child_order.append(node)
+
+    def iter_children(self):
+        if self._child_order is not None:
+            return iter(self._child_order)
+
+        return iter(())
+
+    def walk(self):
+        """
+        Yields (depth, node) for all nodes below this one in output order (depth-first, children after their parent).
+        Children of this node have depth 0.
+        """
+        # Iterators over the children of each level, a recursive generator would pass every node up through all levels
+        stack = [self.iter_children()]
+
+        while stack:
+            for child in stack[-1]:
+                yield len(stack) - 1, child
+                stack.append(child.iter_children())
+                break
+            else:
+                stack.pop()
+
+    def clear(self):
+        """
+        Removes all children.
+        """
+        self._children = None
+        self._child_order = None
+
+class SharedBlockExtractor(object):
+    """
+    Optimization pass over the selector tree that moves property lines repeated in several nodes into Stylus mixins,
+    which the nodes call instead. Candidates are the prefixes and suffixes of the property lines of each node. That
+    covers identical blocks, and blocks that differ in a single line share their prefix and suffix up to that line. A
+    mixin call expands to the same lines at the same position, so the compiled CSS is the same (unlike @extend, which
+    would move the declarations to the first rule and change the cascade).
+
+    @param min_lines:
+        Minimum number of property lines of a mixin.
+    """
+
+    def __init__(self, min_lines=2, name_prefix='shared-block-'):
+        self.min_lines = min_lines
+        self.name_prefix = name_prefix
+
+        # (name, property lines) of the created mixins in output order
+        self.mixins = []
+
+        self.num_lines_saved = 0
+        self.num_bytes_saved = 0
+
+    @staticmethod
+    def _get_saved_bytes(name, lines, depths):
+        """
+        Returns the number of bytes saved by calling a mixin of the lines in nodes of the given depths, instead of
+        writing the lines (indented by two spaces per level).
+        """
+        lines_bytes = sum(len(line) + 1 for line in lines)
+        call_bytes = len(name) + 3
+
+        # Blank line, name and lines of the definition
+        definition_bytes = 1 + call_bytes + lines_bytes + 2 * len(lines)
+
+        return (len(depths) * (lines_bytes - call_bytes) +
+                sum(2 * (depth + 1) * (len(lines) - 1) for depth in depths) -
+                definition_bytes)
+
+    def run(self, tree):
+        """
+        Replaces repeated property lines in the nodes of the tree by mixin calls. The mixins must be written before the
+        tree (see write_mixins).
+        """
+        # (depth, node) of the nodes that have enough lines
+        nodes = [(depth, node) for depth, node in tree.walk() if len(node.properties) >= self.min_lines]
+
+        min_lines = self.min_lines
+
+        # The first min_lines lines of all prefixes and suffixes => number of occurrences. Prefixes and suffixes
+        # starting with lines that occur only once can't be shared, which rules out most nodes cheaply.
+        start_counts = {}
+        for unused_depth, node in nodes:
+            lines = node.properties
+            for start in range(len(lines) - min_lines + 1):
+                key = tuple(lines[start:start + min_lines])
+                start_counts[key] = start_counts.get(key, 0) + 1
+
+        # Tuple of lines => set of (node index, start index) where they occur as prefix or suffix
+        occurrences = {}
+        for i, (unused_depth, node) in enumerate(nodes):
+            lines = node.properties
+            if start_counts[tuple(lines[:min_lines])] > 1:
+                for end in range(min_lines, len(lines) + 1):
+                    occurrences.setdefault(tuple(lines[:end]), set()).add((i, 0))
+            for start in range(1, len(lines) - min_lines + 1):
+                if start_counts[tuple(lines[start:start + min_lines])] > 1:
+                    occurrences.setdefault(tuple(lines[start:]), set()).add((i, start))
+
+        next_name = lambda: '%s%d' % (self.name_prefix, len(self.mixins) + 1)
+
+        # Most saved bytes first, ties are broken by length and position to make the output deterministic
+        candidates = []
+        for lines, positions in occurrences.items():
+            if len(positions) > 1:
+                saved_bytes = self._get_saved_bytes(next_name(), lines, [nodes[i][0] for i, unused_start in positions])
+                if saved_bytes > 0:
+                    candidates.append((-saved_bytes, -len(lines), min(positions), lines))
+        candidates.sort()
+
+        # Node index => [(start, end, mixin name), ...] and set of replaced line indexes
+        replacements = {}
+        replaced_lines = {}
+
+        for unused_saved_bytes, unused_length, unused_position, lines in candidates:
+            positions = []
+            for i, start in sorted(occurrences[lines]):
+                line_indexes = set(range(start, start + len(lines)))
+                if not line_indexes & replaced_lines.setdefault(i, set()):
+                    positions.append((i, start))
+                    # Also prevents overlapping occurrences in the same node
+                    replaced_lines[i] |= line_indexes
+
+            name = next_name()
+            saved_bytes = self._get_saved_bytes(name, lines, [nodes[i][0] for i, unused_start in positions])
+
+            if len(positions) < 2 or saved_bytes <= 0:
+                for i, start in positions:
+                    replaced_lines[i] -= set(range(start, start + len(lines)))
+                continue
+
+            self.mixins.append((name, list(lines)))
+            self.num_bytes_saved += saved_bytes
+            self.num_lines_saved += (len(lines) - 1) * len(positions) - (len(lines) + 2)
+
+            for i, start in positions:
+                replacements.setdefault(i, []).append((start, start + len(lines), name))
+
+        for i, node_replacements in replacements.items():
+            node = nodes[i][1]
+            properties = []
+            position = 0
+            for start, end, name in sorted(node_replacements):
+                properties.extend(node.properties[position:start])
+                properties.append(name + '()')
+                position = end
+            properties.extend(node.properties[position:])
+            node.properties = properties
+
+    def write_mixins(self, emitter, compact=False):
+        """
+        @param compact:
+            Write the mixins in the compact output profile (see Css2Stylus.convert).
+        """
+        for name, lines in self.mixins:
+            if compact:
+                lines = Css2Stylus._compact_property_lines(lines)
+            else:
+                emitter.write_line()
+
+            emitter.write_line(name + '()')
+            emitter.indent += 1
+            emitter.write_lines(lines)
+            emitter.indent -= 1
+
+class VariableDiscovery(object):
+    """
+    Turns color and length values that are used many times into variables, without any EXTRACT_VARIABLES rules. Runs
+    over the property lines of the selector tree after the conversion. The first pass counts every color (hex, rgb(),
+    hsl(), ...) and length with a unit in a dictionary, with the number of nodes and a few selectors using it. The
+    second pass replaces the values used more than `threshold` times. Extracted variables, strings, comments, URLs
+    and calc() are skipped, and so are lengths next to a slash ('12px/1.5'), which Stylus would divide if one side was
+    a variable. Hex colors are counted case-insensitively.
+
+    Variable names are made from the values (e.g. $color-3c3c3c, $size-10px), so they stay the same when the
+    stylesheet changes, and a vars file edited by hand still fits the rules.
+    """
+
+    _value_token_regex = re.compile(r'''
+        /\*.*?\*/ | url\([^)]*\) | calc\((?:[^()]|\([^()]*\))*\) | "(?:[^"\\]|\\.)*" | '(?:[^'\\]|\\.)*' | \$[\w-]+ |
+        (?<![\w.#/-])(?P<value>
+            \#(?:[0-9a-fA-F]{6}|[0-9a-fA-F]{3})(?![\w-]) |
+            (?:rgba?|hsla?)\([^()]*\) |
+            (?P<number>-?(?:\d+(?:\.\d+)?|\.\d+))(?:px|em|rem|pt|ex|ch|vw|vh)(?![\w%/-])
+        )
+    ''', re.X | re.S)
+
+    # Number of selectors listed per variable in the report
+    num_example_selectors = 3
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+        # (name, value, occurrences, number of nodes, example selectors) of the discovered variables, sorted by name
+        self.variables = []
+
+        # Number of distinct colors and lengths
+        self.num_values = 0
+
+    @staticmethod
+    def _get_selector(path):
+        """
+        Returns the full selector list of a node from the selector lists of the nodes on its path, without @media
+        queries.
+        """
+        selectors = ['']
+        for selector_list in path:
+            if selector_list[0].startswith('@'):
+                continue
+
+            selectors = [(parent + ' ' + selector).lstrip() for parent in selectors for selector in selector_list]
+
+        return ', '.join(selectors)
+
+    @staticmethod
+    def _get_match_value(match):
+        value = match.group('value')
+        return value.lower() if value is not None and value.startswith('#') else value
+
+    @staticmethod
+    def _get_variable_name(value):
+        if value.startswith('#'):
+            return 'color-' + value[1:]
+
+        if value.endswith(')'):
+            return 'color-' + re.sub(r'[^\w.]+', '-', value.lower()).strip('-').replace('.', '_')
+
+        if value.startswith('-'):
+            value = 'minus' + value
+
+        return 'size-' + value.replace('.', '_')
+
+    def run(self, tree, existing_names=()):
+        """
+        Replaces the values used more than `threshold` times in the tree by variables. The new variables must not get
+        one of existing_names.
+        """
+        # Value => [occurrences, number of nodes, last node, example selectors]
+        index = {}
+
+        # Selector lists of the nodes on the path to the current node
+        path = []
+
+        for depth, node in tree.walk():
+            del path[depth:]
+            path.append(node.selector_list)
+
+            for line in node.properties:
+                for match in self._value_token_regex.finditer(line):
+                    value = self._get_match_value(match)
+
+                    if value is None or (match.group('number') is not None and not float(match.group('number'))):
+                        continue
+
+                    entry = index.get(value)
+                    if entry is None:
+                        entry = index[value] = [0, 0, None, []]
+
+                    entry[0] += 1
+
+                    if entry[2] is not node:
+                        entry[1] += 1
+                        entry[2] = node
+
+                        if len(entry[3]) < self.num_example_selectors:
+                            entry[3].append(self._get_selector(path))
+
+        self.num_values = len(index)
+
+        # Value => variable name
+        names = {}
+        used_names = set(existing_names)
+
+        for value, (occurrences, num_nodes, unused_node, selectors) in sorted(index.items()):
+            if occurrences <= self.threshold:
+                continue
+
+            name = base_name = self._get_variable_name(value)
+            suffix = 1
+            while name in used_names:
+                suffix += 1
+                name = '%s-%d' % (base_name, suffix)
+
+            used_names.add(name)
+            names[value] = name
+            self.variables.append((name, value, occurrences, num_nodes, selectors))
+
+        self.variables.sort()
 
-TREE_ATTRIBUTE_NAMES = ('_properties', '_order_index')
+        if not names:
+            return
+
+        def replace(match):
+            name = names.get(self._get_match_value(match))
+            return '$' + name if name is not None else match.group()
+
+        for unused_depth, node in tree.walk():
+            node.properties = [self._value_token_regex.sub(replace, line) for line in node.properties]
 
 class Css2Stylus(object):
-    def _addStyleRule(self, rule, extracted_variables, variables_to_extract):
-        extract_variables_mapping = {}
+    # ConversionStats of the current conversion, or None
+    _stats = None
+
+    # Whether the rules are written in the compact output profile, see convert
+    _compact_output = False
+
+    # Property lines whose colon can be left out in compact output. Values with colons, braces or '&' keep it, so that
+    # Stylus doesn't take the line for a selector ('filter: progid:DXImageTransform...'), and so do values with '/' or
+    # starting with an operator character, which Stylus would evaluate as an expression with the property name
+    # ('font 12px/1.5 a' divides, 'margin -1px' subtracts).
+    _compact_property_regex = re.compile(r'^(-?[a-zA-Z_][\w-]*): (?![-+*%(\[{~!=<>?.])(?=[^:{}&/]*$)')
+
+    # Comments in property values, which compact output leaves out, and strings, which may contain '/*'
+    _value_comment_regex = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|\s*/\*.*?\*/''', re.S)
+
+    # Selectors without attribute selectors, functional pseudo-classes, strings, comments or escapes, which are split
+    # with a single regex. In the others, combinators and whitespace may also appear inside brackets, strings and
+    # escapes.
+    _simple_selector_regex = re.compile(r'[^\[\]()"\'/\\]*$')
+    _simple_selector_part_regex = re.compile(r'\s*([>+~]?)\s*([^\s>+~]+)')
+    _selector_token_regex = re.compile(r'''
+        "(?:[^"\\]|\\.)*" | '(?:[^'\\]|\\.)*' | /\*.*?\*/ | \\. | [\[\]()] | \s*[>+~]\s* | \s+ |
+        [^\s>+~\[\]()"'/\\]+ | .
+    ''', re.X | re.S)
+
+    def _addStyleRule(self, rule, extracted_variables, extraction_rules, rule_index=None, converted=None,
+                      parent=None):
+        """
+        @param converted:
+            Result of _convertAndCountStyleRule if the rule was already converted by a worker process (see
+            ParallelRuleConverter)
+        @param parent:
+            Tree node of the @media block containing the rule (see _addMediaRule), None for top-level rules
+        """
+        node = self._get_rule_node(rule['selector_list'], parent)
 
-        # If there's exactly one selector, it can be merged with other rules
-        if self._use_indented_style and len(rule['selector_list']) == 1:
-            selector = rule['selector_list'][0]
+        self._num_style_rules += 1
 
-            node = self._find_or_create_nested_node(selector)
+        if rule_index is None:
+            if converted is None:
+                converted = self._convertStyleRule(rule, extraction_rules)
         else:
-            node = {'_properties': [], '_order_index' : self._order_index}
-            self._order_index += 1
-            self._tree[tuple(rule['selector_list'])] = node
+            fingerprint = rule_index.get_rule_fingerprint(rule)
+            indexed = rule_index.get(fingerprint)
 
-        for selector in rule['selector_list']:
-            if selector in variables_to_extract:
-                extract_variables_mapping.update(variables_to_extract[selector])
+            if indexed is not None:
+                converted = indexed
             else:
-                for selector_match_regex in variables_to_extract:
-                    original_selector_match_regex = selector_match_regex
+                if converted is None:
+                    converted = self._convertAndCountStyleRule(rule, extraction_rules)
+                rule_index.add(fingerprint, converted)
 
-                    # Force full matching
-                    if not selector_match_regex.endswith('$'):
-                        selector_match_regex += '$'
+        property_lines, rule_variables, num_extraction_searches = converted[:3]
 
-                    if re.match(selector_match_regex, selector):
-                        extract_variables_mapping.update(variables_to_extract[original_selector_match_regex])
-                        break
+        # Rules converted by a worker or taken from the rule index weren't counted yet
+        if self._stats is not None and len(converted) > 3:
+            self._stats.add_pattern_counts(converted[3])
+
+        node.add_properties(property_lines, extraction_rules.stylus_functions)
+        self._num_extraction_searches += num_extraction_searches
+
+        for variable_name, variable_value in rule_variables:
+            if variable_name in extracted_variables:
+                expected_variable_value = extracted_variables[variable_name][0]
+
+                if expected_variable_value != variable_value:
+                    raise Exception("Variable %s has ambiguous values '%s' and '%s', maybe you need to be more "
+                                    "specific in your variable definiton or create two variables"
+                                    % (variable_name, expected_variable_value, variable_value))
+
+                # Increment number of occurrences
+                extracted_variables[variable_name][1] += 1
+            else:
+                extracted_variables[variable_name] = [variable_value, 1]
+
+    def _get_rule_node(self, selector_list, parent=None):
+        """
+        Returns the tree node for the properties of a rule, below the given node or the root. In linear style, every
+        rule gets its own node, also if an earlier rule has the same selectors (like the rules written right away with
+        streaming).
+        """
+        if self._use_indented_style:
+            return self._find_or_create_nested_node(selector_list, parent)
+
+        node = SelectorTreeNode(tuple(selector_list), self._order_index)
+        self._order_index += 1
+        (self._tree if parent is None else parent).add_child(node)
+
+        return node
+
+    def _addMediaRule(self, rule, extracted_variables, extraction_rules, write_line, rule_index=None,
+                      converted_rules=None, parent=None):
+        """
+        Adds the rules of an @media block below the tree node of its query. A block is grouped into the node of the
+        previous block with the same query (and the same parent, for nested blocks) if no style rule came between them.
+        Otherwise it gets its own node, because moving rules past other rules could change the cascade.
+
+        @param converted_rules:
+            Iterator over the results of ParallelRuleConverter for the style rules in the block, or None
+        @param parent:
+            Tree node of the enclosing @media block, None for top-level blocks
+        """
+        if parent is None:
+            parent = self._tree
+
+        # Children are keyed by their selector list, so the tree node of the parent is also the index of its queries
+        selector_list = (('@media ' + rule['media_text']).rstrip(),)
+        node = parent.get_child(selector_list)
+
+        if node is not None and self._media_rule_ends[node] != self._num_style_rules:
+            node = None
+
+        if node is None:
+            node = SelectorTreeNode(selector_list, self._order_index)
+            self._order_index += 1
+            parent.add_child(node)
+        else:
+            parent.set_child(node)
+            self._num_grouped_media_rules += 1
+
+        self._num_media_rules += 1
+
+        for inner_rule in rule['rules']:
+            if inner_rule['type'] == 'style':
+                self._addStyleRule(inner_rule, extracted_variables, extraction_rules, rule_index,
+                                   next(converted_rules) if converted_rules is not None else None, node)
+            elif inner_rule['type'] == 'comment':
+                self._writeCommentRule(inner_rule, write_line)
+            elif inner_rule['type'] == 'media':
+                self._addMediaRule(inner_rule, extracted_variables, extraction_rules, write_line, rule_index,
+                                   converted_rules, node)
+            else:
+                raise AssertionError
+
+        self._media_rule_ends[node] = self._num_style_rules
+
+    def _clear_tree(self):
+        """
+        Removes the written rules from the tree, together with what _addMediaRule keeps about them for grouping.
+        """
+        self._tree.clear()
+        self._media_rule_ends.clear()
 
-        # Stores the Stylus function names that were already written out for this rule
+    @classmethod
+    def _iter_style_rules(cls, records):
+        """
+        Yields the style rules of the records, including those in @media blocks, in the order they are added to the
+        tree.
+        """
+        for record in records:
+            if record['type'] == 'style':
+                yield record
+            elif record['type'] == 'media':
+                for rule in cls._iter_style_rules(record['rules']):
+                    yield rule
+
+    def _convertAndCountStyleRule(self, rule, extraction_rules):
+        """
+        Returns the _convertStyleRule result with the pattern counts of the rule appended (see
+        ConversionStats.get_pattern_counts, None if no statistics are collected). The counts are not added to the
+        statistics yet, _addStyleRule does that, also for rules from worker processes and the rule index.
+        """
+        if self._stats is None:
+            return self._convertStyleRule(rule, extraction_rules) + (None,)
+
+        stats = self._stats
+        self._stats = ConversionStats()
+        self._stats.extraction_rules = extraction_rules
+
+        try:
+            return self._convertStyleRule(rule, extraction_rules) + (self._stats.get_pattern_counts(),)
+        finally:
+            self._stats = stats
+
+    def _convertStyleRule(self, rule, extraction_rules):
+        """
+        Converts the properties of a rule and extracts the variables. The result only depends on the rule and the
+        extraction rules, so it can be reused for unchanged rules (see RuleIndex).
+
+        @return:
+            Tuple (Stylus property lines, [(variable name, variable value), ...], number of regex searches)
+        """
+        extract_variables_mapping = {}
+        property_lines = []
+        rule_variables = []
+        num_extraction_searches = 0
+
+        pattern_stats = self._stats.selector_patterns if self._stats is not None else None
+
+        for selector in rule['selector_list']:
+            selector_match_regex = extraction_rules.selector_index.find(selector, pattern_stats)
+            if selector_match_regex is not None:
+                extract_variables_mapping.update(extraction_rules.compiled_variables_to_extract[selector_match_regex])
+
+        # Stores the Stylus function names that were already written out for this rule (duplicates of other rules
+        # merged into the same tree node are removed by SelectorTreeNode.add_properties)
         had_shorthand = set()
+        shorthand_index = extraction_rules.shorthand_index
 
         for property in rule['properties']:
             name, value, priority = property
 
-            # Store parts of 'value' where we inserted variable names already. These parts are excluded from regex
-            # searching so that variable names are not matched accidentally.
-            value_variable_ranges = []
-
             if name in extract_variables_mapping:
-                for search_regex, variable_name in extract_variables_mapping[name]:
-                    # Match colors #fff, #123456, red, white, etc.
-                    search_regex = (search_regex.replace('<COLOR>', r'(?P<color>#[a-fA-F0-9]{3,6}|[a-z]{3,20})')
-                                                .replace('<VALUE>', r'\s*(?P<value>.*)\s*'))
+                # Parts of 'value' where we inserted variable names are excluded from regex searching so that they
+                # are not matched again
+                substitution = ValueSubstitution(value)
 
-                    # Replace any inserted variables by underscores so that they won't get matched
-                    match = re.search(search_regex, self.replace_variable_ranges(value, value_variable_ranges))
+                for extraction_rule in extract_variables_mapping[name]:
+                    variable_name = extraction_rule.variable_name
+                    num_extraction_searches += 1
+
+                    match = substitution.search(extraction_rule.regex)
+
+                    if self._stats is not None:
+                        self._stats.count_search(extraction_rule, match)
 
                     if match:
                         variable_value = None
 
-                        for group_name in ('color', 'value'):
-                            if match.groupdict().get(group_name, None):
+                        for group_name in extraction_rule.group_names:
+                            if match.group(group_name):
                                 if variable_value is not None:
                                     raise AssertionError('Two groups in the regex matched!')
 
                                 variable_value = match.group(group_name)
                                 start, end = match.span(group_name)
 
-                                for vstart, vend in value_variable_ranges:
-                                    if self.overlaps((start, end), (vstart, vend)):
-                                        raise AssertionError('Regex search overlaps with inserted variable')
-
                                 # Inject variable name instead of the value
-                                value = value[:start] + '$' + variable_name + value[end:]
-
-                                for vrange in value_variable_ranges:
-                                    if vrange[0] >= start:
-                                        diff = (end-start) + len('$' + variable_name)
-                                        vrange[0] += diff
-                                        vrange[1] += diff
-
-                                value_variable_ranges.append([start, start + len('$' + variable_name)])
+                                substitution.substitute(start, end, '$' + variable_name)
 
                         if variable_value is None:
                             raise AssertionError('Variable value of %s not found' % variable_name)
 
-                        if variable_name in extracted_variables:
-                            expected_variable_value = extracted_variables[variable_name][0]
-
-                            if expected_variable_value != variable_value:
-                                raise Exception("Variable %s has ambiguous values '%s' and '%s', maybe you need to be more "
-                                                "specific in your variable definiton or create two variables"
-                                                % (variable_name, expected_variable_value, variable_value))
-
-                            # Increment number of occurrences
-                            extracted_variables[variable_name][1] += 1
-                        else:
-                            extracted_variables[variable_name] = [variable_value, 1]
+                        rule_variables.append((variable_name, variable_value))
 
-            if name.startswith('-') and name.count('-') >= 2:
-                officialName = name[2 + name[1:].index('-'):]
-            else:
-                officialName = None
+                value = substitution.get_value()
 
-            if (((name.startswith('-moz-') or name.startswith('-webkit-')) and
-                 officialName is not None and (officialName in NIB_SHORTHANDS or name in NIB_SHORTHANDS)) or
-                name in NIB_SHORTHANDS):
-                stylus_function = NIB_SHORTHANDS[officialName] if officialName in NIB_SHORTHANDS else NIB_SHORTHANDS[name]
+            stylus_function = shorthand_index.get(name)
 
+            if stylus_function is not None:
+                # Prefixed versions of a property are written as one call, the first one wins
                 if stylus_function not in had_shorthand:
-                    node['_properties'].append('%s(%s%s%s)' % (stylus_function,
-                                                               value,
-                                                               ' ' if priority else '',
-                                                               priority))
-                    #write_line('  %s(%s%s%s)' % (stylus_function,
-                    #                            value,
-                    #                            ' ' if priority else '',
-                    #                            priority))
-
-                    # TODO: had_shorthand doesn't work anymore in tree mode, should be stored inside the tree
+                    property_lines.append('%s(%s%s%s)' % (stylus_function,
+                                                          value,
+                                                          ' ' if priority else '',
+                                                          priority))
                     had_shorthand.add(stylus_function)
             else:
-                assert(name not in NIB_SHORTHANDS)
                 property_formatted = '%s: %s%s%s' % (name,
                                                     value,
                                                     ' ' if priority else '',
                                                     priority)
-                node['_properties'].append(property_formatted)
+                property_lines.append(property_formatted)
+
+        return property_lines, rule_variables, num_extraction_searches
 
-    def convert(self, filename, out_filename, vars_out_filename, vars_modules, use_indented_style):
+    def convert(self, filename, out_filename, vars_out_filename, vars_modules, use_indented_style, streaming=False,
+                parser='cssutils', extraction_rules=None, cache=None, incremental=False, records=None, atomic=False,
+                stats=None, dedupe_blocks=False, num_workers=1, discover_vars=None, output_profile='verbose'):
         """
         @param use_indented_style:
             Put rules like 'body p { color: red }' as follows:
@@ -158,243 +2844,537 @@ class Css2Stylus(object):
                   p
                     color: red
 
+            Rules with the same parent selectors are nested in the same node, also with combinators and across
+            the selectors of a selector list ('body > p, body > a' becomes 'body' with '> p' and '> a' below it).
+
             The default is the CSS-like syntax:
 
                 body p
                   color: red
-        @todo:
-            use_colon parameter to define whether to write 'font-size: 14px' or 'font-size 14px' (both valid Stylus syntax)
+        @param streaming:
+            Read and parse the input statement by statement instead of loading the whole stylesheet. In linear style,
+            each rule is written out as soon as it was parsed, so memory usage doesn't grow with the input size. Note
+            that this writes comments and rules in input order after the magic variables line, and doesn't group
+            @media blocks with the same query.
+        @param parser:
+            Name of the parser backend (see PARSERS), 'cssutils' or the faster 'builtin' parser.
+        @param extraction_rules:
+            Already loaded ExtractionRules, vars_modules is ignored if given.
+        @param cache:
+            ConversionCache. If the same input was already converted with the same rules and options, the output
+            files and the printed report are restored from the cache without parsing.
+        @param incremental:
+            Keep a fingerprint index of the converted rules next to the output (out_filename + '.index'). On the next
+            conversion, only changed and added rules go through variable extraction again. The stylesheet is still
+            parsed and the whole output is written, which is the same as with a full conversion (also the
+            statistics).
+        @param records:
+            Already parsed records of the input file (see CssutilsParser), the file is not read again if given. The
+            cache is not used in this case.
+        @param atomic:
+            Write the output files through temporary files which are renamed when finished (see OutputEmitter).
+        @param stats:
+            ConversionStats to fill with timings and pattern statistics.
+        @param dedupe_blocks:
+            Write property lines that are repeated in several rules as Stylus mixins, which makes the output smaller
+            without changing the compiled CSS (see SharedBlockExtractor). When streaming in linear style, the rules
+            are then written at the end instead of right away.
+        @param num_workers:
+            Number of worker processes that convert the properties of the style rules and extract the variables in
+            parallel (see ParallelRuleConverter). The output is the same as with 1, which converts everything in this
+            process. When streaming, the whole input is parsed before the conversion starts.
+        @param discover_vars:
+            Turn colors and lengths that are used more than this number of times into variables, in addition to the
+            extraction rules (see VariableDiscovery). None to not discover variables. When streaming in linear style,
+            the rules are then written at the end instead of right away.
+        @param output_profile:
+            Format of the rules output (see OUTPUT_PROFILES). 'verbose' writes 'font-size: 14px' with a colon, a blank
+            line before each rule, the comments of the input and all helper functions (see HELPER_FUNCTIONS).
+            'compact' writes 'font-size 14px' (both are valid Stylus syntax) without blank lines and comments, which
+            Stylus compiles faster, and only defines the helper functions that are called.
         """
 
-        self._reset()
-        self._use_indented_style = use_indented_style # TODO: actually use this setting
+        stats_stage = stats.stage if stats is not None else _no_stats_stage
+
+        if extraction_rules is None:
+            with stats_stage('load_rules'):
+                extraction_rules = ExtractionRules.from_modules(vars_modules)
+
+        if stats is not None:
+            stats.extraction_rules = extraction_rules
+
+        if cache is not None and records is None:
+            with stats_stage('cache_lookup'):
+                key = cache.get_key(filename,
+                                    extraction_rules,
+                                    {'use_indented_style' : use_indented_style,
+                                     'streaming' : streaming,
+                                     'parser' : parser,
+                                     'dedupe_blocks' : dedupe_blocks,
+                                     'discover_vars' : discover_vars,
+                                     'output_profile' : output_profile})
+                report = cache.restore(key, out_filename, vars_out_filename)
+
+            if stats is not None:
+                stats.cache_hit = report is not None
+
+            if report is None:
+                try:
+                    with captured_output() as (stdout, stderr):
+                        self.convert(filename=filename,
+                                     out_filename=out_filename,
+                                     vars_out_filename=vars_out_filename,
+                                     vars_modules=None,
+                                     use_indented_style=use_indented_style,
+                                     streaming=streaming,
+                                     parser=parser,
+                                     extraction_rules=extraction_rules,
+                                     incremental=incremental,
+                                     atomic=atomic,
+                                     stats=stats,
+                                     dedupe_blocks=dedupe_blocks,
+                                     num_workers=num_workers,
+                                     discover_vars=discover_vars,
+                                     output_profile=output_profile)
+                except:
+                    # Failed conversions are not cached, but their output must not get lost
+                    sys.stdout.write(stdout.getvalue())
+                    sys.stderr.write(stderr.getvalue())
+                    raise
+
+                report = {'stdout' : stdout.getvalue(), 'stderr' : stderr.getvalue()}
+                cache.store(key, out_filename, vars_out_filename, report)
+
+            sys.stdout.write(report['stdout'])
+            sys.stderr.write(report['stderr'])
+            return
+
+        css_parser = PARSERS[parser]()
+
+        if records is None:
+            if streaming:
+                # Generator, statements are only parsed while the output is written (so parsing counts to the 'rules'
+                # stage)
+                records = self._iter_streaming_records(filename, css_parser)
+            else:
+                with stats_stage('parse'):
+                    with open(filename, 'rb') as f:
+                        records = list(css_parser.parse(f.read()))
 
-        with open(filename, 'rb') as f:
-            css = cssutils.parseString(f.read(), validate=False)
+        rule_index = RuleIndex(out_filename + '.index', extraction_rules, stats is not None) if incremental else None
 
-        out = []
+        # Without merging of rules, they can be written out right away, unless shared blocks or variable discovery
+        # need the whole tree
+        write_rules_immediately = (streaming and not use_indented_style and not dedupe_blocks and
+                                   discover_vars is None)
+
+        print('Creating Stylus file')
+
+        result = ConversionResult()
+
+        try:
+            with OutputEmitter(out_filename,
+                               atomic=atomic,
+                               max_buffered_lines=4096 if write_rules_immediately else None) as out_emitter:
+                with OutputEmitter(vars_out_filename, atomic=atomic) as vars_out_emitter:
+                    self._convert_records(records, out_emitter, vars_out_emitter, extraction_rules, use_indented_style,
+                                          write_rules_immediately, rule_index, stats, result, dedupe_blocks,
+                                          num_workers, discover_vars, output_profile)
+        finally:
+            for message in result.messages:
+                print(message)
+
+        if rule_index is not None:
+            with stats_stage('save_index'):
+                rule_index.save()
+
+        for warning in result.warnings:
+            print(warning, file=sys.stderr)
+
+    def convert_css(self, css, extraction_rules=None, use_indented_style=False, parser='cssutils', streaming=False,
+                    stats=None, dedupe_blocks=False, num_workers=1, discover_vars=None, output_profile='verbose'):
+        """
+        Converts CSS in memory. Nothing is printed and no files are read or written, so that many conversions can run
+        in one process. Messages and warnings that convert would print are returned in the result instead.
+
+        @param css:
+            CSS text (unicode, or bytes in UTF-8 or with @charset rule) or file-like object.
+        @param extraction_rules:
+            Already loaded ExtractionRules (see ExtractionRules.from_modules), or None to not extract variables.
+        @param use_indented_style, streaming, parser, stats, dedupe_blocks, num_workers, discover_vars, output_profile:
+            See convert
+        @return:
+            ConversionResult
+        """
+        if extraction_rules is None:
+            extraction_rules = ExtractionRules({})
+
+        if stats is not None:
+            stats.extraction_rules = extraction_rules
+
+        result = ConversionResult()
+        css_parser = PARSERS[parser](warn=result.warnings.append)
+        stats_stage = stats.stage if stats is not None else _no_stats_stage
+
+        # Parser warnings and cssutils log messages come in the same order as convert prints them to stderr
+        with redirected_cssutils_log(_LineCollector(result.warnings)):
+            if streaming:
+                if not hasattr(css, 'read'):
+                    css = StringIO(css.encode('utf-8') if isinstance(css, unicode) else css)
+
+                records = (record
+                           for statement in iter_css_statements(css)
+                           for record in css_parser.parse_statement(statement))
+            else:
+                with stats_stage('parse'):
+                    records = list(css_parser.parse(css.read() if hasattr(css, 'read') else css))
+
+            out_emitter = OutputEmitter(None)
+            vars_out_emitter = OutputEmitter(None)
+            self._convert_records(records, out_emitter, vars_out_emitter, extraction_rules, use_indented_style,
+                                  streaming and not use_indented_style and not dedupe_blocks and discover_vars is None,
+                                  None, stats, result, dedupe_blocks, num_workers, discover_vars, output_profile)
+
+        result.rules_text = out_emitter.getvalue()
+        result.vars_text = vars_out_emitter.getvalue()
+
+        return result
+
+    def _convert_records(self, records, out_emitter, vars_out_emitter, extraction_rules, use_indented_style,
+                         write_rules_immediately, rule_index, stats, result, dedupe_blocks=False, num_workers=1,
+                         discover_vars=None, output_profile='verbose'):
+        """
+        Converts parsed records, writing the Stylus code to the two OutputEmitters and filling the ConversionResult.
+
+        @param dedupe_blocks:
+            Move repeated property lines into mixins (see SharedBlockExtractor). The rules must not be written
+            immediately.
+        @param num_workers:
+            Number of worker processes converting the style rules (see ParallelRuleConverter), 1 for none.
+        @param discover_vars:
+            Threshold of VariableDiscovery, or None. The rules must not be written immediately.
+        @param output_profile:
+            See convert
+        """
+        if output_profile not in OUTPUT_PROFILES:
+            raise ValueError('Unknown output profile %r' % output_profile)
+
+        stats_stage = stats.stage if stats is not None else _no_stats_stage
+
+        self._reset()
+        self._use_indented_style = use_indented_style
+        self._stats = stats
+        self._compact_output = output_profile == 'compact'
+
+        # Helper functions that are not defined yet. Compact output only defines them before they're first called.
+        self._undefined_helper_functions = list(HELPER_FUNCTIONS) if self._compact_output else []
 
         # Variable name => (value, number of occurrences of that value)
         extracted_variables = {}
-        variables_to_extract = {}
 
-        if vars_modules:
-            if len(set(vars_modules)) != len(vars_modules):
-                raise AssertionError('Duplicate variables module')
+        write_line = out_emitter.write_line
+        write_line_vars = vars_out_emitter.write_line
 
-            script_dir = os.path.abspath(os.path.dirname(__file__))
-            cwd = os.getcwd()
-            sys.path.insert(0, cwd)
-            sys.path.insert(1, script_dir)
-            try:
-                for vars_module in vars_modules:
-                    module = __import__(vars_module)
-
-                    # Merge dictionary (cannot use dict.update because that does a simple key replacement, we have a
-                    # nested dictionary)
-                    for selector_match_regex, mapping in module.EXTRACT_VARIABLES.items():
-                        if selector_match_regex in variables_to_extract:
-                            for property_name, extraction_infos in mapping.items():
-                                if property_name in variables_to_extract[selector_match_regex]:
-                                    merged_extraction_infos = (tuple(variables_to_extract[selector_match_regex][property_name]) +
-                                                            tuple(extraction_infos))
-                                    variables_to_extract[selector_match_regex][property_name] = merged_extraction_infos
-                                else:
-                                    variables_to_extract[selector_match_regex][property_name] = extraction_infos
-                        else:
-                            variables_to_extract[selector_match_regex] = mapping
-            finally:
-                sys.path = sys.path[2:]
-        else:
-            print('WARNING: Not extracting variables, use the --vars-module parameter to do so', file=sys.stderr)
+        def write_line_both(line=''):
+            write_line(line)
+            write_line_vars(line)
 
+        write_line_both('// THIS FILE IS AUTOGENERATED BY CSS2STYLUS')
+        write_line_both('// ----------------------------------------')
+        write_line_vars()
 
-        for rule in css:
-            if rule.type == rule.COMMENT:
-                out.append({'type' : 'comment',
-                            'text' : rule.cssText})
-            elif rule.type == rule.STYLE_RULE:
-                selector_list = tuple(selector.selectorText for selector in rule.selectorList)
+        if not self._compact_output:
+            write_line()
+            write_line('/* Functions that are not in nib library */')
+            for unused_name, definition_lines in HELPER_FUNCTIONS:
+                out_emitter.write_lines(definition_lines)
+                write_line()
 
-                properties = []
-                out.append({'type' : 'style',
-                            'selector_list' : selector_list,
-                            'properties' : properties})
+        write_line("@import 'nib'")
 
-                for property in rule.style:
-                    properties.append((property.name, property.value, property.priority))
-            elif rule.type == rule.MEDIA_RULE:
-                continue
-            else:
-                print('Unsupported rule type: %d' % rule.type, file=sys.stderr)
+        if write_rules_immediately:
+            write_line('/* Extracted variables should be inserted here */')
 
-        print('Creating Stylus file')
-        first = True
-
-        with open(out_filename, 'wb') as out_file:
-            with open(vars_out_filename, 'wb') as vars_out_file:
-                write_line = lambda line='': print(line, file=out_file)
-                write_line_vars = lambda line='': print(line, file=vars_out_file)
-
-                def write_line_both(line=''):
-                    print(line, file=out_file)
-                    print(line, file=vars_out_file)
-
-                write_line_both('// THIS FILE IS AUTOGENERATED BY CSS2STYLUS')
-                write_line_both('// ----------------------------------------')
-                write_line_both()
-                write_line('/* Functions that are not in nib library */')
-                write_line('border-top-left-radius()')
-                write_line('  border-top-left-radius: arguments')
-                write_line('  -webkit-border-top-left-radius: arguments')
-                write_line('  -moz-border-radius-topleft: arguments')
-                write_line()
-                write_line("@import 'nib'")
+        def write_tree():
+            if stats is not None:
+                stats.add_tree(self._tree)
+
+            self._write_helper_functions(out_emitter,
+                                         (line for unused_depth, node in self._tree.walk() for line in node.properties))
+            self._write_tree(out_emitter)
+
+        with stats_stage('rules'):
+            rule_converter = None
+            converted_rules = None
 
-                for rule in out:
+            if num_workers > 1:
+                # Streamed records are parsed completely first
+                records = list(records)
+                rule_converter = ParallelRuleConverter(extraction_rules, num_workers, stats)
+                converted_rules = rule_converter.imap(list(self._iter_style_rules(records)), rule_index)
+
+            try:
+                for rule in records:
                     if rule['type'] == 'style':
-                        self._addStyleRule(rule, extracted_variables, variables_to_extract)
+                        self._addStyleRule(rule, extracted_variables, extraction_rules, rule_index,
+                                           next(converted_rules) if converted_rules is not None else None)
+
+                        if write_rules_immediately:
+                            write_tree()
+                            self._clear_tree()
                     elif rule['type'] == 'comment':
                         # TODO: does not work anymore with tree structure, rewrite to insert comments in correct order
                         self._writeCommentRule(rule, write_line)
+                    elif rule['type'] == 'media':
+                        self._addMediaRule(rule, extracted_variables, extraction_rules, write_line, rule_index,
+                                           converted_rules)
+
+                        if write_rules_immediately:
+                            write_tree()
+                            self._clear_tree()
                     else:
                         raise AssertionError
-
-                # Write out variables in alphabetical order
-                extracted_variables_list = list(extracted_variables.items())
-                extracted_variables_list.sort()
-                write_line('/* Extracted variables should be inserted here */')
-                for variable_name, (variable_value, numOccurrences) in extracted_variables_list:
-                    print('Variable $%-32s = %-10s (x%d)' % (variable_name, variable_value, numOccurrences))
-                    write_line_vars('$%s = %s' % (variable_name, variable_value))
-
-                if extracted_variables_list:
+            finally:
+                if rule_converter is not None:
+                    rule_converter.close()
+
+        discovery = None
+        if discover_vars is not None:
+            with stats_stage('discover_vars'):
+                discovery = VariableDiscovery(discover_vars)
+                discovery.run(self._tree, extracted_variables)
+
+            for name, value, occurrences, unused_num_nodes, unused_selectors in discovery.variables:
+                extracted_variables[name] = [value, occurrences]
+
+        # Write out variables in alphabetical order
+        extracted_variables_list = list(extracted_variables.items())
+        extracted_variables_list.sort()
+        if not write_rules_immediately:
+            write_line('/* Extracted variables should be inserted here */')
+        for variable_name, (variable_value, numOccurrences) in extracted_variables_list:
+            result.messages.append('Variable $%-32s = %-10s (x%d)' % (variable_name, variable_value, numOccurrences))
+            write_line_vars('$%s = %s' % (variable_name, variable_value))
+
+        if discovery is not None:
+            result.messages.append('Discovered variables: %d of %d colors and lengths are used more than %d times'
+                                   % (len(discovery.variables), discovery.num_values, discover_vars))
+            for name, value, occurrences, num_nodes, selectors in discovery.variables:
+                result.messages.append('  $%-32s in %d rules, e.g. %s' % (name, num_nodes, '; '.join(selectors)))
+
+        result.variables = extracted_variables
+
+        if self._num_extraction_searches:
+            num_compilations = extraction_rules.compiler.num_compilations
+            result.messages.append('Extraction regexes: %d searches, %d compiled, %d compilations saved'
+                                   % (self._num_extraction_searches,
+                                      num_compilations,
+                                      max(0, self._num_extraction_searches - num_compilations)))
+
+        if self._num_media_rules:
+            result.messages.append('Media queries: %d @media blocks, %d grouped into blocks with the same query'
+                                   % (self._num_media_rules, self._num_grouped_media_rules))
+
+        if rule_index is not None:
+            result.messages.append('Incremental conversion: %d rules converted, %d unchanged'
+                                   % (rule_index.num_converted, rule_index.num_reused))
+
+        shared_blocks = None
+        if dedupe_blocks:
+            with stats_stage('dedupe_blocks'):
+                shared_blocks = SharedBlockExtractor()
+                shared_blocks.run(self._tree)
+
+            result.messages.append('Shared blocks: %d mixins, %d lines and %d bytes saved'
+                                   % (len(shared_blocks.mixins),
+                                      shared_blocks.num_lines_saved,
+                                      shared_blocks.num_bytes_saved))
+
+        with stats_stage('write'):
+            if not write_rules_immediately:
+                if extracted_variables_list and not self._compact_output:
                     write_line()
 
-                self._write_tree(write_line)
+                if shared_blocks is not None:
+                    # Mixins may call helper functions as well, which must be defined before the mixins are called
+                    mixin_lines = (line for unused_name, lines in shared_blocks.mixins for line in lines)
+                    self._write_helper_functions(out_emitter, mixin_lines)
+                    shared_blocks.write_mixins(out_emitter, compact=self._compact_output)
+
+                write_tree()
 
-        extracted_variable_names = set(extracted_variables.keys())
+            out_emitter.flush()
+            vars_out_emitter.flush()
 
-        for mapping in variables_to_extract.values():
+        for mapping in extraction_rules.variables_to_extract.values():
             for extraction_infos in mapping.values():
                 for unused_search_regex, variable_name in extraction_infos:
-                    if variable_name not in extracted_variable_names:
-                        print('WARNING: Variable %s not extracted, check regex' % variable_name,
-                              file=sys.stderr)
+                    if variable_name not in extracted_variables:
+                        result.warnings.append('WARNING: Variable %s not extracted, check regex' % variable_name)
+
+    def _iter_streaming_records(self, filename, css_parser):
+        with open(filename, 'rb') as f:
+            for statement in iter_css_statements(f):
+                for record in css_parser.parse_statement(statement):
+                    yield record
 
     @staticmethod
     def find_common_selector_parent(a, b):
+        """
+        Returns the longest common parent selector of two selectors, e.g. 'body' for 'body p' and 'body > div', or
+        None if they have no common parent.
+        """
         if ',' in a or ',' in b:
             raise AssertionError
 
-        a_split = list(filter(bool, a.split(' ')))
-        b_split = list(filter(bool, b.split(' ')))
-
-        if any((op in a_split or op in b_split) for op in OPERATORS):
-            # Merging rules with operators such as '>' not supported. Can they be written indented in Stylus? If so, then
-            # 1) that's awesome and 2) one could just merge each operator with the next list item here.
-            return None
+        a_split = Css2Stylus._split_selector(a)
+        b_split = Css2Stylus._split_selector(b)
 
         if a_split == b_split:
             raise AssertionError
 
-        last_equal_index = -1
-        for i in range(max(len(a_split), len(b_split))):
-            if a_split[i] != b_split[i]:
+        num_equal = 0
+        for a_part, b_part in zip(a_split, b_split):
+            if a_part != b_part:
                 break
 
-            last_equal_index = i
+            num_equal += 1
 
-        if last_equal_index == -1:
+        if not num_equal:
             # No common parent
             return None
 
-        # Some in-code unit testing :D
-        assert(a_split[:last_equal_index + 1] == b_split[:last_equal_index + 1])
+        return ' '.join(a_split[:num_equal])
 
-        return ' '.join(a_split[:last_equal_index + 1])
-
-    def _find_existing_parent(selector, _tree=None, _depth=0, _existing_matches=None):
-        raise AssertionError("abandoned")
+    def _find_or_create_nested_node(self, selector_list, parent=None):
         """
-        Recursively find node with a single selector that shares the same parent with the given selector. For example,
-        if selector is 'body p ul', and the current tree is self._tree={'body':{'p':{...}}}, then the 'p' dictionary
-        value should be returned.
-
-        In other words:
+        Returns the node of a selector list in the selector trie of indented style below the given node or the root,
+        creating missing nodes. Each level of the trie is a compound selector with the combinator before it (see
+        _split_selector). The selectors of a list share the nodes of their common parent, and the rest of each selector
+        goes into a single node below that:
 
-            self._tree =
-              body
-                p
-                  ...
+            'body .ui-btn > span, body .ui-bar' =>
 
-            self._find_existing_parent('body p ul') =>
-
-        The reverse example must work as well:
-
-            self._tree =
-              body
-                p
-                  ul
-                    ...
-
-            self._find_existing_parent('body p') => 'p'
+            body
+              .ui-btn > span
+              .ui-bar
         """
+        selector_splits = [self._split_selector(selector) for selector in selector_list]
 
-        # Start recursion with the top :)
-        if _tree is None:
-            outer_recursion = True
-            _tree = self._tree
-
-            # Tuples (depth, found dictionary)
-            _existing_matches = []
+        if len(selector_splits) == 1:
+            path = [(part,) for part in selector_splits[0]]
         else:
-            outer_recursion
+            # Every selector keeps at least its last part, the node can't be written as an empty selector
+            num_common = min(len(selector_split) for selector_split in selector_splits) - 1
+            first_split = selector_splits[0]
 
-        for selector_list in _tree:
-            if len(selector_list) == 1 and self.find_common_selector_parent(selector, selector_list[0]):
-                _existing_matches.append((_depth))
+            for i in range(num_common):
+                if any(selector_split[i] != first_split[i] for selector_split in selector_splits):
+                    num_common = i
+                    break
 
-        if outer_recursion:
-            # Sort by depth
-            _existing_matches.sort()
-            if _existing_matches:
-                return _existing_matches[0]
+            path = [(part,) for part in first_split[:num_common]]
+            path.append(tuple(' '.join(selector_split[num_common:]) for selector_split in selector_splits))
 
-            return None
-
-    def _find_or_create_nested_node(self, selector):
-        selector_split = self._split_selector(selector)
+        node = parent if parent is not None else self._tree
 
-        node = self._tree
+        for child_selector_list in path:
+            child = node.get_child(child_selector_list)
 
-        for selector_part in selector_split:
-            if (selector_part,) not in node:
-                node[(selector_part,)] = {'_properties' : [], '_order_index' : self._order_index}
+            if child is None:
+                child = SelectorTreeNode(child_selector_list, self._order_index)
                 self._order_index += 1
+                node.set_child(child)
 
-            node = node[(selector_part,)]
+            node = child
 
         return node
 
     @staticmethod
-    def merge(stylus_filename, vars_filename, out_merged_filename):
-        with open(stylus_filename, 'rU') as f:
-            lines = list(f)
+    def convert_batch(jobs, vars_modules, num_workers=None):
+        """
+        Converts many stylesheets with a pool of worker processes. The vars modules are only loaded and compiled once.
+
+        @param jobs:
+            List of dictionaries with keyword arguments for convert (filename, out_filename, vars_out_filename,
+            use_indented_style, ...)
+        @param num_workers:
+            Number of worker processes, defaults to the number of CPUs. With 1, everything runs in this process.
+        @return:
+            Generator of result dictionaries (filename, stdout, stderr, error) in the order of the jobs. 'error' is
+            None for successful conversions, otherwise the traceback.
+        """
+        import multiprocessing
 
-        with open(vars_filename, 'rU') as f:
-            vars_lines = list(f)
+        extraction_rules = ExtractionRules.from_modules(vars_modules)
 
-        for i in range(len(lines)):
-            if lines[i].rstrip() == '/* Extracted variables should be inserted here */':
-                lines[i:i+1] = vars_lines
-                break
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        num_workers = max(1, min(num_workers, len(jobs)))
+
+        if num_workers == 1:
+            _init_batch_worker(extraction_rules)
+            for job in jobs:
+                yield _run_batch_job(job)
         else:
-            print('Warning: Magic line for variables not found, inserting at top', file=sys.stderr)
-            lines = vars_lines + ['\n'] + lines
+            pool = multiprocessing.Pool(num_workers, initializer=_init_batch_worker, initargs=(extraction_rules,))
+            try:
+                for result in pool.imap(_run_batch_job, jobs):
+                    yield result
+            finally:
+                pool.terminate()
+                pool.join()
+
+    @staticmethod
+    def merge(stylus_filename, vars_filename, out_merged_filename, stats=None, use_mmap=False):
+        Css2Stylus.merge_many(stylus_filename, [(vars_filename, out_merged_filename)], stats=stats, use_mmap=use_mmap)
+
+    @staticmethod
+    def merge_many(stylus_filename, jobs, num_workers=1, stats=None, use_mmap=False):
+        """
+        Merges each of many vars files with the same Stylus file, which is only read and split at the magic line
+        once (see MergeTemplate). Output files that are unchanged are not written.
+
+        @param jobs:
+            List of (vars filename, merged output filename) tuples
+        @param num_workers:
+            Number of threads writing the outputs in parallel (merging is mostly file I/O, which doesn't hold the
+            interpreter lock).
+        @param use_mmap:
+            Memory-map the input files instead of reading them.
+        """
+        with (stats.stage('merge') if stats is not None else _no_stats_stage('merge')):
+            template = MergeTemplate.from_file(stylus_filename, use_mmap)
+            try:
+                for warning in template.warnings:
+                    print(warning, file=sys.stderr)
+
+                render_to_file = lambda job: template.render_to_file(job[0], job[1], use_mmap)
+
+                if num_workers > 1 and len(jobs) > 1:
+                    import multiprocessing.pool
+
+                    pool = multiprocessing.pool.ThreadPool(min(num_workers, len(jobs)))
+                    try:
+                        pool.map(render_to_file, jobs)
+                    finally:
+                        pool.terminate()
+                        pool.join()
+                else:
+                    for job in jobs:
+                        render_to_file(job)
+            finally:
+                template.close()
 
-        with open(out_merged_filename, 'wb') as merged_file:
-            merged_file.write(''.join(lines))
+    @staticmethod
+    def merge_text(stylus_text, vars_text):
+        """
+        Inserts the variables into the Stylus code at the magic line, in memory (see convert_css). Returns a tuple
+        (merged text, list of warnings).
+        """
+        template = MergeTemplate(stylus_text)
+        return template.render(vars_text), template.warnings
 
     @staticmethod
     def overlaps(range1, range2):
@@ -420,59 +3400,1171 @@ class Css2Stylus(object):
 
         return False
 
-    @staticmethod
-    def replace_variable_ranges(value, value_variable_ranges):
-        ret = value
-
-        for start, end in value_variable_ranges:
-            ret = ret[:start] + (end - start) * '_' + ret[end:]
-
-        return ret
 
     def _reset(self):
-        # Nested dictionary where the key '_properties' represents lists of property strings (full lines). Note that keys in the
-        # dictionaries are tuples of selectors. Nesting is only possible if that tuple contains exactly one selector.
-        # TODO: store the order of keys somehow (in a nested way, e.g. by subclassing dict and adding a list of keys defining the order)
-        self._tree = {}
+        # Root of the selector tree. Children of a node are identified by their tuple of selectors. Nesting is only
+        # possible if that tuple contains exactly one selector.
+        self._tree = SelectorTreeNode()
 
-        # Helper for sorting output
+        # Creation order of the tree nodes
         self._order_index = 0
 
-    @staticmethod
-    def _split_selector(selector):
-        return list(filter(bool, selector.split(' ')))
+        # Number of regex searches for variable values
+        self._num_extraction_searches = 0
+
+        # Number of @media blocks, and of those added to the node of an earlier block with the same query
+        self._num_media_rules = 0
+        self._num_grouped_media_rules = 0
+
+        # Number of style rules added to the tree, and the number when the last block of each @media tree node ended
+        # (see _addMediaRule)
+        self._num_style_rules = 0
+        self._media_rule_ends = {}
+
+        self._stats = None
+
+    @classmethod
+    def _split_selector(cls, selector):
+        """
+        Splits a selector into its compound selectors, each with the combinator before it as written in nested Stylus
+        selectors. Comments stay with the compound selector before them.
+
+            'body > .ui-btn a:not([title="x y"]) + span' => ['body', '> .ui-btn', 'a:not([title="x y"])', '+ span']
+        """
+        if cls._simple_selector_regex.match(selector):
+            if '>' not in selector and '+' not in selector and '~' not in selector:
+                return selector.split()
+
+            return [combinator + ' ' + compound if combinator else compound
+                    for combinator, compound in cls._simple_selector_part_regex.findall(selector)]
+
+        parts = []
+        current = []
+        combinator = ''
+        depth = 0
+
+        for token in cls._selector_token_regex.findall(selector):
+            if depth == 0:
+                stripped = token.strip()
+
+                if not stripped or stripped in SELECTOR_COMBINATORS:
+                    if current:
+                        parts.append(combinator + ''.join(current))
+                        current = []
+                        combinator = ''
+                    if stripped:
+                        combinator = stripped + ' '
+                    continue
+
+                if token.startswith('/*') and not current and parts:
+                    parts[-1] += ' ' + token
+                    continue
+
+            if token in ('[', '('):
+                depth += 1
+            elif token in (']', ')'):
+                depth -= 1
+
+            current.append(token)
+
+        if current:
+            parts.append(combinator + ''.join(current))
+
+        return parts
 
     def _writeCommentRule(self, rule, write_line):
-        write_line(rule['text'])
+        if not self._compact_output:
+            write_line(rule['text'])
+
+    def _write_helper_functions(self, emitter, property_lines):
+        """
+        Writes the definitions of the helper functions that are called in the property lines and not defined yet.
+        """
+        for line in property_lines:
+            if not self._undefined_helper_functions:
+                break
 
-    def _write_tree(self, write_line, _tree=None):
-        if _tree is None:
-            _tree = self._tree
+            for i, (name, definition_lines) in enumerate(self._undefined_helper_functions):
+                if line.startswith(name + '('):
+                    emitter.write_lines(definition_lines)
+                    del self._undefined_helper_functions[i]
+                    break
 
-        l = list(_tree.items())
+    @classmethod
+    def _compact_property_lines(cls, property_lines):
+        """
+        Returns the property lines without comments and the colons that can be left out (see _compact_property_regex).
+        """
+        regex = cls._compact_property_regex
+        compact_lines = []
 
-        # Sort, and ignore any additional attributes such as k=_order_index v=0
-        l.sort(key=lambda (k, v): v['_order_index'] if k not in TREE_ATTRIBUTE_NAMES else -1)
+        for line in property_lines:
+            if '/*' in line:
+                line = cls._value_comment_regex.sub(lambda match: match.group(1) or '', line)
 
-        for selector_list, sub_tree in l:
-            if selector_list in TREE_ATTRIBUTE_NAMES:
-                # This should not happen at top level
-                assert(_tree is not self._tree)
+            compact_lines.append(regex.sub(r'\1 ', line))
 
-                # This is not a selector list, but additional attributes
-                continue
+        return compact_lines
 
-            write_line()
+    def _write_tree(self, emitter):
+        base_indent = emitter.indent
+
+        for depth, node in self._tree.walk():
+            emitter.indent = base_indent + depth
+
+            if self._compact_output:
+                emitter.write_lines(node.selector_list)
+                emitter.indent += 1
+                emitter.write_lines(self._compact_property_lines(node.properties))
+            else:
+                emitter.write_line()
+                emitter.write_lines(node.selector_list)
+                emitter.indent += 1
+                emitter.write_lines(node.properties)
+
+        emitter.indent = base_indent
+
+class ConversionWatcher(object):
+    """
+    Watch mode: keeps the parsed stylesheet and the compiled extraction rules in memory and only re-runs the stages
+    affected by a file change. Changes of the input CSS or a vars module run convert (and merge), changes of the vars
+    file only run merge. Files are polled because there's no portable file notification API, and a burst of changes
+    (e.g. an editor saving several files) is handled once when no further change happened for the debounce time.
+    """
+
+    def __init__(self, filename, out_filename, vars_out_filename, vars_modules, use_indented_style, parser='cssutils',
+                 incremental=False, atomic=False, vars_filename=None, merged_filename=None, poll_interval=0.2,
+                 debounce=0.3, dedupe_blocks=False, discover_vars=None, output_profile='verbose'):
+        self.filename = filename
+        self.out_filename = out_filename
+        self.vars_out_filename = vars_out_filename
+        self.vars_modules = vars_modules or []
+        self.use_indented_style = use_indented_style
+        self.parser = parser
+        self.incremental = incremental
+        self.atomic = atomic
+        self.vars_filename = vars_filename
+        self.merged_filename = merged_filename
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.dedupe_blocks = dedupe_blocks
+        self.discover_vars = discover_vars
+        self.output_profile = output_profile
+
+        self._converter = Css2Stylus()
+        self._records = None
+        self._extraction_rules = None
+
+        # Filename => (modification time, size) at the last poll
+        self._file_states = {}
+
+        # Stages that failed and must be retried with the next change
+        self._failed_stages = set()
+
+    def _get_watched_files(self):
+        """
+        Returns a dictionary filename => stage to re-run if the file changes.
+        """
+        watched_files = {self.filename : 'parse'}
+
+        if self._extraction_rules is not None:
+            for filename in self._extraction_rules.get_source_filenames():
+                watched_files[filename] = 'load_rules'
+
+        if self.vars_filename and self.merged_filename:
+            watched_files[self.vars_filename] = 'merge'
+
+        return watched_files
+
+    _get_file_state = staticmethod(_get_file_state)
+
+    def poll(self):
+        """
+        Returns the set of stages that need to be re-run because of file changes since the last poll.
+        """
+        stages = set()
+
+        for filename, stage in self._get_watched_files().items():
+            state = self._get_file_state(filename)
+
+            # Files seen for the first time (e.g. vars modules after importing them) are not a change
+            if filename in self._file_states and self._file_states[filename] != state:
+                stages.add(stage)
+
+            self._file_states[filename] = state
+
+        return stages
+
+    def run_stages(self, stages):
+        """
+        Runs the given stages and the ones depending on them ('parse' and 'load_rules' => 'convert' => 'merge').
+        """
+        import time
+
+        start_time = time.time()
+
+        if self._extraction_rules is None:
+            stages = stages | set(['load_rules'])
+        if self._records is None:
+            stages = stages | set(['parse'])
+
+        if 'load_rules' in stages:
+            # Import the changed modules again
+            for vars_module in self.vars_modules:
+                sys.modules.pop(vars_module, None)
+
+            self._extraction_rules = ExtractionRules.from_modules(self.vars_modules)
+            stages = stages | set(['convert'])
+
+        if 'parse' in stages:
+            with open(self.filename, 'rb') as f:
+                self._records = list(PARSERS[self.parser]().parse(f.read()))
+
+            stages = stages | set(['convert'])
+
+        if 'convert' in stages:
+            self._converter.convert(filename=self.filename,
+                                    out_filename=self.out_filename,
+                                    vars_out_filename=self.vars_out_filename,
+                                    vars_modules=None,
+                                    use_indented_style=self.use_indented_style,
+                                    parser=self.parser,
+                                    extraction_rules=self._extraction_rules,
+                                    incremental=self.incremental,
+                                    records=self._records,
+                                    atomic=self.atomic,
+                                    dedupe_blocks=self.dedupe_blocks,
+                                    discover_vars=self.discover_vars,
+                                    output_profile=self.output_profile)
+
+            stages = stages | set(['merge'])
+
+        if 'merge' in stages and self.vars_filename and self.merged_filename:
+            Css2Stylus.merge(stylus_filename=self.out_filename,
+                             vars_filename=self.vars_filename,
+                             out_merged_filename=self.merged_filename)
+
+        print('Watch: ran %s in %d ms' % (', '.join(stage
+                                                    for stage in ('load_rules', 'parse', 'convert', 'merge')
+                                                    if stage in stages),
+                                          (time.time() - start_time) * 1000))
+
+    def run(self):
+        """
+        Converts once, then watches the files until interrupted with Ctrl+C.
+        """
+        import time
+
+        pending_stages = set()
+        last_change_time = None
+
+        self.poll()
+        self._run_stages_safely(set(['load_rules', 'parse']))
+        print('Watching for changes, press Ctrl+C to stop')
+
+        try:
+            while True:
+                time.sleep(self.poll_interval)
+
+                stages = self.poll()
+                if stages:
+                    pending_stages |= stages
+                    last_change_time = time.time()
+                elif pending_stages and time.time() - last_change_time >= self.debounce:
+                    self._run_stages_safely(pending_stages)
+                    pending_stages = set()
+        except KeyboardInterrupt:
+            pass
+
+    def _run_stages_safely(self, stages):
+        stages = stages | self._failed_stages
+
+        try:
+            self.run_stages(stages)
+            self._failed_stages = set()
+        except Exception:
+            # Keep watching, the user will probably fix the error and save again
+            traceback.print_exc()
+            self._failed_stages = stages
+
+class ConversionServer(object):
+    """
+    Server mode: runs convert and merge requests of many short-lived clients (see send_server_request) on a pool of
+    worker processes, so that they don't pay Python startup, imports and loading of the vars modules each time. The
+    workers keep the loaded extraction rules and the parsed records of recently converted stylesheets between
+    requests.
+
+    The protocol is one JSON object per line, one request per connection:
+
+        {"command": "convert" or "merge", "options": {keyword arguments}, "cwd": ..., "stats": false, "timeout": 60,
+         "token": ...}
+        {"command": "status", "token": ...}
+
+    The response has "ok", "error" and for jobs the captured "stdout" and "stderr" and the "stats" report. Requests
+    run code of the vars modules they name, so only the user who started the server may send them: the Unix socket is
+    only accessible by that user, and TCP requests must contain the token. Options that aren't in SERVER_JOB_OPTIONS are
+    rejected.
+
+    @param address:
+        Unix socket filename, or (host, port) tuple for TCP. Use a localhost address.
+    @param token:
+        Secret that every request must contain, required for TCP (see get_server_token_filename).
+    @param vars_modules:
+        Vars modules loaded by every worker at startup. Requests with other modules work as well, they're loaded
+        when first needed.
+    @param num_workers:
+        Number of worker processes, defaults to the number of CPUs.
+    @param queue_size:
+        Number of requests that may wait for a free worker. Further requests are rejected right away with a "busy"
+        error instead of piling up (back-pressure), clients should retry later.
+    @param timeout:
+        Default number of seconds after which a request fails with a "timeout" error. The job itself can't be
+        interrupted and keeps its worker until finished, but its slot is free again, so that jobs lost with a worker
+        process that died don't make the server busy forever.
+    """
+
+    def __init__(self, address, vars_modules=None, num_workers=None, queue_size=16, timeout=60, token=None):
+        import multiprocessing
+        import threading
+        import time
+
+        if token is None and not isinstance(address, basestring):
+            raise ValueError('A TCP server needs a token')
+
+        self.address = address
+        self.token = token
+        self.vars_modules = vars_modules or []
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        # Free slots for running and waiting jobs
+        self._slots = threading.Semaphore(self.num_workers + queue_size)
+
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._counters = {'pending' : 0, 'completed' : 0, 'failed' : 0, 'rejected' : 0, 'timed_out' : 0,
+                          'job_seconds' : 0.0}
+
+        self._pool = multiprocessing.Pool(self.num_workers,
+                                          initializer=_init_server_worker,
+                                          initargs=(self.vars_modules,))
+        self._socket_server = self._create_socket_server()
+
+    def _create_socket_server(self):
+        import json
+        import SocketServer
+
+        conversion_server = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                except ValueError:
+                    response = {'ok' : False, 'error' : 'Invalid request'}
+                else:
+                    response = conversion_server.handle_request(request)
+
+                self.wfile.write(json.dumps(response) + '\n')
+
+        if isinstance(self.address, basestring):
+            if os.path.exists(self.address):
+                try:
+                    send_server_request(self.address, {'command' : 'status'})
+                except EnvironmentError:
+                    # Left over from a server that didn't exit cleanly
+                    os.remove(self.address)
+                else:
+                    raise ValueError('Another server is already listening on %s' % self.address)
+
+            server_class = SocketServer.ThreadingUnixStreamServer
+        else:
+            server_class = SocketServer.ThreadingTCPServer
+
+        server = server_class(self.address, RequestHandler, bind_and_activate=False)
+        server.allow_reuse_address = True
+        server.daemon_threads = True
+
+        # The socket file is created accessible by the user only, there's no moment where others could connect
+        old_umask = os.umask(0o177)
+        try:
+            server.server_bind()
+        finally:
+            os.umask(old_umask)
+
+        server.server_activate()
+
+        return server
+
+    def handle_request(self, request):
+        """
+        Handles a request dictionary and returns the response dictionary. Called by the handler thread of each
+        connection.
+        """
+        import hmac
+        import multiprocessing.pool
+
+        if self.token is not None:
+            token = request.get('token')
+            if not isinstance(token, unicode) or not hmac.compare_digest(token.encode('utf-8'), self.token):
+                return {'ok' : False, 'error' : 'Invalid token'}
+
+        command = request.get('command')
+
+        if command == 'status':
+            return dict(self.get_status(), ok=True, error=None)
+        elif command not in ('convert', 'merge'):
+            return {'ok' : False, 'error' : 'Invalid command %r' % command}
+
+        options = request.get('options', {})
+        if not isinstance(options, dict):
+            return {'ok' : False, 'error' : 'Invalid options'}
+
+        invalid_options = sorted(set(options) - SERVER_JOB_OPTIONS[command])
+        if invalid_options:
+            return {'ok' : False, 'error' : 'Invalid options: %s' % ', '.join(invalid_options)}
+
+        if not self._slots.acquire(False):
+            self._count('rejected')
+            return {'ok' : False, 'error' : 'busy'}
+
+        job = {'command' : command,
+               'options' : options,
+               'cwd' : request.get('cwd') or os.getcwd(),
+               'stats' : bool(request.get('stats'))}
+
+        def job_done(response):
+            # Also called if the request timed out, but not for jobs lost with a worker process
+            with self._lock:
+                self._counters['pending'] -= 1
+                self._counters['completed' if response['ok'] else 'failed'] += 1
+                self._counters['job_seconds'] += response['seconds']
+
+        with self._lock:
+            self._counters['pending'] += 1
+
+        try:
+            async_result = self._pool.apply_async(_run_server_job, (job,), callback=job_done)
+            return async_result.get(request.get('timeout') or self.timeout)
+        except multiprocessing.TimeoutError:
+            self._count('timed_out')
+            return {'ok' : False, 'error' : 'timeout'}
+        finally:
+            self._slots.release()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get_status(self):
+        """
+        Returns health and statistics of the server as dictionary.
+        """
+        import time
+
+        with self._lock:
+            counters = dict(self._counters)
+
+        num_jobs = counters['completed'] + counters['failed']
+        counters['mean_job_seconds'] = counters.pop('job_seconds') / num_jobs if num_jobs else None
+
+        return dict(counters,
+                    uptime_seconds=time.time() - self._start_time,
+                    workers=self.num_workers,
+                    queue_size=self.queue_size,
+                    vars_modules=self.vars_modules,
+                    pid=os.getpid())
+
+    def serve_forever(self):
+        self._socket_server.serve_forever()
+
+    def shutdown(self):
+        """
+        Stops serve_forever (call from another thread) and the worker processes.
+        """
+        self._socket_server.shutdown()
+        self.close()
+
+    def close(self):
+        self._socket_server.server_close()
+        self._pool.terminate()
+        self._pool.join()
+
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.remove(self.address)
+
+def send_server_request(address, request, timeout=None, token=None):
+    """
+    Sends a request dictionary to a ConversionServer and returns the response dictionary.
+
+    @param address:
+        Unix socket filename or (host, port) tuple, see ConversionServer
+    @param timeout:
+        Socket timeout in seconds, None to wait for the server's timeout.
+    @param token:
+        Token of the server, if it has one
+    """
+    import json
+    import socket
+
+    if token is not None:
+        request = dict(request, token=token)
+
+    sock = socket.socket(socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall(json.dumps(request) + '\n')
+
+        with contextlib.closing(sock.makefile('rb')) as f:
+            line = f.readline()
+    finally:
+        sock.close()
+
+    if not line:
+        raise IOError('Server closed the connection without a response')
+
+    return json.loads(line)
+
+class UnitTestMethods(object):
+    """
+    Tests of the UnitTest case, which is only created in unittest mode (see run_unit_tests) so that the other modes
+    don't import unittest.
+    """
 
-            for selector in selector_list:
-                write_line(selector)
+    @staticmethod
+    def _generate_stylesheet(num_rules, seed):
+        import random
+        rnd = random.Random(seed)
+
+        selector_parts = ('body', 'div', 'p', 'a', 'li', '.ui-btn', '.ui-bar-a', '#main', 'a:hover', 'A.Foo',
+                          '[type="text"]', "input[ type = 'x' ]", 'li:first-child', '*')
+        values = ('red', '#FFFFFF', '#aabbcc', '#3c3c3c', '0px', '.5em', '-0.50px', '+1px', '10.0px', '100%',
+                  'rgba(0,0,0,.3)', 'url(images/x.png)', "url( 'a b.png' )", '"Helvetica Neue",Arial , sans-serif',
+                  '12px/1.5 Arial', '0 1px 4px #000000', 'inset 0 1px 0 rgba(255,255,255,.3)',
+                  '-webkit-linear-gradient( #3c3c3c /*{a-bar-background-start}*/, #111 /*{a-bar-background-end}*/)',
+                  'calc(100% - 10px)', 'block !important', '1PX solid RED /* comment */')
+        names = ('color', 'background', 'margin', 'Padding', 'font', 'border-radius', '-moz-border-radius',
+                 '-webkit-box-shadow', 'box-shadow', 'background-image', 'text-shadow', 'width')
+
+        lines = []
+        for i in range(num_rules):
+            if rnd.random() < 0.1:
+                lines.append('/* Comment %d */' % i)
+
+            selectors = []
+            for j in range(rnd.randint(1, 3)):
+                parts = [rnd.choice(selector_parts) for k in range(rnd.randint(1, 4))]
+                selectors.append(rnd.choice(('  ', ' > ', '+', ' ')).join(parts))
+
+            declarations = ['%s : %s' % (rnd.choice(names), rnd.choice(values)) for j in range(rnd.randint(0, 5))]
+            lines.append('%s {%s}' % (' , '.join(selectors), ';'.join(declarations)))
+
+            if rnd.random() < 0.05:
+                lines.append('@media screen and (min-width:%dpx) { p { color: red } }' % rnd.randint(1, 999))
+
+        return '\n'.join(lines)
+
+    def test_parser_backends(self):
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            inputs = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.css')]
+            for seed in range(2):
+                inputs.append(os.path.join(temp_dir, 'generated%d.css' % seed))
+                with open(inputs[-1], 'wb') as f:
+                    f.write(self._generate_stylesheet(300, seed))
+
+            # Escapes, comments around combinators and rules that both parsers drop
+            edge_cases = (r'.a\:b, #\31 23, .a\3A  b, .a\.b .c, #a\ b > .\-c { color: red }' '\n'
+                          'html>/**/body, a>/**/ b, a/**/>b, a /**/b, a/**/ b, a /**/> b { color: red }\n'
+                          'a/**/, /**/b, a:hover/**/, a > b/**/ c { color: red }\n'
+                          'a:not(.b) { color: red }\n'
+                          'a:not(.b, .c) { color: red }\n'
+                          'a:not(a > b) { color: red }\n'
+                          'a/**/b { color: red }\n'
+                          'a! { color: red }\n'
+                          'a, { color: red }\n'
+                          '.u { unicode-range: U+0025-00FF, u+4?? }\n'
+                          '@media screen and (max-width:100PX) and (min-width: 1.50EM) { p { color: red } }\n')
+            inputs.append(os.path.join(temp_dir, 'edge_cases.css'))
+            with open(inputs[-1], 'wb') as f:
+                f.write(edge_cases)
+
+            # Both parsers give the same message for each dropped rule
+            warnings = []
+            for parser in sorted(PARSERS):
+                result = Css2Stylus().convert_css(edge_cases, parser=parser)
+                warnings.append([warning for warning in result.warnings if warning.startswith('ERROR\tSelectorList')])
+            self.assertEqual(5, len(warnings[0]))
+            self.assertEqual(warnings[0], warnings[1])
+            self.assertIn('  unicode-range: u+0025-00ff, u+4??\n', result.rules_text)
+
+            # Statements are decoded with the encoding of @charset, unknown ones fall back to UTF-8
+            latin1_css = ('@charset "iso-8859-1";\n'
+                          '.a:before { content: "\xe9" }\n'
+                          '@media print { .b { content: "\xe9" } }\n')
+            records = [list(PARSERS[parser](warn=lambda message: None).parse(latin1_css)) for parser in sorted(PARSERS)]
+            self.assertEqual(records[0], records[1])
+            self.assertEqual(u'"\xe9"', records[1][1]['rules'][0]['properties'][0][1])
+
+            parser_warnings = []
+            self.assertEqual([{'type' : 'style', 'selector_list' : (u'.a',), 'properties' : [(u'color', u'red', '')]}],
+                             list(BuiltinParser(warn=parser_warnings.append).parse('@charset "x-unknown";\n'
+                                                                                   '.a { color: red }\n')))
+            self.assertEqual(['Unknown @charset encoding: x-unknown, decoding as UTF-8', 'Unsupported rule type: 2'],
+                             parser_warnings)
+
+            for filename in inputs:
+                for use_indented_style in (False, True):
+                    outputs = []
+
+                    for parser in sorted(PARSERS):
+                        out_filename = os.path.join(temp_dir, 'out.%s.styl' % parser)
+                        vars_out_filename = os.path.join(temp_dir, 'vars.%s.styl' % parser)
+                        Css2Stylus().convert(filename=filename,
+                                             out_filename=out_filename,
+                                             vars_out_filename=vars_out_filename,
+                                             vars_modules=['some_test_rules'],
+                                             use_indented_style=use_indented_style,
+                                             parser=parser)
+
+                        with open(out_filename, 'rb') as f:
+                            with open(vars_out_filename, 'rb') as vars_f:
+                                outputs.append((f.read(), vars_f.read()))
+
+                    self.assertEqual(outputs[0], outputs[1], filename)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_iter_css_statements(self):
+        css = ('/* a { b } ; */ @import "x;y.css";\n'
+               'a:after { content: "}\\"{;" /* } */ }\n'
+               "b[title='\\'}'] { content: '/*' }\n"
+               '/**/@media print { p { color: red } /* ; */ }\n'
+               'c { content: "\\\\" }   /* last */\n'
+               'd { margin: 0 }')
+        expected = ['/* a { b } ; */',
+                    '@import "x;y.css";',
+                    'a:after { content: "}\\"{;" /* } */ }',
+                    "b[title='\\'}'] { content: '/*' }",
+                    '/**/',
+                    '@media print { p { color: red } /* ; */ }',
+                    'c { content: "\\\\" }',
+                    '/* last */',
+                    'd { margin: 0 }']
+
+        # Tokens and escapes split across chunks give the same statements
+        for chunk_size in range(1, len(css) + 2):
+            self.assertEqual(expected, list(iter_css_statements(StringIO(css), chunk_size)), chunk_size)
+
+    def test_convert_css(self):
+        import shutil
+        import tempfile
+
+        css = self._generate_stylesheet(200, 0) + '\n@font-face { font-family: x }\np.api { color: #3c3c3c }'
+        extraction_rules = ExtractionRules({r'p\.api' : {r'color' : [(r'<COLOR>', 'p-color')]},
+                                            r'.*' : {r'width' : [(r'calc\(<VALUE> -', 'calc-width')]}})
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'test.css')
+            with open(filename, 'wb') as f:
+                f.write(css)
+
+            out_filenames = [os.path.join(temp_dir, name) for name in ('out.styl', 'vars.styl', 'merged.styl')]
+
+            for parser in sorted(PARSERS):
+                for use_indented_style in (False, True):
+                    for streaming in (False, True):
+                        with captured_output() as (stdout, stderr):
+                            Css2Stylus().convert(filename=filename,
+                                                 out_filename=out_filenames[0],
+                                                 vars_out_filename=out_filenames[1],
+                                                 vars_modules=None,
+                                                 use_indented_style=use_indented_style,
+                                                 streaming=streaming,
+                                                 parser=parser,
+                                                 extraction_rules=extraction_rules)
+                            Css2Stylus.merge(*out_filenames)
+
+                        outputs = []
+                        for out_filename in out_filenames:
+                            with open(out_filename, 'rb') as f:
+                                outputs.append(f.read())
+
+                        # Text and file-like input, nothing printed
+                        for css_input in (css, StringIO(css)):
+                            with captured_output() as (api_stdout, api_stderr):
+                                result = Css2Stylus().convert_css(css_input,
+                                                                  extraction_rules,
+                                                                  use_indented_style=use_indented_style,
+                                                                  parser=parser,
+                                                                  streaming=streaming)
+                                merged, merge_warnings = Css2Stylus.merge_text(result.rules_text, result.vars_text)
+
+                            self.assertEqual(('', ''), (api_stdout.getvalue(), api_stderr.getvalue()))
+                            self.assertEqual(outputs, [result.rules_text, result.vars_text, merged])
+                            self.assertEqual([], merge_warnings)
+                            self.assertEqual(['Creating Stylus file'] + result.messages,
+                                             stdout.getvalue().splitlines())
+                            self.assertEqual(sorted(stderr.getvalue().splitlines()), sorted(result.warnings))
+                            self.assertIn('Unsupported rule type: 5', result.warnings)
+                            self.assertEqual('#3c3c3c', result.variables['p-color'][0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+        # Streamed statements are parsed after the @charset and @namespace statements, and rules with the same
+        # selectors are kept apart like when they're written right away
+        css = ('@charset "utf-8";\n'
+               '@namespace svg url(http://www.w3.org/2000/svg);\n'
+               'svg|a { color: red }\n'
+               '.a { color: red }\n'
+               '.b { color: blue }\n'
+               '.a { margin: 0 }\n'
+               '@media print { .a { color: black } .a { margin: 1px } }\n')
+        results = [Css2Stylus().convert_css(css, parser='cssutils', streaming=streaming) for streaming in (False, True)]
+        self.assertEqual(results[0].rules_text, results[1].rules_text)
+        self.assertEqual(['Unsupported rule type: 2', 'Unsupported rule type: 10'], results[1].warnings)
+        self.assertIn('svg|a\n', results[1].rules_text)
+        self.assertEqual(2, results[1].rules_text.count('\n.a\n'))
+
+        self.assertEqual(('a\n$x = 1\nb\n', []),
+                         Css2Stylus.merge_text('a\r\n/* Extracted variables should be inserted here */\r\nb\r\n',
+                                               '$x = 1\n'))
+        self.assertEqual(('$x = 1\n\na\n', ['Warning: Magic line for variables not found, inserting at top']),
+                         Css2Stylus.merge_text('a\n', '$x = 1\n'))
+
+    def test_conversion_server(self):
+        import shutil
+        import stat
+        import tempfile
+        import threading
+        import time
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'test.css')
+            with open(filename, 'wb') as f:
+                f.write(self._generate_stylesheet(100, 0))
+
+            options = {'filename' : filename,
+                       'out_filename' : os.path.join(temp_dir, 'out.styl'),
+                       'vars_out_filename' : os.path.join(temp_dir, 'vars.styl'),
+                       'vars_modules' : ['some_test_rules'],
+                       'use_indented_style' : True}
+
+            with captured_output() as (stdout, stderr):
+                Css2Stylus().convert(filename=filename,
+                                     out_filename=os.path.join(temp_dir, 'expected.styl'),
+                                     vars_out_filename=os.path.join(temp_dir, 'expected.vars.styl'),
+                                     vars_modules=['some_test_rules'],
+                                     use_indented_style=True)
+
+            address = os.path.join(temp_dir, 'server.sock')
+            server = ConversionServer(address, vars_modules=['some_test_rules'], num_workers=2, queue_size=1)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                # Only the user can connect, and only known options are accepted
+                self.assertEqual(0o600, stat.S_IMODE(os.stat(address).st_mode))
+                response = send_server_request(address, {'command' : 'convert', 'options' : dict(options, evil=1)})
+                self.assertEqual('Invalid options: evil', response['error'])
+
+                # Twice, the second conversion reuses the parsed stylesheet in one of the workers
+                for unused_i in range(2):
+                    response = send_server_request(address, {'command' : 'convert', 'options' : options})
+                    self.assertTrue(response['ok'], response['error'])
+                    self.assertEqual(stdout.getvalue(), response['stdout'])
+
+                    for name, expected_name in (('out.styl', 'expected.styl'), ('vars.styl', 'expected.vars.styl')):
+                        with open(os.path.join(temp_dir, name), 'rb') as f:
+                            with open(os.path.join(temp_dir, expected_name), 'rb') as expected_f:
+                                self.assertEqual(expected_f.read(), f.read())
+
+                # The command line prints the stats report of the server
+                import json
+                import subprocess
+
+                stats_css_filename = os.path.join(temp_dir, 'stats.css')
+                with open(stats_css_filename, 'wb') as f:
+                    f.write('.ui-focus { box-shadow: 0 0 12px red }\n'
+                            '.ui-bar-a { background-image: none }\n')
+
+                stats = ConversionStats()
+                with captured_output():
+                    Css2Stylus().convert(filename=stats_css_filename,
+                                         out_filename=os.path.join(temp_dir, 'expected.styl'),
+                                         vars_out_filename=os.path.join(temp_dir, 'expected.vars.styl'),
+                                         vars_modules=['some_test_rules'],
+                                         use_indented_style=True,
+                                         stats=stats)
+                get_pattern_counts = lambda report: sorted((pattern['variable'], pattern['searches'], pattern['matches'])
+                                                           for pattern in report['property_patterns'])
+
+                stats_filename = os.path.join(temp_dir, 'stats.json')
+                script_filename = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+                subprocess.check_call([sys.executable, script_filename, 'convert', '--socket', address,
+                                       '--input', stats_css_filename, '--output', options['out_filename'],
+                                       '--vars-output', options['vars_out_filename'],
+                                       '--vars-module', 'some_test_rules', '--stats-json', stats_filename],
+                                      cwd=os.path.dirname(script_filename),
+                                      stdout=subprocess.PIPE)
+                with open(stats_filename, 'rb') as f:
+                    report = json.load(f)
+
+                self.assertEqual([('invalid-regex-example-variable', 0, 0),
+                                  ('my-box-shadow', 1, 1),
+                                  ('my-gradient-end', 1, 0),
+                                  ('my-gradient-start', 1, 0)],
+                                 get_pattern_counts(report))
+                self.assertEqual(get_pattern_counts(json.loads(json.dumps(stats.to_dict()))),
+                                 get_pattern_counts(report))
+
+                response = send_server_request(address,
+                                               {'command' : 'merge',
+                                                'options' : {'stylus_filename' : 'out.styl',
+                                                             'vars_filename' : 'vars.styl',
+                                                             'out_merged_filename' : 'merged.styl'},
+                                                'cwd' : temp_dir,
+                                                'stats' : True})
+                self.assertTrue(response['ok'], response['error'])
+                self.assertEqual(['merge'], [stage['name'] for stage in response['stats']['stages']])
+                self.assertTrue(os.path.exists(os.path.join(temp_dir, 'merged.styl')))
+
+                response = send_server_request(address, {'command' : 'merge',
+                                                         'options' : {'stylus_filename' : 'missing.styl',
+                                                                      'vars_filename' : 'vars.styl',
+                                                                      'out_merged_filename' : 'merged.styl'},
+                                                         'cwd' : temp_dir})
+                self.assertFalse(response['ok'])
+                self.assertIn('IOError', response['error'])
+
+                # Back-pressure: with all slots taken, requests are rejected right away
+                for unused_i in range(3):
+                    server._slots.acquire()
+                self.assertEqual('busy', send_server_request(address, {'command' : 'convert',
+                                                                       'options' : options})['error'])
+                for unused_i in range(3):
+                    server._slots.release()
+
+                # A bigger stylesheet that isn't parsed yet
+                slow_filename = os.path.join(temp_dir, 'slow.css')
+                with open(slow_filename, 'wb') as f:
+                    f.write(self._generate_stylesheet(2000, 1))
+
+                self.assertEqual('timeout', send_server_request(address, {'command' : 'convert',
+                                                                          'options' : dict(options,
+                                                                                           filename=slow_filename),
+                                                                          'timeout' : 0.001})['error'])
+
+                # The timed out job still finishes (wait generously, machines running the tests may be slow)
+                for unused_i in range(600):
+                    status = send_server_request(address, {'command' : 'status'})
+                    if not status['pending']:
+                        break
+                    time.sleep(0.1)
+
+                self.assertEqual((5, 1, 1, 1), (status['completed'], status['failed'], status['rejected'],
+                                                status['timed_out']))
+                self.assertEqual(2, status['workers'])
+                self.assertFalse(send_server_request(address, {'command' : 'unknown'})['ok'])
+
+                # Jobs lost with a worker process that died free their slot, so the server doesn't stay busy
+                with open(os.path.join(temp_dir, 'dying_vars.py'), 'wb') as f:
+                    f.write('import os\nos._exit(1)\n')
+
+                dying_options = dict(options, vars_modules=['dying_vars'])
+                for unused_i in range(3):
+                    self.assertEqual('timeout', send_server_request(address, {'command' : 'convert',
+                                                                              'options' : dying_options,
+                                                                              'cwd' : temp_dir,
+                                                                              'timeout' : 1})['error'])
+
+                response = send_server_request(address, {'command' : 'convert', 'options' : options})
+                self.assertTrue(response['ok'], response['error'])
+            finally:
+                server.shutdown()
+                thread.join()
 
-            for property_line in sub_tree['_properties']:
-                write_line('  ' + property_line)
+            self.assertFalse(os.path.exists(address))
 
-            self._write_tree(lambda s='': write_line('  ' + s), _tree=sub_tree)
+            # TCP requests must have the token
+            self.assertRaises(ValueError, ConversionServer, ('127.0.0.1', 0))
+            server = ConversionServer(('127.0.0.1', 0), num_workers=1, token='secret')
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                address = server._socket_server.server_address
+                for token in (None, 'wrong'):
+                    self.assertEqual('Invalid token', send_server_request(address, {'command' : 'status'},
+                                                                          token=token)['error'])
+                self.assertTrue(send_server_request(address, {'command' : 'status'}, token='secret')['ok'])
+            finally:
+                server.shutdown()
+                thread.join()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_merge_many(self):
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            stylus_filename = os.path.join(temp_dir, 'rules.styl')
+            with open(stylus_filename, 'wb') as f:
+                f.write('body\r\n  color: $color\r\n/* Extracted variables should be inserted here */ \r\np\r\n')
+
+            jobs = []
+            for i in range(5):
+                jobs.append((os.path.join(temp_dir, 'theme%d.vars.styl' % i),
+                             os.path.join(temp_dir, 'theme%d.styl' % i)))
+                with open(jobs[-1][0], 'wb') as f:
+                    f.write('$color = #%06x\n' % i)
+
+            for use_mmap in (False, True):
+                for num_workers in (1, 3):
+                    Css2Stylus.merge_many(stylus_filename, jobs, num_workers=num_workers, use_mmap=use_mmap)
+
+                    for i, (unused_vars_filename, out_filename) in enumerate(jobs):
+                        with open(out_filename, 'rb') as f:
+                            self.assertEqual('body\n  color: $color\n$color = #%06x\np\n' % i, f.read())
+
+                    # Unchanged outputs are not written again
+                    for unused_vars_filename, out_filename in jobs:
+                        os.utime(out_filename, (0, 0))
+
+            self.assertEqual([0] * len(jobs), [os.path.getmtime(out_filename) for unused, out_filename in jobs])
+
+            template = MergeTemplate('a\n/* Extracted variables should be inserted here */')
+            self.assertEqual(('a\n$x = 1\n', []), (template.render('$x = 1\r\n'), template.warnings))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_shorthands(self):
+        index = build_shorthand_index()
+        self.assertEqual('border-radius', index['-webkit-border-radius'])
+        self.assertEqual('border-top-left-radius', index['-moz-border-radius-topleft'])
+        self.assertEqual('box-shadow', index['-ms-box-shadow'])
+        self.assertEqual('border-radius', index['-o-border-radius'])
+        self.assertNotIn('-khtml-box-shadow', index)
+
+        css = ('p { -webkit-border-radius: 1em; border-radius: 2em; -khtml-box-shadow: none }\n'
+               'a { color: red }\n'
+               'p { color: red; border-radius: 1em }\n'
+               'p { border-radius: 3em }\n')
+
+        result = Css2Stylus().convert_css(css, use_indented_style=True)
+        self.assertIn('p\n  -khtml-box-shadow: none\n  color: red\n  border-radius(1em)\n  border-radius(3em)\n',
+                      result.rules_text)
+
+        extraction_rules = ExtractionRules({}, vendor_prefixes=VENDOR_PREFIXES + ('-khtml-',))
+        result = Css2Stylus().convert_css(css, extraction_rules, use_indented_style=True)
+        self.assertIn('p\n  box-shadow(none)\n  color: red\n  border-radius(1em)\n  border-radius(3em)\n',
+                      result.rules_text)
+        self.assertNotEqual(ExtractionRules({}).get_fingerprint(), extraction_rules.get_fingerprint())
+
+    def test_shared_blocks(self):
+        def expand_mixins(stylus):
+            """
+            Replaces the mixin calls by the lines of the mixin, like Stylus does when compiling.
+            """
+            mixins = {}
+            lines = []
+            for line in stylus.split('\n'):
+                if re.match(r'^shared-block-\d+\(\)$', line):
+                    mixin_lines = mixins[line] = []
+                    # Blank line before the definition
+                    lines.pop()
+                elif mixins and line.startswith('  ') and lines[-1:] == [None]:
+                    mixin_lines.append(line[2:])
+                    continue
+                else:
+                    lines.append(line)
+                    continue
+                lines.append(None)
+
+            expanded_lines = []
+            for line in lines:
+                if line is None:
+                    continue
+
+                call = line.lstrip(' ')
+                if call in mixins:
+                    indent = line[:len(line) - len(call)]
+                    expanded_lines.extend(indent + mixin_line for mixin_line in mixins[call])
+                else:
+                    expanded_lines.append(line)
+
+            return '\n'.join(expanded_lines)
+
+        swatch = ('border: 1px solid #222; background: %s; font-family: Helvetica, Arial, sans-serif; '
+                  'text-shadow: 0 1px 1px #111; color: #fff')
+        heading = 'font-weight: bold; margin: .6em 0; white-space: nowrap; overflow: hidden; text-overflow: ellipsis'
+        css = ('.ui-btn-up-a { %s }\n' % (swatch % '#333') +
+               '.ui-btn-up-b { %s }\n' % (swatch % '#333') +
+               '.ui-btn-up-c { %s }\n' % (swatch % '#444') +
+               'body .ui-btn-up-d { %s }\n' % (swatch % '#555') +
+               '.ui-li-heading { %s }\n' % heading +
+               '.ui-li-desc { -webkit-border-radius: 1em; border-radius: 1em; color: red }\n'
+               'p .ui-li-desc { %s }\n' % heading)
+
+        for use_indented_style in (False, True):
+            expected = Css2Stylus().convert_css(css, use_indented_style=use_indented_style)
+            result = Css2Stylus().convert_css(css, use_indented_style=use_indented_style, dedupe_blocks=True)
+
+            self.assertIn('shared-block-1()', result.rules_text)
+            self.assertEqual(expected.rules_text, expand_mixins(result.rules_text))
+            self.assertEqual(expected.vars_text, result.vars_text)
+
+            bytes_saved = len(expected.rules_text) - len(result.rules_text)
+            lines_saved = expected.rules_text.count('\n') - result.rules_text.count('\n')
+            self.assertGreater(bytes_saved, 0)
+            self.assertIn('Shared blocks: 2 mixins, %d lines and %d bytes saved' % (lines_saved, bytes_saved),
+                          result.messages)
+
+        # The common suffix of blocks that differ in one line, and identical blocks
+        self.assertIn('shared-block-1()\n'
+                      '  font-family: Helvetica, Arial, sans-serif\n'
+                      '  text-shadow: 0 1px 1px #111\n'
+                      '  color: #fff\n',
+                      result.rules_text)
+        self.assertIn('.ui-btn-up-c\n'
+                      '  border: 1px solid #222\n'
+                      '  background: #444\n'
+                      '  shared-block-1()\n',
+                      result.rules_text)
+        self.assertIn('.ui-li-heading\n'
+                      '  shared-block-2()\n',
+                      result.rules_text)
+
+    def test_discover_vars(self):
+        css = ('.ui-bar-a { color: #FFF; border: 1px solid #222; font: 12px/1.5 Arial }\n'
+               '.ui-bar-b { color: #fff; margin: -1px 0 1px; background: url(#fff) #222 }\n'
+               '.ui-bar-b p { color: #fff; padding: 1px; width: calc(100% - 1px); text-shadow: 0 1px 1px #000 }\n'
+               '.ui-bar-c { color: red; font: 12px Arial }\n'
+               '.ui-bar-c span, .ui-bar-c a { top: 12px; border-color: rgba(0, 0, 0, .3) }\n')
+        extraction_rules = ExtractionRules({r'\.ui-bar-b' : {r'color' : [(r'<COLOR>', 'color-fff')]}})
+
+        for use_indented_style in (False, True):
+            plain = Css2Stylus().convert_css(css, extraction_rules, use_indented_style=use_indented_style,
+                                             parser='builtin')
+            result = Css2Stylus().convert_css(css, extraction_rules, use_indented_style=use_indented_style,
+                                              parser='builtin', discover_vars=1)
+
+            self.assertEqual('// THIS FILE IS AUTOGENERATED BY CSS2STYLUS\n'
+                             '// ----------------------------------------\n'
+                             '\n'
+                             '$color-222 = #222\n'
+                             '$color-fff = #fff\n'
+                             '$color-fff-2 = #fff\n'
+                             '$size-12px = 12px\n'
+                             '$size-1px = 1px\n',
+                             result.vars_text)
+            self.assertEqual(['#fff', 2], result.variables['color-fff-2'])
+            self.assertEqual(['1px', 5], result.variables['size-1px'])
+            self.assertIn('Discovered variables: 4 of 7 colors and lengths are used more than 1 times', result.messages)
+            self.assertIn('font: 12px/1.5 Arial', result.rules_text)
+            self.assertIn('width: calc(100% - 1px)', result.rules_text)
+            self.assertIn('background: url(#fff) $color-222', result.rules_text)
+
+            # Same rules with the values put back (#FFF counted as #fff)
+            values = dict(('$' + name, value) for name, (value, unused_count) in result.variables.items()
+                          if name != 'color-fff')
+            self.assertEqual(plain.rules_text.replace('#FFF', '#fff'), re.sub(r'\$[\w-]+',
+                                                      lambda match: values.get(match.group(), match.group()),
+                                                      result.rules_text))
+
+    def test_compiled_rules(self):
+        import json
+        import shutil
+        import tempfile
+
+        module_name = 'compiled_test_rules_%d' % os.getpid()
+        css = ('.ui-bar-a { color: #111; -ms-box-shadow: 0 0 1px #222 }\n'
+               '.ui-bar-a a { color: #111 }\n'
+               '.ui-btn { border: 1px solid #444 }\n')
+
+        temp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        try:
+            with open(module_name + '.py', 'wb') as f:
+                f.write("EXTRACT_VARIABLES = {r'\\.ui-bar-a( .*)?' : {'color' : [(r'<COLOR>', 'bar-color')]}}\n")
+
+            with open('rules.json', 'wb') as f:
+                json.dump({'EXTRACT_VARIABLES' : {'.ui-btn' : {'border' : [['solid\\s+<COLOR>', 'btn-border']]}},
+                           'VENDOR_PREFIXES' : ['-khtml-']},
+                          f)
+
+            with captured_output():
+                expected_rules = ExtractionRules.from_modules([module_name, 'rules.json'])
+                ExtractionRules.compile([module_name, 'rules.json'], 'compiled.json')
+            expected = Css2Stylus().convert_css(css, expected_rules, use_indented_style=True)
+
+            # Loaded without importing the module, with the same result
+            sys.modules.pop(module_name)
+            with captured_output() as (out, err):
+                compiled_rules = ExtractionRules.from_modules(['compiled.json'])
+            self.assertNotIn(module_name, sys.modules)
+            self.assertEqual('', err.getvalue())
+            self.assertEqual(expected_rules.get_fingerprint(), compiled_rules.get_fingerprint())
+
+            result = Css2Stylus().convert_css(css, compiled_rules, use_indented_style=True)
+            self.assertEqual(expected.rules_text, result.rules_text)
+            self.assertEqual(expected.vars_text, result.vars_text)
+            self.assertIn('box-shadow(', result.rules_text)
+
+            # Compiled again when a source changes
+            with open(module_name + '.py', 'wb') as f:
+                f.write("EXTRACT_VARIABLES = {r'\\.ui-bar-a( .*)?' : {'color' : [(r'<COLOR>', 'new-color')]}}\n")
+            os.utime(module_name + '.py', (0, 0))
+
+            with captured_output() as (out, err):
+                compiled_rules = ExtractionRules.from_modules(['compiled.json'])
+            self.assertIn('outdated', err.getvalue())
+            self.assertIn('$new-color = #111', Css2Stylus().convert_css(css, compiled_rules).vars_text)
+
+            with captured_output() as (out, err):
+                ExtractionRules.from_modules(['compiled.json'])
+            self.assertEqual('', err.getvalue())
+
+            # The same search regexes in different rules and modules share one compiled regex
+            with open(module_name + '_dup.py', 'wb') as f:
+                f.write("EXTRACT_VARIABLES = {r'\\.ui-bar-b' : {'color' : [(r'<COLOR>', 'bar-b-color')],\n"
+                        "                                       'border' : [(r'solid\\s+<COLOR>', 'bar-b-border')]}}\n")
+
+            with captured_output():
+                duplicate_rules = ExtractionRules.from_modules([module_name, module_name + '_dup', 'rules.json'])
+            self.assertEqual(2, duplicate_rules.compiler.num_compilations)
+            regexes = dict((extraction_rule.search_regex, set())
+                           for extraction_rule in duplicate_rules.extraction_rule_keys)
+            for extraction_rule in duplicate_rules.extraction_rule_keys:
+                regexes[extraction_rule.search_regex].add(id(extraction_rule.regex))
+            self.assertEqual({'<COLOR>' : 1, 'solid\\s+<COLOR>' : 1},
+                             dict((search_regex, len(ids)) for search_regex, ids in regexes.items()))
+
+            result = Css2Stylus().convert_css('.ui-bar-a { color: #111 }\n'
+                                              '.ui-bar-b { color: #666; border: 1px solid #777 }\n'
+                                              '.ui-btn { border: 1px solid #444 }\n',
+                                              duplicate_rules)
+            self.assertEqual(['#666', '#777', '#444'], [result.variables[name][0]
+                                                        for name in ('bar-b-color', 'bar-b-border', 'btn-border')])
+            self.assertIn('Extraction regexes: 4 searches, 2 compiled, 2 compilations saved', result.messages)
+
+            with open('invalid.json', 'wb') as f:
+                json.dump({'EXTRACT_VARIABLES' : {'a' : {'color' : [['red', 'red-color']]}}}, f)
+            self.assertRaises(ValueError, ExtractionRules.compile, ['invalid.json'], 'invalid-compiled.json')
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(temp_dir)
+            sys.modules.pop(module_name, None)
+            sys.modules.pop(module_name + '_dup', None)
 
-class UnitTest(unittest.TestCase):
     def test_find_common_selector_parent(self):
         f = Css2Stylus.find_common_selector_parent
 
@@ -488,8 +4580,612 @@ class UnitTest(unittest.TestCase):
         # Should return None if there is no common parent selector
         self.assertIsNone(f('p', 'body div'))
 
-        # Operators - should be supported at some point
-        self.assertIsNone(f('body p', 'body > p'))
+        # Combinators and whitespace in attribute selectors and strings
+        self.assertEqual('body',
+                         f('body p', 'body > p'))
+        self.assertEqual('ul > li',
+                         f('ul>li + a', 'ul > li ~ span'))
+        self.assertEqual('div[title="a b"]',
+                         f('div[title="a b"] p', 'div[title="a b"] > a:not([href="x > y"])'))
+        self.assertIsNone(f('a > p', 'b > p'))
+
+        s = Css2Stylus._split_selector
+        self.assertEqual(['body', '> .ui-btn', 'a:not([title="x y"])', '+ span', '~ i'],
+                         s('body > .ui-btn a:not([title="x y"]) + span~i'))
+        self.assertEqual(['li:nth-child(2n+1)', '> a /* x > y */', 'b'], s('li:nth-child(2n+1)>a /* x > y */ b'))
+
+    def test_selector_trie(self):
+        css = ('body { color: red }\n'
+               'body > p + a, body > p span { color: blue }\n'
+               'div[title="a b"] p { color: green }\n'
+               'body > p span, body > p + a { margin: 0 }\n'
+               'ul > li, ol > li { padding: 0 }\n'
+               'body > p { top: 0 }\n')
+        result = Css2Stylus().convert_css(css, use_indented_style=True, parser='builtin')
+
+        self.assertEqual('body\n'
+                         '  color: red\n'
+                         '  \n'
+                         '  > p\n'
+                         '    top: 0\n'
+                         '    \n'
+                         '    + a\n'
+                         '    span\n'
+                         '      color: blue\n'
+                         '    \n'
+                         '    span\n'
+                         '    + a\n'
+                         '      margin: 0\n'
+                         '\n'
+                         'div[title="a b"]\n'
+                         '  \n'
+                         '  p\n'
+                         '    color: green\n'
+                         '\n'
+                         'ul > li\n'
+                         'ol > li\n'
+                         '  padding: 0\n',
+                         result.rules_text.split('/* Extracted variables should be inserted here */\n\n')[1])
+
+    def test_media_rules(self):
+        css = ('.ui-bar-a { color: #111 }\n'
+               'a { margin: 1px }\n'
+               '@media print { div { display: none } }\n'
+               '@media screen and (max-width:600px) { .ui-bar-a { color: #222 } p { margin: 0 } }\n'
+               '@media screen and (max-width: 600px) { p { padding: 0 }\n'
+               '  @media (orientation:landscape) { a { top: 0 } } }\n')
+        extraction_rules = ExtractionRules({r'\.ui-bar-a' : {r'color' : [(r'<COLOR>', 'bar-color')]}})
+
+        for parser in sorted(PARSERS):
+            for use_indented_style in (False, True):
+                result = Css2Stylus().convert_css(css, use_indented_style=use_indented_style, parser=parser)
+
+                # The consecutive screen blocks are grouped. Rules with the same selectors are merged in indented style
+                # and kept apart in linear style, like outside of @media blocks.
+                self.assertEqual('.ui-bar-a\n'
+                                 '  color: #111\n'
+                                 '\n'
+                                 'a\n'
+                                 '  margin: 1px\n'
+                                 '\n'
+                                 '@media print\n'
+                                 '  \n'
+                                 '  div\n'
+                                 '    display: none\n'
+                                 '\n'
+                                 '@media screen and (max-width: 600px)\n'
+                                 '  \n'
+                                 '  .ui-bar-a\n'
+                                 '    color: #222\n'
+                                 '  \n'
+                                 '  p\n'
+                                 '    margin: 0\n' +
+                                 ('    padding: 0\n' if use_indented_style else '  \n  p\n    padding: 0\n') +
+                                 '  \n'
+                                 '  @media (orientation: landscape)\n'
+                                 '    \n'
+                                 '    a\n'
+                                 '      top: 0\n',
+                                 result.rules_text.split('/* Extracted variables should be inserted here */\n\n')[1])
+                self.assertIn('Media queries: 4 @media blocks, 1 grouped into blocks with the same query',
+                              result.messages)
+
+        # Blocks with a style rule between them aren't grouped, for class="a b" grouping would make the blue color win
+        # over the red one
+        for between in ('.a { color: blue }', '.b { color: blue }'):
+            result = Css2Stylus().convert_css('@media print { .a { color: red } }\n' + between +
+                                              '\n@media print { p { margin: 0 } }\n', parser='builtin')
+            self.assertEqual('@media print\n'
+                             '  \n'
+                             '  .a\n'
+                             '    color: red\n'
+                             '\n' +
+                             between.split(' {')[0] + '\n'
+                             '  color: blue\n'
+                             '\n'
+                             '@media print\n'
+                             '  \n'
+                             '  p\n'
+                             '    margin: 0\n',
+                             result.rules_text.split('/* Extracted variables should be inserted here */\n\n')[1])
+            self.assertIn('Media queries: 2 @media blocks, 0 grouped into blocks with the same query',
+                          result.messages)
+
+        # Same selectors at the top level are also kept apart in linear style
+        result = Css2Stylus().convert_css('.a { color: red }\n.b { color: blue }\n.a { margin: 0 }\n', parser='builtin')
+        self.assertEqual('.a\n'
+                         '  color: red\n'
+                         '\n'
+                         '.b\n'
+                         '  color: blue\n'
+                         '\n'
+                         '.a\n'
+                         '  margin: 0\n',
+                         result.rules_text.split('/* Extracted variables should be inserted here */\n\n')[1])
+
+        # Rules in @media blocks go through variable extraction
+        self.assertRaises(Exception, Css2Stylus().convert_css, css, extraction_rules, parser='builtin')
+        result = Css2Stylus().convert_css(css.replace('#111', '#222'), extraction_rules, parser='builtin')
+        self.assertEqual(['#222', 2], result.variables['bar-color'])
+
+        # Rules written while converting can't be grouped
+        result = Css2Stylus().convert_css(css, parser='builtin', streaming=True)
+        self.assertEqual(2, result.rules_text.count('@media screen and (max-width: 600px)'))
+
+    def test_output_profiles(self):
+        css = ('/* Buttons */\n'
+               '.ui-btn { color: #fff; background: url(http://x/a.png) linear-gradient(#111 /*{a-bar}*/, #222);\n'
+               '          content: "/* x */" }\n'
+               'p { -moz-border-radius-topleft: 3px; margin: 0 }\n'
+               '@media print { p { display: none } }\n')
+
+        helper = ('border-top-left-radius()\n'
+                  '  border-top-left-radius: arguments\n'
+                  '  -webkit-border-top-left-radius: arguments\n'
+                  '  -moz-border-radius-topleft: arguments\n')
+        rules = ('.ui-btn\n'
+                 '  color #fff\n'
+                 '  background: url(http://x/a.png) linear-gradient(#111, #222)\n'
+                 '  content: "/* x */"\n',
+                 'p\n'
+                 '  border-top-left-radius(3px)\n'
+                 '  margin 0\n'
+                 '@media print\n'
+                 '  p\n'
+                 '    display none\n')
+
+        # The helper function is defined before the rules, or before the first rule calling it when they're written
+        # while converting
+        for streaming, expected in ((False, helper + rules[0] + rules[1]), (True, rules[0] + helper + rules[1])):
+            result = Css2Stylus().convert_css(css, parser='builtin', streaming=streaming, output_profile='compact')
+
+            self.assertEqual('// THIS FILE IS AUTOGENERATED BY CSS2STYLUS\n'
+                             '// ----------------------------------------\n'
+                             "@import 'nib'\n"
+                             '/* Extracted variables should be inserted here */\n' + expected,
+                             result.rules_text)
+
+        verbose = Css2Stylus().convert_css(css, parser='builtin')
+        self.assertIn('/* Buttons */', verbose.rules_text)
+        self.assertIn('  background: url(http://x/a.png) linear-gradient(#111 /*{a-bar}*/, #222)', verbose.rules_text)
+
+        # Unused helper functions are left out, shared blocks are compact as well
+        block = '{ background-color: #123456; border-bottom-color: #654321 }'
+        result = Css2Stylus().convert_css('a %s p %s li %s' % (block, block, block), parser='builtin',
+                                          dedupe_blocks=True, output_profile='compact')
+        self.assertNotIn('border-top-left-radius', result.rules_text)
+        self.assertIn('shared-block-1()\n'
+                      '  background-color #123456\n'
+                      '  border-bottom-color #654321\n'
+                      'a\n'
+                      '  shared-block-1()\n',
+                      result.rules_text)
+
+        # Values that Stylus would take for an expression keep the colon
+        self.assertEqual(['color red', 'font: 12px/1.5 a', 'margin: -1px 0', 'z-index: +1', 'width: (1px + 2px)',
+                          'width: [1px]', 'content: {a}', 'margin: .5em', 'margin 0 -1px', 'background url(a.png)'],
+                         Css2Stylus._compact_property_lines(['color: red', 'font: 12px/1.5 a', 'margin: -1px 0',
+                                                             'z-index: +1', 'width: (1px + 2px)', 'width: [1px]',
+                                                             'content: {a}', 'margin: .5em', 'margin: 0 -1px',
+                                                             'background: url(a.png)']))
+
+        self.assertRaises(ValueError, Css2Stylus().convert_css, css, parser='builtin', output_profile='tiny')
+
+    def test_convert_batch(self):
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            jobs = []
+            for i, css in enumerate((self._generate_stylesheet(100, 0),
+                                     '.ui-bar-a { background-image: linear-gradient(#fff, #000) }',
+                                     '.ui-focus { box-shadow: 0 0 12px red }\n.ui-focus { box-shadow: 0 0 12px blue }',
+                                     self._generate_stylesheet(100, 1))):
+                filename = os.path.join(temp_dir, '%d.css' % i)
+                with open(filename, 'wb') as f:
+                    f.write(css)
+
+                jobs.append({'filename' : filename,
+                             'out_filename' : filename + '.rules.styl',
+                             'vars_out_filename' : filename + '.vars.styl',
+                             'use_indented_style' : True,
+                             'parser' : 'builtin'})
+
+            results = list(Css2Stylus.convert_batch(jobs, vars_modules=['some_test_rules'], num_workers=2))
+
+            # Results in input order, the ambiguous variable only fails its own conversion
+            self.assertEqual([job['filename'] for job in jobs], [result['filename'] for result in results])
+            self.assertEqual([False, False, True, False], [result['error'] is not None for result in results])
+            self.assertIn('Variable $my-gradient-start', results[1]['stdout'])
+
+            with captured_output():
+                Css2Stylus().convert(vars_modules=['some_test_rules'],
+                                     **dict(jobs[3], out_filename=os.path.join(temp_dir, 'single.styl')))
+
+            with open(jobs[3]['out_filename'], 'rb') as f:
+                with open(os.path.join(temp_dir, 'single.styl'), 'rb') as single_f:
+                    self.assertEqual(single_f.read(), f.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parallel_rules(self):
+        css = self._generate_stylesheet(300, 2) + '\np.api { color: #3c3c3c }'
+        extraction_rules = ExtractionRules({r'p\.api' : {r'color' : [(r'<COLOR>', 'p-color')]},
+                                            r'.*' : {r'width' : [(r'calc\(<VALUE> -', 'calc-width')],
+                                                     r'color' : [(r'(?P<color>#3c3c3c)', 'dark-color')]}})
+
+        for use_indented_style in (False, True):
+            for streaming in (False, True):
+                outputs = []
+                for num_workers in (1, 3):
+                    stats = ConversionStats()
+                    result = Css2Stylus().convert_css(css,
+                                                      extraction_rules,
+                                                      use_indented_style=use_indented_style,
+                                                      parser='builtin',
+                                                      streaming=streaming,
+                                                      stats=stats,
+                                                      num_workers=num_workers)
+                    report = stats.to_dict()
+                    outputs.append((result.rules_text, result.vars_text, result.messages, result.variables,
+                                    report['selector_patterns'], report['property_patterns'], report['tree']))
+
+                self.assertEqual(outputs[0], outputs[1])
+                self.assertIn('Variable $dark-color', '\n'.join(outputs[1][2]))
+
+        # Ambiguous values fail at the same rule, before the invalid regex of a later rule
+        css = ''.join('.a%d { color: red }\n' % i for i in range(50)) + '.a { color: blue }\n.b { color: green }'
+        extraction_rules = ExtractionRules({r'\.a.*' : {r'color' : [(r'(?P<color>red|blue)', 'a-color')]},
+                                            r'\.b' : {r'color' : [(r'(?P<color>gr)(?P<value>een)', 'b-color')]}})
+        errors = []
+        for num_workers in (1, 3):
+            try:
+                Css2Stylus().convert_css(css, extraction_rules, parser='builtin', num_workers=num_workers)
+            except Exception as e:
+                errors.append(str(e))
+
+        self.assertEqual(2, len(errors))
+        self.assertEqual(errors[0], errors[1])
+        self.assertIn("ambiguous values 'red' and 'blue'", errors[0])
+
+    def test_conversion_cache(self):
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'test.css')
+            with open(filename, 'wb') as f:
+                f.write(self._generate_stylesheet(100, 0))
+
+            cache = ConversionCache(os.path.join(temp_dir, 'cache'))
+            kwargs = {'filename' : filename,
+                      'vars_modules' : ['some_test_rules'],
+                      'use_indented_style' : True,
+                      'parser' : 'builtin'}
+
+            with captured_output() as (uncached_stdout, unused_stderr):
+                Css2Stylus().convert(out_filename=os.path.join(temp_dir, 'uncached.styl'),
+                                     vars_out_filename=os.path.join(temp_dir, 'uncached.vars.styl'),
+                                     **kwargs)
+
+            outputs = []
+            for i in range(2):
+                with captured_output() as (stdout, unused_stderr):
+                    Css2Stylus().convert(out_filename=os.path.join(temp_dir, '%d.styl' % i),
+                                         vars_out_filename=os.path.join(temp_dir, '%d.vars.styl' % i),
+                                         cache=cache,
+                                         **kwargs)
+
+                self.assertEqual(uncached_stdout.getvalue(), stdout.getvalue())
+
+                for suffix in ('.styl', '.vars.styl'):
+                    with open(os.path.join(temp_dir, '%d%s' % (i, suffix)), 'rb') as f:
+                        outputs.append(f.read())
+
+            self.assertEqual(1, len(os.listdir(cache.cache_dir)))
+            self.assertEqual(outputs[:2], outputs[2:])
+
+            with open(os.path.join(temp_dir, 'uncached.styl'), 'rb') as f:
+                self.assertEqual(f.read(), outputs[0])
+
+            # Different options need a new entry, and the oldest entry is evicted if the cache is too small
+            cache.max_size = sum(map(len, outputs[:2])) + 1000
+            with captured_output():
+                Css2Stylus().convert(out_filename=os.path.join(temp_dir, 'linear.styl'),
+                                     vars_out_filename=os.path.join(temp_dir, 'linear.vars.styl'),
+                                     cache=cache,
+                                     **dict(kwargs, use_indented_style=False))
+
+            self.assertEqual(1, len(os.listdir(cache.cache_dir)))
+            with open(os.path.join(temp_dir, 'linear.styl'), 'rb') as f:
+                with open(os.path.join(cache.cache_dir, os.listdir(cache.cache_dir)[0], 'rules.styl'), 'rb') as cached_f:
+                    self.assertEqual(f.read(), cached_f.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_incremental_convert(self):
+        import random
+        import shutil
+        import tempfile
+
+        rnd = random.Random(0)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'test.css')
+            statements = self._generate_stylesheet(200, 0).split('\n')
+
+            # Values that the random edits don't change, so that the variables never become ambiguous
+            extraction_rules = ExtractionRules({r'.*' : {r'width' : [(r'calc\(<VALUE> -', 'calc-width')],
+                                                         r'color' : [(r'(?P<color>#3c3c3c)', 'dark-color')]}})
+
+            for use_indented_style in (True, False):
+                for i in range(6):
+                    if i:
+                        # Random edits: change, remove, add or duplicate rules
+                        for unused_j in range(rnd.randint(1, 5)):
+                            k = rnd.randrange(len(statements))
+                            edit = rnd.choice(('change', 'remove', 'add', 'duplicate'))
+                            if edit == 'change':
+                                statements[k] = statements[k].replace(rnd.choice(('red', '0px', 'div', ';')),
+                                                                      rnd.choice(('blue', '1px', 'p', '')))
+                            elif edit == 'remove':
+                                del statements[k]
+                            elif edit == 'add':
+                                statements.insert(k, self._generate_stylesheet(1, rnd.random()))
+                            else:
+                                statements.insert(rnd.randrange(len(statements)), statements[k])
+
+                    with open(filename, 'wb') as f:
+                        f.write('\n'.join(statements))
+
+                    outputs = []
+                    pattern_reports = []
+                    for incremental in (True, False):
+                        out_filename = os.path.join(temp_dir, 'incremental.styl' if incremental else 'full.styl')
+                        # The first runs fill the index without pattern counts, which must not be reused with stats
+                        stats = ConversionStats() if i >= 2 else None
+                        with captured_output() as (stdout, unused_stderr):
+                            Css2Stylus().convert(filename=filename,
+                                                 out_filename=out_filename,
+                                                 vars_out_filename=out_filename + '.vars',
+                                                 vars_modules=None,
+                                                 use_indented_style=use_indented_style,
+                                                 parser='builtin',
+                                                 extraction_rules=extraction_rules,
+                                                 incremental=incremental,
+                                                 stats=stats,
+                                                 num_workers=2 if i == 5 else 1)
+
+                        if stats is not None:
+                            report = stats.to_dict()
+                            pattern_reports.append((report['selector_patterns'], report['property_patterns']))
+
+                        if incremental and i:
+                            self.assertFalse(re.search(r'Incremental conversion: \d+ rules converted, 0 unchanged',
+                                                       stdout.getvalue()))
+
+                        for suffix in ('', '.vars'):
+                            with open(out_filename + suffix, 'rb') as f:
+                                outputs.append(f.read())
+
+                    self.assertEqual(outputs[:2], outputs[2:])
+                    if pattern_reports:
+                        self.assertEqual(pattern_reports[0], pattern_reports[1])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_conversion_watcher(self):
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'test.css')
+            vars_filename = os.path.join(temp_dir, 'my.vars.styl')
+            merged_filename = os.path.join(temp_dir, 'merged.styl')
+
+            with open(filename, 'wb') as f:
+                f.write('.ui-focus { box-shadow: 0 0 12px red }')
+            with open(vars_filename, 'wb') as f:
+                f.write('$my-box-shadow = 0 0 12px blue\n')
+
+            watcher = ConversionWatcher(filename=filename,
+                                        out_filename=os.path.join(temp_dir, 'rules.styl'),
+                                        vars_out_filename=os.path.join(temp_dir, 'vars.styl'),
+                                        vars_modules=['some_test_rules'],
+                                        use_indented_style=True,
+                                        parser='builtin',
+                                        vars_filename=vars_filename,
+                                        merged_filename=merged_filename)
+
+            def run_stages(stages):
+                with captured_output() as (stdout, unused_stderr):
+                    watcher.run_stages(stages)
+                return stdout.getvalue()
+
+            self.assertEqual(set(), watcher.poll())
+            self.assertIn('Watch: ran load_rules, parse, convert, merge in', run_stages(set()))
+
+            # Vars modules are watched once imported
+            module_filename = os.path.splitext(sys.modules['some_test_rules'].__file__)[0] + '.py'
+            self.assertEqual('load_rules', watcher._get_watched_files()[module_filename])
+            self.assertEqual(set(), watcher.poll())
+
+            with open(merged_filename, 'rb') as f:
+                self.assertIn('$my-box-shadow = 0 0 12px blue\n\n\n.ui-focus\n  box-shadow($my-box-shadow)', f.read())
+
+            # Changing the variables only needs merging
+            with open(vars_filename, 'wb') as f:
+                f.write('$my-box-shadow = none\n')
+            os.utime(vars_filename, (0, 0))
+
+            self.assertEqual(set(['merge']), watcher.poll())
+            self.assertIn('Watch: ran merge in', run_stages(set(['merge'])))
+
+            with open(merged_filename, 'rb') as f:
+                self.assertIn('$my-box-shadow = none\n', f.read())
+
+            # Changing the CSS reconverts, without loading the vars modules again
+            with open(filename, 'wb') as f:
+                f.write('.ui-focus { box-shadow: 0 0 12px red }\np { color: red }')
+            os.utime(filename, (0, 0))
+
+            self.assertEqual(set(['parse']), watcher.poll())
+            self.assertIn('Watch: ran parse, convert, merge in', run_stages(set(['parse'])))
+
+            with open(merged_filename, 'rb') as f:
+                self.assertIn('\np\n  color: red', f.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_output_emitter(self):
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'out.styl')
+
+            with OutputEmitter(filename, max_buffered_lines=2) as emitter:
+                emitter.write_line('body')
+                emitter.indent += 1
+                emitter.write_lines(['color: red', 'p'])
+                emitter.indent += 1
+                emitter.write_line()
+
+            with open(filename, 'rb') as f:
+                self.assertEqual('body\n  color: red\n  p\n    \n', f.read())
+
+            # A failed atomic write leaves the previous output
+            with self.assertRaises(ValueError):
+                with OutputEmitter(filename, atomic=True, max_buffered_lines=1) as emitter:
+                    emitter.write_line('partial')
+                    raise ValueError
+
+            with open(filename, 'rb') as f:
+                self.assertEqual('body\n  color: red\n  p\n    \n', f.read())
+            self.assertEqual(['out.styl'], os.listdir(temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_selector_tree_node(self):
+        root = SelectorTreeNode()
+        for order_index, selector_list in enumerate((('body',), ('p', 'a'), ('div',))):
+            root.set_child(SelectorTreeNode(selector_list, order_index))
+
+        root.get_child(('body',)).set_child(SelectorTreeNode(('p',), 3))
+
+        # Replaced children move to the end
+        root.set_child(SelectorTreeNode(('p', 'a'), 4))
+
+        self.assertEqual([(0, ('body',), 0), (1, ('p',), 3), (0, ('div',), 2), (0, ('p', 'a'), 4)],
+                         [(depth, node.selector_list, node.order_index) for depth, node in root.walk()])
+        self.assertIsNone(root.get_child(('p',)))
+
+        # Added children keep the earlier ones with the same selector list
+        root.add_child(SelectorTreeNode(('div',), 5))
+        self.assertEqual([2, 5], [node.order_index for node in root.iter_children() if node.selector_list == ('div',)])
+        self.assertEqual(5, root.get_child(('div',)).order_index)
+
+        root.clear()
+        self.assertEqual([], list(root.walk()))
+
+    def test_conversion_stats(self):
+        import json
+        import shutil
+        import tempfile
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp_dir, 'test.css')
+            with open(filename, 'wb') as f:
+                f.write('.ui-focus { box-shadow: 0 0 12px red }\n'
+                        '.ui-bar-a p { color: red }\n'
+                        '.ui-bar-a { background-image: none }\n'
+                        'body p a { color: red }')
+
+            stats = ConversionStats()
+            with captured_output():
+                Css2Stylus().convert(filename=filename,
+                                     out_filename=filename + '.styl',
+                                     vars_out_filename=filename + '.vars.styl',
+                                     vars_modules=['some_test_rules'],
+                                     use_indented_style=True,
+                                     parser='builtin',
+                                     stats=stats)
+
+            report = json.loads(json.dumps(stats.to_dict()))
+
+            self.assertEqual(['load_rules', 'parse', 'rules', 'write'], [stage['name'] for stage in report['stages']])
+            self.assertEqual({'nodes' : 6, 'max_depth' : 3}, report['tree'])
+            self.assertEqual({'.ui-focus' : (1, 1), '.ui-bar-a' : (2, 1), '.ui-bar-b' : (0, 0)},
+                             dict((pattern['selector_regex'], (pattern['attempts'], pattern['hits']))
+                                  for pattern in report['selector_patterns']))
+            self.assertEqual({'my-box-shadow' : (1, 1),
+                              'my-gradient-start' : (1, 0),
+                              'my-gradient-end' : (1, 0),
+                              'invalid-regex-example-variable' : (0, 0)},
+                             dict((pattern['variable'], (pattern['searches'], pattern['matches']))
+                                  for pattern in report['property_patterns']))
+
+            self.assertIn('never matched (1 attempts): .ui-bar-a { background-image: linear-gradient',
+                          ConversionStats.format_report(report))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_selector_index(self):
+        variables_to_extract = {}
+        for pattern in (r'.ui-bar-a', r'.ui-bar-a .ui-link(:.*)?', r'.ui-bar-a .ui-link:.*', r'^body\.x', r'p|div',
+                        r'.ui-btn-up-[a-e]', r'(?i)LI', r'ab?c', r'\#main\s.*', r'.*', r'x{2}y', r'.ui-body-a$'):
+            variables_to_extract[pattern] = {'color' : [(r'<COLOR>', pattern)]}
+
+        index = SelectorIndex(variables_to_extract)
+
+        for selector in ('.ui-bar-a', 'xui-bar-a', '.ui-bar-a .ui-link', '.ui-bar-a .ui-link:hover', 'body.x',
+                         'div', 'p a', '.ui-btn-up-c', 'li', 'ac', 'abc', '#main a', 'xxy', '.ui-body-a', '',
+                         '.ui-bar-b'):
+            expected = variables_to_extract.get(selector)
+            for selector_match_regex in variables_to_extract if expected is None else ():
+                if re.match(selector_match_regex if selector_match_regex.endswith('$') else selector_match_regex + '$',
+                            selector):
+                    expected = variables_to_extract[selector_match_regex]
+                    break
+
+            self.assertEqual(expected, variables_to_extract.get(index.find(selector)))
+
+        self.assertEqual((1, 'ui-bar-a '), SelectorIndex._literal_anchor(r'.ui-bar-a .ui-link(:.*)?'))
+        self.assertEqual((0, 'a'), SelectorIndex._literal_anchor(r'ab?c'))
+        self.assertIsNone(SelectorIndex._literal_anchor(r'p|div'))
+
+    def test_value_substitution(self):
+        substitution = ValueSubstitution('linear-gradient(#3c3c3c /*{start}*/, #111 /*{end}*/)')
+
+        # Substitutions in any order, searches don't see already substituted parts
+        for variable_name in ('end', 'start'):
+            match = substitution.search(re.compile(r'(?P<color>#[0-9a-f]{3,6}) /\*\{%s' % variable_name))
+            substitution.substitute(match.start('color'), match.end('color'), '$' + variable_name)
+
+        self.assertIsNone(substitution.search(re.compile(r'#[0-9a-f]{3,6}')))
+        self.assertEqual('linear-gradient($start /*{start}*/, $end /*{end}*/)', substitution.get_value())
+
+        self.assertRaises(AssertionError, lambda: substitution.substitute(20, 30, '$x'))
+        self.assertRaises(AssertionError, lambda: substitution.substitute(0, 17, '$x'))
+        substitution.substitute(0, 15, '$x')
+        self.assertEqual('$x($start /*{start}*/, $end /*{end}*/)', substitution.get_value())
+
+        # Errors of the extraction
+        rule = {'selector_list' : ('p',), 'properties' : [('color', 'red', '')]}
+        for extraction_infos, message in (([(r'(?P<color>red)', 'a'), (r'<VALUE>', 'b')],
+                                           'Regex search overlaps with inserted variable'),
+                                          ([(r'(?P<color>r)(?P<value>ed)', 'a')],
+                                           'Two groups in the regex matched!'),
+                                          ([(r'r(?P<color>x)?', 'a')],
+                                           'Variable value of a not found')):
+            with self.assertRaises(AssertionError) as context:
+                Css2Stylus()._convertStyleRule(rule, ExtractionRules({r'p' : {r'color' : extraction_infos}}))
+            self.assertEqual(message, str(context.exception))
 
     def test_overlaps(self):
         o = lambda s1, e1, s2, e2: Css2Stylus.overlaps((s1, e1), (s2, e2))
@@ -514,31 +5210,216 @@ class UnitTest(unittest.TestCase):
         self.assertFalse(o(1, 2, 3, 4))
         self.assertFalse(o(3, 4, 1, 2))
 
+    def test_startup(self):
+        import shutil
+        import subprocess
+        import tempfile
+
+        # Modules that take long to import (cssutils alone takes about 0.1 seconds), the timing itself is measured by
+        # benchmarks/startup.py
+        slow_modules = ('cssutils', 'logging', 'multiprocessing', 'SocketServer', 'unittest')
+
+        script_filename = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+        def get_imported_modules(argv=None):
+            """
+            Imports the module in a new interpreter, runs main() with the arguments (if any) and returns the names of
+            the imported modules.
+            """
+            code = ('import sys\n'
+                    'sys.path.insert(0, %r)\n'
+                    'sys.argv = %r\n'
+                    'import css2stylus\n'
+                    '%s\n'
+                    'sys.stderr.write(" ".join(sorted(sys.modules)))\n') % (os.path.dirname(script_filename),
+                                                                            [script_filename] + (argv or []),
+                                                                            'css2stylus.main()' if argv else '')
+            process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            unused_stdout, stderr = process.communicate()
+            self.assertEqual(0, process.returncode, stderr)
+            return set(stderr.splitlines()[-1].split())
+
+        temp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(temp_dir)
+        try:
+            with open('test.css', 'wb') as f:
+                f.write(self._generate_stylesheet(20, 0))
+
+            convert_args = ['convert', '--input', 'test.css', '--output', 'rules.styl', '--vars-output', 'vars.styl']
+            merge_args = ['merge', '--input', 'rules.styl', '--vars-input', 'vars.styl', '--output', 'merged.styl']
+
+            self.assertIn('cssutils', get_imported_modules(convert_args))
+
+            for argv in (None, convert_args + ['--parser', 'builtin'], merge_args):
+                self.assertEqual([], sorted(set(slow_modules) & get_imported_modules(argv)))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(temp_dir)
+
+def _get_batch_jobs(input_pattern, manifest_filename, output_template, vars_output_template):
+    """
+    Returns the (filename, out_filename, vars_out_filename) tuples of batch mode, either from a glob pattern or from a
+    JSON manifest file with a list of {"input": ..., "output": ..., "vars_output": ...} objects. Missing output
+    filenames are built from the templates, e.g. "build/{name}.rules.styl" where {name} is the input filename without
+    directory and extension, and {dir} is the input directory.
+    """
+    import glob
+    import json
+
+    if manifest_filename:
+        with open(manifest_filename, 'rU') as f:
+            entries = json.load(f)
+    else:
+        entries = [{'input' : filename} for filename in sorted(glob.glob(input_pattern))]
+
+    jobs = []
+    for entry in entries:
+        filename = entry['input']
+        template_args = {'name' : os.path.splitext(os.path.basename(filename))[0],
+                         'dir' : os.path.dirname(filename) or '.'}
+
+        out_filename = entry.get('output') or (output_template and output_template.format(**template_args))
+        vars_out_filename = (entry.get('vars_output') or
+                             (vars_output_template and vars_output_template.format(**template_args)))
+
+        if not out_filename or not vars_out_filename:
+            raise ValueError('Missing output or variables output filename for %s' % filename)
+
+        jobs.append((filename, out_filename, vars_out_filename))
+
+    return jobs
+
+def run_unit_tests(argv):
+    import unittest
+
+    global UnitTest
+    UnitTest = type('UnitTest', (UnitTestMethods, unittest.TestCase), {})
+
+    unittest.main(argv=argv)
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description='Convert plain CSS to Stylus, extract variables, merge your own '
                                                  'variable values with a generated Stylus file.')
-    parser.add_argument('mode', help='Mode, either "convert", "merge" or "unittest"')
+    parser.add_argument('mode', help='Mode, either "convert", "batch", "merge", "compile-vars", "watch", "serve", '
+                                     '"status" or "unittest"')
     parser.add_argument('--input',
-                        help='Input file (CSS file for convert mode, Stylus file for merge mode)',
+                        help='Input file (CSS file for convert and watch mode, Stylus file for merge mode, glob '
+                             'pattern of CSS files for batch mode)',
                         metavar='FILENAME')
     parser.add_argument('--vars-input',
-                        help='Variables file (merge mode only, Stylus file containing variable values)',
+                        help='Variables file (merge and watch mode, Stylus file containing variable values). In merge '
+                             'mode, this can be a glob pattern of many variables files, e.g. one per theme',
+                        metavar='FILENAME')
+    parser.add_argument('--output',
+                        help='Stylus output file (convert, merge and watch mode), filename template like '
+                             '"{dir}/{name}.rules.styl" in batch mode and in merge mode with many variables files, '
+                             'compiled rules file in compile-vars mode',
+                        metavar='FILENAME')
+    parser.add_argument('--vars-output',
+                        help='Variables output file (convert and watch mode), filename template in batch mode',
+                        metavar='FILENAME')
+    parser.add_argument('--merged-output',
+                        help='Merged Stylus output file (watch mode only, merging is skipped if not given)',
                         metavar='FILENAME')
-    parser.add_argument('--output', help='Stylus output file (convert and merge mode)', metavar='FILENAME')
-    parser.add_argument('--vars-output', help='Variables output file (convert mode only)', metavar='FILENAME')
+    parser.add_argument('--manifest',
+                        help='JSON file with a list of {"input": ..., "output": ..., "vars_output": ...} objects, '
+                             'instead of --input (batch mode only)',
+                        metavar='FILENAME')
+    parser.add_argument('--jobs',
+                        type=int,
+                        help='Number of worker processes (batch and serve mode, defaults to the number of CPUs), '
+                             'threads (merge mode, defaults to 1) or worker processes converting the rules of the '
+                             'stylesheet in parallel (convert mode without server, defaults to 1)',
+                        metavar='NUMBER')
     parser.add_argument('--vars-module',
                         action='append',
                         dest='vars_modules',
                         help='Python module with a dictionary called EXTRACT_VARIABLES defining which variables to '
-                             'extract. Can be defined multiple times, rules are merged together. (convert mode only, '
-                             'defaults to none)',
+                             'extract, or a JSON rule file ending in .json. Can be defined multiple times, rules are '
+                             'merged together. A single compiled rules file (see compile-vars mode) is loaded without '
+                             'importing any module (convert, batch, watch, serve and compile-vars mode, defaults to '
+                             'none)',
                         metavar='MODULE NAME')
     parser.add_argument('--no-indented-style',
                         action="store_false",
                         default=True,
-                        help='Output Stylus in linear style, not indented (convert mode only)')
+                        help='Output Stylus in linear style, not indented (convert, batch and watch mode)')
+    parser.add_argument('--parser',
+                        choices=sorted(PARSERS),
+                        default='cssutils',
+                        help='CSS parser backend, "builtin" is much faster than the reference "cssutils" parser '
+                             '(convert, batch and watch mode, defaults to cssutils)')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Parse the input rule by rule instead of loading the whole stylesheet, keeps memory usage '
+                             'constant in linear style (convert and batch mode)')
+    parser.add_argument('--cache-dir',
+                        help='Directory for caching conversion results. Unchanged stylesheets are not converted again '
+                             'if the variables modules and options are unchanged as well (convert and batch mode)',
+                        metavar='DIRECTORY')
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=100,
+                        help='Maximum size of the cache directory in megabytes, least recently used results are '
+                             'evicted (defaults to 100)',
+                        metavar='MEGABYTES')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Keep a fingerprint index of the converted rules next to the output file and only '
+                             'reconvert changed rules on the next run (convert, batch and watch mode)')
+    parser.add_argument('--dedupe-blocks',
+                        action='store_true',
+                        help='Write property lines that are repeated in several rules as shared Stylus mixins, which '
+                             'makes the output smaller without changing the compiled CSS (convert, batch and watch '
+                             'mode)')
+    parser.add_argument('--discover-vars',
+                        type=int,
+                        help='Turn colors and lengths that are used more than NUMBER times into variables with names '
+                             'like $color-3c3c3c, in addition to the --vars-module rules (convert, batch and watch '
+                             'mode)',
+                        metavar='NUMBER')
+    parser.add_argument('--output-profile',
+                        choices=OUTPUT_PROFILES,
+                        default='verbose',
+                        help='Format of the rules output, "compact" leaves out colons, blank lines, comments and '
+                             'unused helper functions, which Stylus compiles faster (convert, batch and watch mode, '
+                             'defaults to verbose)')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='Print timings and memory usage per stage, match statistics of the EXTRACT_VARIABLES '
+                             'patterns and the size of the selector tree (convert and merge mode)')
+    parser.add_argument('--stats-json',
+                        help='Write the --stats report to a JSON file (convert and merge mode)',
+                        metavar='FILENAME')
+    parser.add_argument('--atomic',
+                        action='store_true',
+                        help='Write output files through temporary files that are renamed when finished, so that other '
+                             'tools never see partial output (convert, batch and watch mode)')
+    parser.add_argument('--mmap',
+                        action='store_true',
+                        help='Memory-map the input files instead of reading them (merge mode only)')
+    parser.add_argument('--socket',
+                        help='Unix socket of the server. In serve mode, listen on it, in convert and merge mode, send '
+                             'the job to the server instead of running it, in status mode, query the server',
+                        metavar='FILENAME')
+    parser.add_argument('--port',
+                        type=int,
+                        help='Like --socket, but with a TCP port on localhost',
+                        metavar='PORT')
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=16,
+                        help='Number of requests that may wait for a free worker, further requests are rejected as '
+                             'busy (serve mode only, defaults to 16)',
+                        metavar='NUMBER')
+    parser.add_argument('--timeout',
+                        type=float,
+                        help='Seconds after which a request to the server fails (serve, convert and merge mode, '
+                             'defaults to 60)',
+                        metavar='SECONDS')
 
     args = parser.parse_args()
 
@@ -548,6 +5429,46 @@ def main():
         exit(1)
         raise Exception
 
+    server_address = args.socket or (('127.0.0.1', args.port) if args.port else None)
+
+    # The TCP server writes its token to a file of the user, clients read it from there
+    server_token = None
+    if args.port and not args.socket and args.mode != 'serve':
+        try:
+            with open(get_server_token_filename(args.port), 'rb') as f:
+                server_token = f.read().strip()
+        except IOError as e:
+            print('ERROR: Cannot read the server token: %s' % e, file=sys.stderr)
+            exit(1)
+
+    def run_on_server(command, options):
+        """
+        Runs a convert or merge job on the server and prints its output like a local run. Returns the stats report.
+        """
+        try:
+            response = send_server_request(server_address, {'command' : command,
+                                                            'options' : options,
+                                                            'cwd' : os.getcwd(),
+                                                            'stats' : args.stats or bool(args.stats_json),
+                                                            'timeout' : args.timeout},
+                                           token=server_token)
+        except EnvironmentError as e:
+            print('ERROR: Cannot reach server: %s' % e, file=sys.stderr)
+            exit(1)
+
+        sys.stdout.write(response.get('stdout', ''))
+        sys.stderr.write(response.get('stderr', ''))
+
+        if not response['ok']:
+            print('ERROR: Server request failed: %s' % response['error'], file=sys.stderr)
+            exit(1)
+
+        return response['stats']
+
+    cache = ConversionCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+    stats = ConversionStats() if args.stats or args.stats_json else None
+    report = None
+
     if args.mode == 'testjqm':
         args.input = 'jquery.mobile.theme-1.1.0.css'
         args.output = 'jquery.mobile.theme-1.1.0.css.autogen.rules.styl'
@@ -562,27 +5483,214 @@ def main():
         args.mode = 'convert'
 
     if args.mode == 'unittest':
-        unittest.main(argv=sys.argv[:1])
+        run_unit_tests(sys.argv[:1])
     elif args.mode == 'convert':
         if not args.input:
             arg_error('Missing input filename')
         if not args.output or not args.vars_output:
             arg_error('Missing output or variables output filename')
 
-        Css2Stylus().convert(filename=args.input,
-                             out_filename=args.output,
-                             vars_out_filename=args.vars_output,
-                             vars_modules=args.vars_modules,
-                             use_indented_style=not args.no_indented_style)
+        if server_address:
+            report = run_on_server('convert', {'filename' : args.input,
+                                               'out_filename' : args.output,
+                                               'vars_out_filename' : args.vars_output,
+                                               'vars_modules' : args.vars_modules,
+                                               'use_indented_style' : not args.no_indented_style,
+                                               'streaming' : args.streaming,
+                                               'parser' : args.parser,
+                                               'cache_dir' : args.cache_dir,
+                                               'cache_size' : args.cache_size,
+                                               'incremental' : args.incremental,
+                                               'atomic' : args.atomic,
+                                               'dedupe_blocks' : args.dedupe_blocks,
+                                               'discover_vars' : args.discover_vars,
+                                               'output_profile' : args.output_profile})
+        else:
+            Css2Stylus().convert(filename=args.input,
+                                 out_filename=args.output,
+                                 vars_out_filename=args.vars_output,
+                                 vars_modules=args.vars_modules,
+                                 use_indented_style=not args.no_indented_style,
+                                 streaming=args.streaming,
+                                 parser=args.parser,
+                                 cache=cache,
+                                 incremental=args.incremental,
+                                 atomic=args.atomic,
+                                 stats=stats,
+                                 dedupe_blocks=args.dedupe_blocks,
+                                 num_workers=args.jobs or 1,
+                                 discover_vars=args.discover_vars,
+                                 output_profile=args.output_profile)
+    elif args.mode == 'batch':
+        if not args.input and not args.manifest:
+            arg_error('Missing input pattern or manifest')
+
+        try:
+            jobs = _get_batch_jobs(args.input, args.manifest, args.output, args.vars_output)
+        except ValueError as e:
+            arg_error(str(e))
+
+        num_failed = 0
+
+        for (filename, unused_out_filename, unused_vars_out_filename), result in zip(
+                jobs,
+                Css2Stylus.convert_batch([{'filename' : filename,
+                                           'out_filename' : out_filename,
+                                           'vars_out_filename' : vars_out_filename,
+                                           'use_indented_style' : not args.no_indented_style,
+                                           'streaming' : args.streaming,
+                                           'parser' : args.parser,
+                                           'cache' : cache,
+                                           'incremental' : args.incremental,
+                                           'atomic' : args.atomic,
+                                           'dedupe_blocks' : args.dedupe_blocks,
+                                           'discover_vars' : args.discover_vars,
+                                           'output_profile' : args.output_profile}
+                                          for filename, out_filename, vars_out_filename in jobs],
+                                         vars_modules=args.vars_modules,
+                                         num_workers=args.jobs)):
+            print('Converting %s' % filename)
+            sys.stdout.write(result['stdout'])
+            sys.stderr.write(result['stderr'])
+
+            if result['error']:
+                num_failed += 1
+                print('ERROR: Converting %s failed:\n%s' % (filename, result['error']), file=sys.stderr)
+
+        print('Converted %d of %d stylesheets' % (len(jobs) - num_failed, len(jobs)))
+
+        if num_failed:
+            exit(1)
     elif args.mode == 'merge':
         if not args.input:
             arg_error('Missing input filename')
         if not args.output or not args.vars_input:
             arg_error('Missing output or variables input filename')
 
-        Css2Stylus.merge(stylus_filename=args.input, vars_filename=args.vars_input, out_merged_filename=args.output)
+        if any(char in args.vars_input for char in '*?['):
+            # One output per variables file (e.g. themes), the rules file is only read once
+            import glob
+
+            if '{name}' not in args.output:
+                arg_error('Output filename template must contain {name} if merging many variables files')
+
+            jobs = [(vars_filename, args.output.format(name=os.path.splitext(os.path.basename(vars_filename))[0],
+                                                       dir=os.path.dirname(vars_filename) or '.'))
+                    for vars_filename in sorted(glob.glob(args.vars_input))]
+
+            if not jobs:
+                arg_error('No variables files match %s' % args.vars_input)
+        else:
+            jobs = [(args.vars_input, args.output)]
+
+        merge_options = {'stylus_filename' : args.input,
+                         'jobs' : jobs,
+                         'num_workers' : args.jobs or 1,
+                         'use_mmap' : args.mmap}
+
+        if server_address:
+            report = run_on_server('merge', merge_options)
+        else:
+            Css2Stylus.merge_many(stats=stats, **merge_options)
+    elif args.mode == 'compile-vars':
+        if not args.vars_modules:
+            arg_error('Missing variables modules or rule files')
+        if not args.output:
+            arg_error('Missing output filename')
+
+        try:
+            extraction_rules = ExtractionRules.compile(args.vars_modules, args.output)
+        except ValueError as e:
+            print('ERROR: %s' % e, file=sys.stderr)
+            exit(1)
+
+        print('Compiled %d selector patterns into %s' % (len(extraction_rules.variables_to_extract), args.output))
+    elif args.mode == 'watch':
+        if not args.input:
+            arg_error('Missing input filename')
+        if not args.output or not args.vars_output:
+            arg_error('Missing output or variables output filename')
+        if bool(args.vars_input) != bool(args.merged_output):
+            arg_error('Variables input and merged output filename must be given together')
+
+        ConversionWatcher(filename=args.input,
+                          out_filename=args.output,
+                          vars_out_filename=args.vars_output,
+                          vars_modules=args.vars_modules,
+                          use_indented_style=not args.no_indented_style,
+                          parser=args.parser,
+                          incremental=args.incremental,
+                          atomic=args.atomic,
+                          dedupe_blocks=args.dedupe_blocks,
+                          discover_vars=args.discover_vars,
+                          output_profile=args.output_profile,
+                          vars_filename=args.vars_input,
+                          merged_filename=args.merged_output).run()
+    elif args.mode == 'serve':
+        if not server_address:
+            arg_error('Missing socket filename or port')
+
+        if not args.socket:
+            import binascii
+
+            server_token = binascii.hexlify(os.urandom(16))
+            token_filename = get_server_token_filename(args.port)
+
+            # Only readable by the user
+            if os.path.exists(token_filename):
+                os.remove(token_filename)
+            with os.fdopen(os.open(token_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                f.write(server_token + '\n')
+
+        server = ConversionServer(address=server_address,
+                                  vars_modules=args.vars_modules,
+                                  num_workers=args.jobs,
+                                  queue_size=args.queue_size,
+                                  timeout=args.timeout or 60,
+                                  token=server_token)
+
+        print('Listening on %s with %d workers, press Ctrl+C to stop' % (args.socket or 'port %d' % args.port,
+                                                                          server.num_workers))
+
+        # Also clean up when stopped by a service manager
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+
+            if server_token is not None:
+                os.remove(token_filename)
+    elif args.mode == 'status':
+        if not server_address:
+            arg_error('Missing socket filename or port')
+
+        import json
+
+        print(json.dumps(send_server_request(server_address, {'command' : 'status'}, timeout=args.timeout or 60,
+                                             token=server_token),
+                         indent=2,
+                         sort_keys=True))
     else:
         arg_error('Invalid mode')
 
+    # Jobs that ran on the server returned its report instead
+    if stats is not None and report is None:
+        report = stats.to_dict()
+
+    if report is not None:
+        if args.stats:
+            print(ConversionStats.format_report(report))
+
+        if args.stats_json:
+            import json
+
+            with open(args.stats_json, 'wb') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -38,4 +38,11 @@ E[r'.ui-bar-a'] = {r'background-image' : [(r'linear-gradient\(\s*<COLOR>', 'my-g
 # not match.
 E[r'.ui-bar-b'] = {r'background-ImAgE' : [(r'linear-gradient\(\s*<COLOR>', 'invalid-regex-example-variable')]}
 
-EXTRACT_VARIABLES = E
\ No newline at end of file
+EXTRACT_VARIABLES = E
+
+# Properties in NIB_SHORTHANDS (see css2stylus.py) are written as nib function calls, e.g. "border-radius(.6em)" for
+# "-webkit-border-radius", "-moz-border-radius" and "border-radius". A vars module can add more functions, and more
+# vendor prefixes whose properties are converted to the same calls (if your nib version writes these prefixes):
+#
+# NIB_SHORTHANDS = {'transition' : 'transition'}
+# VENDOR_PREFIXES = ['-khtml-']